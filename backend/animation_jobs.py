@@ -0,0 +1,176 @@
+"""
+动画生成任务管理模块
+"""
+import threading
+import time
+import uuid
+
+# 配置参数
+POLL_INITIAL_DELAY = 2.0  # 任务创建后第一次查询的等待时间（秒）
+POLL_BACKOFF = 1.5  # 每次查询后等待时间的增长倍数
+POLL_MAX_DELAY = 15.0  # 查询间隔的上限（秒）
+POLL_MAX_ERRORS = 5  # 连续查询失败达到该次数后判定任务失败
+JOB_RETENTION = 3600  # 已结束的任务保留多长时间供客户端查询（秒）
+JOB_MAX_AGE = 1800  # 任务创建后超过该时间（秒）仍未结束则判定超时失败，避免上游卡住的任务被无限等待
+
+TERMINAL_STATUSES = ('succeeded', 'failed')
+
+
+class AnimationJob:
+    """一个动画生成任务：对应一个上游content_generation任务"""
+
+    def __init__(self, task_id, params):
+        self.job_id = uuid.uuid4().hex
+        self.task_id = task_id  # 上游任务ID
+        self.params = params  # 创建任务时的请求参数，随状态一起返回给客户端
+        self.status = 'queued'
+        self.video_url = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.version = 0  # 状态每变化一次加1，SSE据此判断是否需要推送
+        self.poll_count = 0
+        self.poll_errors = 0
+        self.next_poll_at = self.created_at + POLL_INITIAL_DELAY
+
+    @property
+    def finished(self):
+        return self.status in TERMINAL_STATUSES
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'task_id': self.task_id,
+            'status': self.status,
+            'video_url': self.video_url,
+            'error': self.error,
+            'params': self.params,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
+
+
+class AnimationJobManager:
+    """管理所有动画生成任务，由一个后台线程统一轮询上游任务状态
+
+    每个任务按自己的时间表查询：刚创建时查询较频繁，之后查询间隔按POLL_BACKOFF倍增长到POLL_MAX_DELAY，
+    后台线程每次只查询已经到期的任务，没有任务时休眠直到有新任务提交。创建后超过max_age仍未结束的任务判定为超时失败。
+    client只需提供 content_generation.tasks.create / get 接口，测试时可以替换为本地的假客户端。
+    """
+
+    def __init__(self, client, model="doubao-seedance-1-0-pro-250528", initial_delay=POLL_INITIAL_DELAY,
+                 backoff=POLL_BACKOFF, max_delay=POLL_MAX_DELAY, retention=JOB_RETENTION, max_age=JOB_MAX_AGE):
+        self.client = client
+        self.model = model
+        self.initial_delay = initial_delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.retention = retention
+        self.max_age = max_age
+        self._jobs = {}
+        self._condition = threading.Condition()
+        self._poller = None
+
+    def submit(self, content, params=None):
+        """创建上游任务并登记，立即返回任务对象（不等待生成完成）"""
+        create_result = self.client.content_generation.tasks.create(
+            model=self.model,
+            content=content
+        )
+        job = AnimationJob(create_result.id, params or {})
+        job.next_poll_at = job.created_at + self.initial_delay
+        print(f"动画生成任务已创建，任务ID: {job.task_id}，作业ID: {job.job_id}")
+
+        with self._condition:
+            self._jobs[job.job_id] = job
+            self._ensure_poller()
+            # 唤醒后台线程重新计算下一次查询时间
+            self._condition.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def snapshot(self, job_id):
+        """返回任务当前状态的字典，任务不存在时返回None"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            return job.to_dict() if job else None
+
+    def _ensure_poller(self):
+        if self._poller is None or not self._poller.is_alive():
+            self._poller = threading.Thread(target=self._poll_loop, name="animation-job-poller", daemon=True)
+            self._poller.start()
+
+    def _next_delay(self, job):
+        return min(self.max_delay, self.initial_delay * self.backoff ** job.poll_count)
+
+    def _update(self, job, **changes):
+        # 调用方需持有self._condition
+        for name, value in changes.items():
+            setattr(job, name, value)
+        job.updated_at = time.time()
+        job.version += 1
+        self._condition.notify_all()
+
+    def _poll_loop(self):
+        while True:
+            with self._condition:
+                now = time.time()
+                # 清理保留期已过的已结束任务
+                for job_id in [job_id for job_id, job in self._jobs.items()
+                               if job.finished and now - job.updated_at > self.retention]:
+                    del self._jobs[job_id]
+
+                for job in self._jobs.values():
+                    if not job.finished and now - job.created_at > self.max_age:
+                        print(f"动画生成任务 {job.task_id} 超时")
+                        self._update(job, status='failed', error=f"任务超过{self.max_age:g}秒仍未完成")
+                
+                pending = [job for job in self._jobs.values() if not job.finished]
+                due = [job for job in pending if job.next_poll_at <= now]
+                if not due:
+                    # 休眠到最早到期的任务，有新任务提交时会被提前唤醒
+                    timeout = min((job.next_poll_at for job in pending), default=now + self.retention) - now
+                    self._condition.wait(timeout=max(0.0, timeout))
+                    continue
+
+            # 查询上游时不持有锁，避免阻塞状态查询和新任务提交
+            for job in due:
+                try:
+                    self._poll_job(job)
+                except Exception as e:
+                    # 上游返回的结果格式异常等错误只让这一个任务失败，后台线程继续轮询其他任务
+                    print(f"处理动画生成任务 {job.task_id} 的状态时发生错误: {str(e)}")
+                    with self._condition:
+                        self._update(job, status='failed', error=f"处理任务状态失败: {str(e)}")
+
+    def _poll_job(self, job):
+        try:
+            get_result = self.client.content_generation.tasks.get(task_id=job.task_id)
+        except Exception as e:
+            print(f"查询动画生成任务 {job.task_id} 失败: {str(e)}")
+            with self._condition:
+                job.poll_errors += 1
+                job.poll_count += 1
+                if job.poll_errors >= POLL_MAX_ERRORS:
+                    self._update(job, status='failed', error=f"查询任务状态失败: {str(e)}")
+                else:
+                    job.next_poll_at = time.time() + self._next_delay(job)
+            return
+
+        status = get_result.status
+        with self._condition:
+            job.poll_errors = 0
+            job.poll_count += 1
+            job.next_poll_at = time.time() + self._next_delay(job)
+            if status == "succeeded":
+                print(f"动画生成任务 {job.task_id} 成功完成")
+                self._update(job, status='succeeded', video_url=get_result.content.video_url.strip())
+            elif status == "failed":
+                error_msg = get_result.error.message if get_result.error else "未知错误"
+                print(f"动画生成任务 {job.task_id} 失败: {error_msg}")
+                self._update(job, status='failed', error=error_msg)
+            elif status != job.status:
+                self._update(job, status=status)
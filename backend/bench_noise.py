@@ -0,0 +1,82 @@
+"""
+噪音生成微基准：比较逐样本循环的旧LFSR实现与查表的NoiseEngine
+
+用法：python bench_noise.py [样本数] [重复次数]
+默认88200个样本（44.1kHz下2秒的噪音音符），结果取多次运行中的最短时间。
+"""
+import os
+import sys
+import time
+
+import numpy as np
+
+os.environ.setdefault('ARK_API_KEY', 'bench')  # 导入模块时会创建Ark客户端，基准测试不调用模型
+
+from chiptune_generation import LFSR_SEED, NoiseEngine
+
+DEFAULT_SAMPLES = 88200  # 44.1kHz下2秒
+DEFAULT_REPEATS = 5
+
+
+def legacy_noise_lfsr(num_samples, pulse_width):
+    """改为查表之前的实现：逐样本移位LFSR，并逐样本抽随机数决定是否输出"""
+    lfsr = LFSR_SEED
+    noise = np.zeros(num_samples)
+    noise_density = max(0.1, min(0.9, pulse_width))
+    for i in range(num_samples):
+        bit = ((lfsr >> 1) & 1) ^ (lfsr & 1)
+        lfsr = (lfsr >> 1) | (bit << 14)
+        if np.random.random() < noise_density:
+            noise[i] = (lfsr & 1) * 2.0 - 1.0
+        else:
+            noise[i] = 0.0
+    return noise
+
+
+def legacy_register_bits(num_samples):
+    """旧实现每一步移位后的输出位（不含密度掩码），用于核对新实现的寄存器序列"""
+    lfsr = LFSR_SEED
+    bits = np.empty(num_samples, dtype=np.float32)
+    for i in range(num_samples):
+        bit = ((lfsr >> 1) & 1) ^ (lfsr & 1)
+        lfsr = (lfsr >> 1) | (bit << 14)
+        bits[i] = (lfsr & 1) * 2.0 - 1.0
+    return bits
+
+
+def best_time(func, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main():
+    num_samples = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SAMPLES
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_REPEATS
+
+    engine = NoiseEngine()
+    # 第一次调用需要构建周期表，每种模式只构建一次，单独计时
+    start = time.perf_counter()
+    engine.generate(1, mode='long')
+    table_time = time.perf_counter() - start
+
+    old_time = best_time(lambda: legacy_noise_lfsr(num_samples, 0.5), repeats)
+    new_time = best_time(lambda: engine.generate(num_samples, density=0.5), repeats)
+
+    # 输出噪音的样本上，新旧实现的寄存器序列必须一致
+    noise = engine.generate(num_samples, density=0.5)
+    audible = noise != 0
+    matches = np.array_equal(noise[audible], legacy_register_bits(num_samples)[audible])
+
+    print(f"样本数: {num_samples}，重复: {repeats}次（取最短时间）")
+    print(f"旧实现（逐样本循环）: {old_time * 1000:.1f} ms")
+    print(f"NoiseEngine:          {new_time * 1000:.1f} ms（约{old_time / new_time:.0f}倍）")
+    print(f"周期表构建（每种模式一次）: {table_time * 1000:.1f} ms")
+    print(f"寄存器序列与旧实现一致: {matches}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,32 @@
 """
 音乐生成功能模块
 """
+import base64
+import contextvars
+import hashlib
+import math
+import heapq
+import io
+import itertools
+import json
 import os
-import tempfile
+import re
+import struct
+import subprocess
 import uuid
+import weakref
+import zipfile
 from fastapi import FastAPI, HTTPException, Body
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 import numpy as np
 from pydub import AudioSegment
-import re
 import sys
-from collections import defaultdict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import contextmanager
 
 # 通过 pip install 'volcengine-python-sdk[ark]' 安装方舟SDK
 from volcenginesdkarkruntime import Ark
@@ -28,6 +43,53 @@ client = Ark(
 SAMPLE_RATE = 44100  # 音频采样率
 VOLUME = 0.3  # 整体音量 (0-1)
 BIT_DEPTH = 16  # 位深度
+MIX_GAIN = 0.7  # 混合各轨道时的缩放因子，避免混合后溢出
+NOTE_CACHE_MAX_BYTES = 64 * 1024 * 1024  # 音符渲染缓存的内存上限
+ENCODER_CHUNK_SIZE = 64 * 1024  # 流式编码时每次读写的字节数
+MIX_REVERB_TIME = 0.02  # 混音总线混响的延迟时间（秒）
+MIX_REVERB_DECAY = 0.1  # 混音总线混响的衰减系数
+STREAM_BLOCK_BEATS = 4  # 流式合成时每块的拍数（默认一小节）
+STREAM_LOOKBACK_BEATS = 4  # 边生成边合成时，允许后到达的音符比已到达的最晚音符提前的拍数
+BEATS_PER_BAR = 4  # 每小节的拍数
+REVERB_TAIL_THRESHOLD = 1e-5  # 混响尾音衰减到该比例以下视为结束（低于16位PCM的最小量化步长）
+RENDER_WORKERS = int(os.environ.get('CHIPTUNE_RENDER_WORKERS', '1'))  # 并行渲染轨道的工作者数，1为串行
+PARALLEL_MIN_NOTES = 256  # 音符数低于该值时始终串行渲染
+BATCH_MAX_SAMPLES = 256 * 1024  # 批量渲染音符时单批二维数组的最大样本数（保持在CPU缓存内）
+SCATTER_MAX_NOTE_SAMPLES = 128  # 不超过该长度的音符整体scatter-add，更长的逐个切片累加
+LFSR_SEED = 0x1234  # 噪音LFSR的默认种子
+ARP_STEP_RATE = 60  # 琶音每秒切换的次数（与NES的帧率相同）
+VIBRATO_DEFAULT_RATE = 6.0  # 颤音参数只给出深度时使用的速度（Hz）
+RAW_STRING_PARAMS = ('arp',)  # 值为十六进制数字序列的参数，保持原样的字符串（前导0有意义，不能转换为整数）
+
+# 磁盘缓存目录（支持exe打包：打包后放在exe所在目录）
+CACHE_DIR = os.environ.get('CHIPTUNE_CACHE_DIR') or os.path.join(
+    os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(__file__), "cache")
+PROMPT_CACHE_MAX_BYTES = 16 * 1024 * 1024  # 提示词→Chiptune文本缓存的磁盘上限
+PROMPT_CACHE_MAX_AGE = 7 * 24 * 3600  # 提示词缓存条目的最长保留时间（秒）
+RENDER_CACHE_MAX_BYTES = 512 * 1024 * 1024  # 乐谱→编码音频缓存的磁盘上限
+RENDER_CACHE_MAX_AGE = 24 * 3600  # 渲染缓存条目的最长保留时间（秒）
+MAX_RENDER_VARIANTS = 16  # 单次重渲染请求最多包含的变体数
+
+# 支持的输出格式：wav和pcm直接输出，不经过外部编码器；pcm按audio/L16（RFC 2586）的规定为16位大端字节序
+OUTPUT_FORMATS = {
+    'mp3': {'media_type': 'audio/mpeg', 'ffmpeg_args': ('-f', 'mp3')},
+    'ogg': {'media_type': 'audio/ogg', 'ffmpeg_args': ('-c:a', 'libvorbis', '-f', 'ogg')},
+    'wav': {'media_type': 'audio/wav'},
+    'pcm': {'media_type': 'audio/L16', 'dtype': '>i2'},
+}
+SUPPORTED_SAMPLE_RATES = (22050, 32000, 44100)
+
+STEM_FORMATS = ('wav', 'ogg')  # 分轨导出支持的格式
+
+# 输出档位：preview用于快速试听，以低采样率直接合成并输出未压缩数据；final用于导出
+OUTPUT_PROFILES = {
+    'preview': {'format': 'wav', 'sample_rate': 22050},
+    'final': {'format': 'mp3', 'sample_rate': SAMPLE_RATE},
+}
+
+# 生成Chiptune文本使用的模型和系统提示词
+CHIPTUNE_MODEL = "doubao-1-5-pro-256k-250115"
+CHIPTUNE_SYSTEM_PROMPT = "你是一个专业的Chiptune音乐生成器。你的任务是根据用户提供的音乐风格描述，生成符合Chiptune格式的音乐指令文本。\n\nChiptune格式说明：\n1. 每行代表一个音符指令\n2. 格式为：轨道|时间|音符|时长|参数\n3. 轨道类型：S1/S2（方波），TR（三角波），NO（噪音）\n4. 时间格式：小节:拍 或 拍数\n5. 音符格式：八度+音名（如4C表示第4八度的C音）\n6. 时长：以拍为单位\n7. 参数：vol=音量(0-15), pw=脉冲宽度(0-100)；方波和三角波还可以使用效果参数：arp=琶音（十六进制半音偏移，如arp=47表示在根音、+4、+7半音之间快速循环）, vib=颤音（速度Hz:深度半音，如vib=6:0.3）, sweep=滑音（音符内滑动的半音数，如sweep=-12）, pws=方波占空比扫动的目标值(0-100)\n\n示例：\nS1 | 1:1 | 5C | 0.5 | vol=10\nS1 | 1:1.5 | 5D | 0.5 | vol=10\nS1 | 1:2 | 5E | 0.5 | vol=10\n8. 音符按起始时间先后顺序输出\n9. 需要循环播放时，可以用一行 LOOP | 开始时间 | 结束时间 标记循环区间\n10. 和弦琶音、颤音、滑音请用一个带效果参数的音符表示，不要拆成大量短音符，保持乐谱简洁\n\n效果示例：\nS2 | 1:1 | 4C | 2 | vol=8, arp=47\nS1 | 1:3 | 5G | 2 | vol=10, vib=6:0.3\nTR | 2:1 | 3C | 1 | vol=12, sweep=-12\n\n请严格按照上述格式输出，不要添加任何额外的文本或解释。"
 
 # 音高频率映射 (A4 = 440Hz)
 NOTE_FREQUENCIES = {
@@ -39,6 +101,32 @@ NOTE_FREQUENCIES = {
 class MusicGenerationRequest(BaseModel):
     prompt: str
     bpm: Optional[int] = 130
+    use_cache: Optional[bool] = True  # 为False时忽略提示词缓存，重新调用模型生成
+    pipelined: Optional[bool] = False  # 为True时以流式方式调用模型，边生成乐谱边合成
+    loop: Optional[bool] = False  # 循环模式：只合成一遍循环体，其余重复部分直接平铺
+    loop_count: Optional[int] = 2  # 循环模式下循环体的重复次数
+    loop_duration: Optional[float] = None  # 循环模式下的总时长（秒），指定时覆盖loop_count
+    stems: Optional[bool] = False  # 分轨模式：返回各轨道分轨和总混音的zip
+    profile: Optional[str] = "final"  # 输出档位：preview 或 final
+    output_format: Optional[str] = None  # 覆盖档位的输出格式：mp3/ogg/wav/pcm
+    sample_rate: Optional[int] = None  # 覆盖档位的采样率：22050/32000/44100
+
+
+class RenderVariant(BaseModel):
+    bpm: Optional[int] = 130
+    profile: Optional[str] = "final"  # 输出档位：preview 或 final
+    output_format: Optional[str] = None  # 覆盖档位的输出格式：mp3/ogg/wav/pcm
+    sample_rate: Optional[int] = None  # 覆盖档位的采样率：22050/32000/44100
+    loop: Optional[bool] = False  # 循环模式：只合成一遍循环体，其余重复部分直接平铺
+    loop_count: Optional[int] = 2  # 循环模式下循环体的重复次数
+    loop_duration: Optional[float] = None  # 循环模式下的总时长（秒），指定时覆盖loop_count
+    stems: Optional[bool] = False  # 分轨模式：返回各轨道分轨和总混音的zip
+
+
+class ChiptuneRenderRequest(BaseModel):
+    score: str  # Chiptune乐谱文本
+    variants: Optional[List[RenderVariant]] = None  # 为空时按默认参数渲染一个变体
+    bundle: Optional[str] = "zip"  # 返回方式：zip 或 json
 
 
 def note_to_frequency(note):
@@ -85,197 +173,551 @@ def parse_parameters(param_str):
     elif not isinstance(param_str, str):
         param_str = str(param_str)
         
-    # 打印参数字符串用于调试
-    print(f"解析参数字符串: {repr(param_str)}")
-        
     for param in param_str.split(','):
-        param = param.strip()
-        if '=' in param:
-            key, value = param.split('=', 1)  # 只分割第一个等号
-            key = key.lower().strip()
-            value = value.strip()
-            
-            # 打印键值对用于调试
-            print(f"解析键值对: key={repr(key)}, value={repr(value)}")
-            
-            # 清理值中的特殊字符
-            value = value.encode('utf-8', errors='ignore').decode('utf-8')
-            
-            # 尝试将值转换为适当的类型
-            # 首先检查是否为整数
-            if value.isdigit() or (value.startswith('-') and value[1:].isdigit()):
-                params[key] = int(value)
-                print(f"参数 {key} 转换为整数: {params[key]}")
-            # 然后检查是否为浮点数
-            elif ('.' in value and value.replace('.', '', 1).isdigit()) or (value.startswith('-') and '.' in value and value[1:].replace('.', '', 1).isdigit()):
-                try:
-                    params[key] = float(value)
-                    print(f"参数 {key} 转换为浮点数: {params[key]}")
-                except ValueError:
-                    # 保持为字符串
-                    params[key] = value
-                    print(f"参数 {key} 保持为字符串: {params[key]}")
-            else:
-                # 保持为字符串
-                params[key] = value
-                print(f"参数 {key} 保持为字符串: {params[key]}")
+        key, sep, value = param.partition('=')  # 只分割第一个等号
+        if not sep:
+            continue
+        key = key.lower().strip()
+        value = value.strip()
+        
+        # 尝试将值转换为适当的类型：整数、浮点数，否则保持为字符串
+        if key in RAW_STRING_PARAMS:
+            params[key] = value
+        elif value.isdigit() or (value.startswith('-') and value[1:].isdigit()):
+            params[key] = int(value)
+        elif ('.' in value and value.replace('.', '', 1).isdigit()) or (value.startswith('-') and '.' in value and value[1:].replace('.', '', 1).isdigit()):
+            params[key] = float(value)
+        else:
+            params[key] = value
     return params
 
 
-def generate_wave(freq, duration, sample_rate, wave_type='square', pulse_width=0.5, volume=1.0, envelope=None):
-    """生成指定类型的波形"""
+def parse_number_param(value):
+    """把参数值转换为数字，字符串形式的数字按整数截断"""
+    if isinstance(value, str):
+        return int(float(value)) if '.' in value else int(value)
+    return value
+
+
+class OscillatorBank:
+    """带限波表振荡器组，按(波形, 脉冲宽度档位, 谐波数档位)缓存单周期波表"""
+
+    TABLE_BITS = 11
+    TABLE_SIZE = 1 << TABLE_BITS  # 单周期波表长度
+    PHASE_BITS = 32  # 定点相位累加器位数
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _build_table(self, wave_type, pw_bucket, harmonics):
+        """用傅里叶级数合成前harmonics次谐波，得到不超过奈奎斯特频率的单周期波表"""
+        spectrum = np.zeros(self.TABLE_SIZE // 2 + 1, dtype=np.complex128)
+        k = np.arange(1, harmonics + 1)
+
+        if wave_type == 'square':
+            # 占空比为d的脉冲波：直流分量2d-1，k次谐波幅度4/(kπ)·sin(πkd)，相位中心在d/2
+            duty = pw_bucket / 100.0
+            spectrum[0] = 2 * duty - 1
+            amplitude = 4 / (k * np.pi) * np.sin(np.pi * k * duty)
+            spectrum[k] = amplitude * np.exp(-2j * np.pi * k * duty / 2) / 2
+        elif wave_type == 'triangle':
+            # 从-1起始的三角波，只含奇次谐波，幅度8/(π²k²)
+            odd = k[k % 2 == 1]
+            spectrum[odd] = -8 / (np.pi ** 2 * odd ** 2) / 2
+        elif wave_type == 'saw':
+            # 锯齿波 Σ 2/(πk)·sin(2πkφ)：两个相位差为d的锯齿波相减即为占空比d的脉冲波（减去直流）
+            spectrum[k] = -1j / (np.pi * k)
+        else:
+            spectrum[1] = -0.5j
+
+        table = np.fft.irfft(spectrum * self.TABLE_SIZE, n=self.TABLE_SIZE)
+        return table.astype(np.float32)
+
+    def table_key(self, wave_type, pulse_width, freq, sample_rate):
+        """计算某个音符使用的波表档位 (波形, 脉冲宽度档位, 谐波数档位)"""
+        if wave_type not in ('square', 'triangle', 'saw'):
+            wave_type = 'sine'
+        pw_bucket = int(round(max(0.0, min(1.0, pulse_width)) * 100)) if wave_type == 'square' else 0
+
+        # 谐波数按2的幂向下取整分档，保证最高次谐波低于奈奎斯特频率
+        max_harmonics = max(1, min(self.TABLE_SIZE // 2, int(sample_rate / 2 / freq)))
+        harmonics = 1 << (max_harmonics.bit_length() - 1)
+        return (wave_type, pw_bucket, harmonics)
+
+    def get_table(self, wave_type, pulse_width, freq, sample_rate):
+        """获取(并缓存)适合该频率的带限波表"""
+        key = self.table_key(wave_type, pulse_width, freq, sample_rate)
+        table = self._tables.get(key)
+        if table is None:
+            with self._lock:
+                table = self._tables.get(key)
+                if table is None:
+                    table = self._build_table(*key)
+                    self._tables[key] = table
+        return table
+
+    def render(self, freq, num_samples, sample_rate, wave_type='square', pulse_width=0.5):
+        """用相位累加器在波表中查表生成波形（float32）"""
+        return self.render_batch([freq], num_samples, sample_rate, wave_type, [pulse_width])[0]
+
+    def render_batch(self, freqs, num_samples, sample_rate, wave_type='square', pulse_widths=None):
+        """批量渲染多个等长音符，返回形状为 (音符数, num_samples) 的float32数组"""
+        freqs = np.asarray(freqs, dtype=np.float64)
+        pulse_widths = np.full(len(freqs), 0.5) if pulse_widths is None else np.asarray(pulse_widths, dtype=np.float64)
+        waves = np.zeros((len(freqs), max(0, num_samples)), dtype=np.float32)
+        audible = np.flatnonzero(freqs > 0)
+        if num_samples <= 0 or len(audible) == 0:
+            return waves
+
+        # 每个音符对应一张波表，相同的波表只取一次并堆叠成二维数组
+        table_rows = {}
+        rows = []
+        for freq, pulse_width in zip(freqs[audible].tolist(), pulse_widths[audible].tolist()):
+            table = self.get_table(wave_type, pulse_width, freq, sample_rate)
+            rows.append(table_rows.setdefault(id(table), (len(table_rows), table))[0])
+        tables = np.concatenate([table for _, table in table_rows.values()])
+        # 各音符所用波表在拼接数组中的起始偏移
+        table_offsets = (np.array(rows, dtype=np.uint32) * np.uint32(self.TABLE_SIZE))[:, None]
+
+        # 32位定点相位累加，溢出即自然回绕一个周期，无需取模
+        increments = np.round(freqs[audible] / sample_rate * (1 << self.PHASE_BITS)).astype(np.uint64)
+        increments = (increments & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+        phase = np.arange(num_samples, dtype=np.uint32)[None, :] * increments[:, None]
+
+        # 高位作为波表索引，低位作为线性插值系数
+        frac_bits = self.PHASE_BITS - self.TABLE_BITS
+        index = phase >> np.uint32(frac_bits)
+        frac = (phase & np.uint32((1 << frac_bits) - 1)).astype(np.float32) * np.float32(1.0 / (1 << frac_bits))
+        following = ((index + np.uint32(1)) & np.uint32(self.TABLE_SIZE - 1)) + table_offsets
+        current = tables.take(index + table_offsets)
+        following = tables.take(following)
+        following -= current
+        following *= frac
+        current += following
+        waves[audible] = current
+        return waves
+
+    def _lookup(self, table, phase):
+        """按 [0, 1) 的浮点相位在单周期波表中线性插值查表"""
+        position = phase * self.TABLE_SIZE
+        index = position.astype(np.int64)
+        frac = (position - index).astype(np.float32)
+        index &= self.TABLE_SIZE - 1
+        current = table[index]
+        return current + (table[(index + 1) & (self.TABLE_SIZE - 1)] - current) * frac
+
+    def render_modulated(self, freqs, sample_rate, wave_type='square', pulse_width=0.5, pulse_width_end=None):
+        """按逐样本变化的频率（和占空比）渲染波形，相位由频率累加得到，变化过程中保持连续
+
+        波表的谐波数按整段中的最高频率选取，保证频率最高处也不会混叠。
+        pulse_width_end不为None时占空比从pulse_width线性变化到pulse_width_end，
+        用两个相位差为占空比的带限锯齿波相减得到任意占空比的带限脉冲波。
+        """
+        freqs = np.asarray(freqs, dtype=np.float64)
+        if len(freqs) == 0 or freqs.max() <= 0:
+            return np.zeros(len(freqs), dtype=np.float32)
+        
+        # 第n个样本的相位为之前各样本频率之和，从0开始
+        phase = np.cumsum(freqs / sample_rate)
+        phase = np.concatenate(([0.0], phase[:-1]))
+        phase -= np.floor(phase)
+        max_freq = float(freqs.max())
+        
+        if wave_type == 'square' and pulse_width_end is not None:
+            duty = np.linspace(pulse_width, pulse_width_end, len(freqs))
+            saw = self.get_table('saw', 0.5, max_freq, sample_rate)
+            shifted = phase - duty
+            shifted -= np.floor(shifted)
+            wave = self._lookup(saw, phase) - self._lookup(saw, shifted)
+            wave += (2 * duty - 1).astype(np.float32)
+            return wave.astype(np.float32, copy=False)
+        
+        table = self.get_table(wave_type, pulse_width, max_freq, sample_rate)
+        return self._lookup(table, phase).astype(np.float32, copy=False)
+
+
+oscillator_bank = OscillatorBank()
+
+
+def generate_wave(freq, duration, sample_rate, wave_type='square', pulse_width=0.5, volume=1.0, envelope=None, noise_mode='long',
+                  effects=None):
+    """生成指定类型的波形，effects为效果参数字典（arp/vib_rate/vib_depth/sweep/pw_end），只对方波和三角波生效"""
     # 计算样本数
     num_samples = int(sample_rate * duration)
     if num_samples <= 0:
-        return np.array([], dtype=np.int16)
-    
-    # 生成时间数组
-    t = np.linspace(0, duration, num_samples, endpoint=False)
-    
-    if wave_type == 'square':
-        # 改进的方波生成算法，更接近真实的芯片音乐声音
-        # 使用更精确的脉冲宽度控制
-        wave = np.zeros(num_samples)
-        if freq > 0:
-            period = 1.0 / freq
-            wave = np.where((t % period) < (pulse_width * period), 1.0, -1.0)
-        
-    elif wave_type == 'triangle':
-        # 改进的三角波生成算法
-        wave = np.zeros(num_samples)
-        if freq > 0:
-            wave = 2 * np.abs(2 * (t * freq - np.floor(t * freq + 0.5))) - 1
-        
-    elif wave_type == 'noise':
+        return np.array([], dtype=np.float32)
+    
+    if wave_type == 'noise':
         # 改进的噪音生成算法，模拟经典游戏机的噪音效果
         # 使用线性反馈移位寄存器(LFSR)生成伪随机噪音
-        wave = generate_noise_lfsr(num_samples, pulse_width)
-            
+        wave = generate_noise_lfsr(num_samples, pulse_width, mode=noise_mode)
+    elif effects:
+        # 带效果的音符逐样本计算频率和占空比，用相位累加保持波形连续
+        pw_end = effects.get('pw_end', -1.0)
+        freqs = note_frequency_curve(freq, num_samples, sample_rate, effects.get('arp', 0), effects.get('vib_rate', 0.0),
+                                     effects.get('vib_depth', 0.0), effects.get('sweep', 0.0))
+        wave = oscillator_bank.render_modulated(freqs, sample_rate, wave_type, pulse_width,
+                                                pw_end if pw_end >= 0 else None)
     else:
-        # 默认正弦波
-        wave = np.sin(2 * np.pi * freq * t) if freq > 0 else np.zeros(num_samples)
+        # 方波、三角波和正弦波都从带限波表中查表生成，避免高八度的混叠
+        wave = oscillator_bank.render(freq, num_samples, sample_rate, wave_type, pulse_width)
+    
+    # 应用包络、音量和淡入淡出
+    wave = shape_note_waves(wave, volume, envelope)
+    
+    # 保持float32归一化样本，统一在混音总线的最后阶段限幅和量化
+    return wave.astype(np.float32, copy=False)
+
+
+def note_frequency_curve(freq, num_samples, sample_rate, arp=0, vib_rate=0.0, vib_depth=0.0, sweep=0.0):
+    """向量化计算带效果音符的逐样本频率：滑音、颤音和琶音都以半音为单位叠加后换算为频率"""
+    semitones = np.zeros(num_samples, dtype=np.float64)
+    sample_index = np.arange(num_samples)
+    if sweep:
+        # 滑音在音符时长内线性地滑过sweep个半音
+        semitones += sweep * (sample_index / max(1, num_samples))
+    if vib_depth:
+        semitones += vib_depth * np.sin(2 * np.pi * vib_rate / sample_rate * sample_index)
+    if arp:
+        offsets = np.array(arp_offsets(arp), dtype=np.float64)
+        steps = (sample_index * ARP_STEP_RATE // sample_rate) % len(offsets)
+        semitones += offsets[steps]
+    return freq * np.exp2(semitones / 12.0)
+
+
+def shape_note_waves(waves, volume, envelope=None):
+    """对一个波形或一批等长波形（最后一维为样本）原地应用包络、音量和淡入淡出
+
+    批量渲染时volume为形状 (音符数, 1) 的float32列向量。
+    """
+    num_samples = waves.shape[-1]
     
     # 应用包络控制（如果提供）
     if envelope is not None and len(envelope) == num_samples:
-        wave *= envelope
+        waves *= envelope
     elif envelope is not None and len(envelope) != num_samples:
         # 如果包络长度不匹配，进行插值
         envelope_interp = np.interp(np.linspace(0, 1, num_samples), np.linspace(0, 1, len(envelope)), envelope)
-        wave *= envelope_interp
+        waves *= envelope_interp
     
     # 应用音量
-    wave = wave * volume * VOLUME
+    waves *= volume
+    waves *= VOLUME
     
     # 应用淡入淡出效果以减少爆音
     fade_samples = min(100, num_samples // 10)  # 淡入淡出样本数
     if fade_samples > 0:
         fade_in = np.linspace(0, 1, fade_samples)
         fade_out = np.linspace(1, 0, fade_samples)
-        wave[:fade_samples] *= fade_in
-        wave[-fade_samples:] *= fade_out
-    
-    # 转换为16位PCM格式
-    wave = np.clip(wave, -1.0, 1.0)  # 限制范围
-    wave = (wave * (2 **(BIT_DEPTH - 1) - 1)).astype(np.int16)
-    return wave
+        waves[..., :fade_samples] *= fade_in
+        waves[..., -fade_samples:] *= fade_out
+    return waves
+
+
+class NoiseEngine:
+    """基于预计算LFSR周期表的噪音生成器（模拟NES噪音通道的长/短模式）"""
+
+    # 反馈抽头：长模式为bit0^bit1（周期32767），短模式为bit0^bit6（周期93或31）
+    FEEDBACK_TAPS = {'long': 1, 'short': 6}
+    REGISTER_BITS = 15
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def _build_table(self, mode):
+        """将15位LFSR的全部状态分解为若干循环，记录每个状态所在循环及位置"""
+        tap = self.FEEDBACK_TAPS[mode]
+        num_states = 1 << self.REGISTER_BITS
+        cycle_ids = np.full(num_states, -1, dtype=np.int32)
+        positions = np.zeros(num_states, dtype=np.int32)
+        cycles = []
 
+        for start in range(1, num_states):
+            if cycle_ids[start] >= 0:
+                continue
+            # 沿循环走一圈，记录每一步移位后的输出位
+            bits = []
+            lfsr = start
+            while True:
+                cycle_ids[lfsr] = len(cycles)
+                positions[lfsr] = len(bits)
+                bit = ((lfsr >> tap) & 1) ^ (lfsr & 1)
+                lfsr = (lfsr >> 1) | (bit << (self.REGISTER_BITS - 1))
+                bits.append(lfsr & 1)
+                if lfsr == start:
+                    break
+            cycles.append(np.array(bits, dtype=np.float32) * 2.0 - 1.0)
 
-def generate_noise_lfsr(num_samples, pulse_width):
+        return cycle_ids, positions, cycles
+
+    def _get_table(self, mode):
+        table = self._tables.get(mode)
+        if table is None:
+            with self._lock:
+                table = self._tables.get(mode)
+                if table is None:
+                    table = self._build_table(mode)
+                    self._tables[mode] = table
+        return table
+
+    def generate(self, num_samples, density=0.5, mode='long', seed=LFSR_SEED):
+        """生成指定长度的噪音，相同的种子总是得到相同的输出"""
+        if num_samples <= 0:
+            return np.array([], dtype=np.float32)
+        if mode not in self.FEEDBACK_TAPS:
+            mode = 'long'
+
+        # 全零状态会让LFSR锁死，退回默认种子
+        state = seed & ((1 << self.REGISTER_BITS) - 1) or LFSR_SEED
+        cycle_ids, positions, cycles = self._get_table(mode)
+        cycle = cycles[cycle_ids[state]]
+
+        # 通过取模索引在周期表上平铺出任意长度的序列
+        indices = (positions[state] + np.arange(num_samples)) % len(cycle)
+        noise = cycle[indices]
+
+        # 根据噪音密度决定哪些样本输出噪音，掩码由种子确定以保证可复现
+        noise_density = max(0.1, min(0.9, density))
+        rng = np.random.default_rng(seed)
+        noise[rng.random(num_samples) >= noise_density] = 0.0
+        return noise
+
+
+noise_engine = NoiseEngine()
+
+
+def generate_noise_lfsr(num_samples, pulse_width, mode='long', seed=LFSR_SEED):
     """使用线性反馈移位寄存器(LFSR)生成伪随机噪音"""
-    # 初始化LFSR
-    lfsr = 0x1234  # 初始种子
-    noise = np.zeros(num_samples)
+    return noise_engine.generate(num_samples, density=pulse_width, mode=mode, seed=seed)
+
+
+# 编译后乐谱中波形类型和噪音模式的编号
+WAVE_TYPES = ('square', 'triangle', 'noise')
+NOISE_MODES = ('long', 'short')
+
+# 编译后乐谱的列式记录结构，每条记录对应一个音符
+SCORE_DTYPE = np.dtype([
+    ('channel', np.int16),  # 轨道编号，对应CompiledScore.channels中的下标
+    ('time', np.float64),  # 起始拍
+    ('duration', np.float64),  # 时长（拍）
+    ('freq', np.float64),  # 频率，噪音为0
+    ('wave', np.int8),  # 波形类型，对应WAVE_TYPES中的下标
+    ('pulse_width', np.float64),  # 脉冲宽度/噪音密度 (0-1)
+    ('volume', np.float64),  # 音量 (0-1)
+    ('noise_mode', np.int8),  # 噪音模式，对应NOISE_MODES中的下标
+    ('arp', np.int32),  # 琶音编码（见parse_arp_param），0为无琶音
+    ('vib_rate', np.float32),  # 颤音速度（Hz）
+    ('vib_depth', np.float32),  # 颤音深度（半音），0为无颤音
+    ('sweep', np.float32),  # 音符内的滑音幅度（半音），0为无滑音
+    ('pw_end', np.float32),  # 占空比扫动的目标值 (0-1)，负数为不扫动
+])
+
+
+class CompiledScore:
+    """编译后的乐谱：所有音符存放在一个NumPy记录数组中，按轨道连续排列"""
+
+    def __init__(self, channels, notes, diagnostics, loop=None):
+        self.channels = channels  # 轨道名列表，按首次出现的顺序
+        self.notes = notes  # SCORE_DTYPE记录数组，同一轨道内保持乐谱中的顺序
+        self.diagnostics = diagnostics  # 编译过程中收集的警告信息
+        self.loop = loop  # 乐谱中标记的循环区间 (开始拍, 结束拍或None)，没有标记时为None
+        # 每个轨道在notes中的起止下标
+        self._bounds = np.searchsorted(notes['channel'], np.arange(len(channels) + 1))
+
+    def __len__(self):
+        return len(self.notes)
+
+    def __bool__(self):
+        return len(self.notes) > 0
+
+    def channel_notes(self, channel_id):
+        """返回某个轨道的全部音符（记录数组的切片）"""
+        return self.notes[self._bounds[channel_id]:self._bounds[channel_id + 1]]
+
+    def tracks(self):
+        """依次返回 (轨道名, 该轨道的音符)"""
+        return [(name, self.channel_notes(channel_id)) for channel_id, name in enumerate(self.channels)]
+
+    def select(self, mask, time_offset=0.0):
+        """返回只包含mask选中音符的乐谱，起始时间整体平移time_offset拍"""
+        notes = self.notes[mask]
+        notes['time'] += time_offset
+        return CompiledScore(self.channels, notes, self.diagnostics)
+
+
+def channel_wave_type(channel):
+    """根据轨道名确定波形类型"""
+    if channel.startswith('TR'):
+        return 'triangle'
+    if channel.startswith('NO'):
+        return 'noise'
+    return 'square'
+
+
+def parse_arp_param(value):
+    """解析琶音参数：每个十六进制数字是一个相对根音的半音偏移（根音本身隐含在最前面）
+
+    返回编码后的整数：高4位为偏移个数，低位依次为各偏移；例如arp=47编码为 (2 << 28) | 0x47。
+    """
+    digits = str(value).strip().lower()
+    if not digits or len(digits) > 7 or any(c not in '0123456789abcdef' for c in digits):
+        raise ValueError(f"琶音参数无效: {value}")
+    return (len(digits) << 28) | int(digits, 16)
+
+
+def arp_offsets(arp_code):
+    """把琶音编码展开为半音偏移序列（包括根音的0）"""
+    count = arp_code >> 28
+    return [0] + [(arp_code >> (4 * (count - 1 - i))) & 0xF for i in range(count)]
+
+
+def parse_vibrato_param(value):
+    """解析颤音参数 速度:深度，只给出一个数字时作为深度，返回 (速度Hz, 深度半音)"""
+    rate, sep, depth = str(value).partition(':')
+    if not sep:
+        return VIBRATO_DEFAULT_RATE, float(rate)
+    return float(rate), float(depth)
+
+
+def parse_loop_line(line):
+    """解析循环标记行 LOOP | 开始时间 | 结束时间，返回 (开始拍, 结束拍或None)"""
+    parts = [p.strip() for p in line.split('|')]
+    parts = [p for p in parts if p]
+    if len(parts) < 2:
+        raise ValueError("循环标记缺少开始时间")
+    start = parse_time(parts[1])
+    end = parse_time(parts[2]) if len(parts) > 2 else None
+    if start < 0:
+        raise ValueError("循环开始时间不能早于第1小节第1拍")
+    if end is not None and end <= start:
+        raise ValueError("循环结束时间必须晚于开始时间")
+    return start, end
+
+
+def compile_note_line(line, channel_ids, channels):
+    """把一行音符指令编译为一条记录（元组），格式不正确时抛出ValueError"""
+    parts = [p.strip() for p in line.split('|')]
+    parts = [p for p in parts if p]
+    if len(parts) < 4:
+        raise ValueError("格式不正确")
+    channel, time_str, note, duration_str = parts[:4]
+    params = parse_parameters(parts[4]) if len(parts) > 4 else {}
     
-    # 根据脉冲宽度参数调整噪音密度
-    noise_density = max(0.1, min(0.9, pulse_width))
+    time = parse_time(time_str)
+    duration = parse_duration(duration_str)
+    if time < 0:
+        raise ValueError("起始时间不能早于第1小节第1拍")
+    wave_type = channel_wave_type(channel)
     
-    for i in range(num_samples):
-        # 生成LFSR噪音
-        bit = ((lfsr >> 1) & 1) ^ (lfsr & 1)
-        lfsr = (lfsr >> 1) | (bit << 14)
-        
-        # 根据噪音密度决定是否输出噪音
-        if np.random.random() < noise_density:
-            noise[i] = (lfsr & 1) * 2.0 - 1.0
-        else:
-            noise[i] = 0.0
+    # 提取脉冲宽度
+    pulse_width = 0.5  # 默认值
+    noise_mode = 'long'  # 噪音模式，np参数以s结尾时使用短周期模式
+    if 'pw' in params:
+        pulse_width = parse_number_param(params['pw']) / 100.0
+    elif 'np' in params:  # 噪音周期参数
+        np_value = params['np']
+        if isinstance(np_value, str) and np_value.lower().endswith('s'):
+            noise_mode = 'short'
+            np_value = np_value[:-1]
+        pulse_width = parse_number_param(np_value) / 100.0
+    
+    # 提取音量，转换为0-1范围
+    volume = parse_number_param(params['vol']) / 15.0 if 'vol' in params else 0.7
+    
+    # 计算频率（噪音不需要频率）
+    freq = note_to_frequency(note) if wave_type != 'noise' else 0.0
+    
+    # 效果参数，只对方波和三角波生效
+    arp, vib_rate, vib_depth, sweep, pw_end = 0, 0.0, 0.0, 0.0, -1.0
+    if wave_type != 'noise':
+        if 'arp' in params:
+            arp = parse_arp_param(params['arp'])
+        if 'vib' in params:
+            vib_rate, vib_depth = parse_vibrato_param(params['vib'])
+        if 'sweep' in params:
+            sweep = float(params['sweep'])
+        if 'pws' in params and wave_type == 'square':
+            pw_end = max(0.0, min(1.0, float(params['pws']) / 100.0))
     
-    return noise
+    channel_id = channel_ids.get(channel)
+    if channel_id is None:
+        channel_id = channel_ids[channel] = len(channels)
+        channels.append(channel)
+    return (channel_id, time, duration, freq, WAVE_TYPES.index(wave_type),
+            pulse_width, volume, NOISE_MODES.index(noise_mode),
+            arp, vib_rate, vib_depth, sweep, pw_end)
+
+
+class IncrementalScoreParser:
+    """增量编译Chiptune指令文本：文本可以分段送入，每凑齐一整行就立即编译
+
+    用于边接收模型输出边合成，编译规则与parse_chiptune_text完全相同。
+    """
+
+    def __init__(self):
+        self.channels = []
+        self.channel_ids = {}
+        self.records = []
+        self.diagnostics = []
+        self.latest_time = 0.0  # 已编译音符中最晚的起始时间（拍）
+        self.loop = None  # 循环标记 (开始拍, 结束拍或None)
+        self._chunks = []
+        self._pending = ''  # 尚未凑齐一整行的文本
+        self._line_num = 0
+
+    def feed(self, text):
+        """送入一段文本，返回其中新凑齐的行编译出的音符（SCORE_DTYPE记录数组）"""
+        self._chunks.append(text)
+        lines = (self._pending + text).split('\n')
+        self._pending = lines.pop()
+        return self._compile_lines(lines)
+
+    def close(self):
+        """文本结束，编译最后一行（没有换行结尾），返回新编译出的音符"""
+        lines = [self._pending]
+        self._pending = ''
+        return self._compile_lines(lines)
+
+    @property
+    def text(self):
+        """目前为止送入的全部文本"""
+        return ''.join(self._chunks)
+
+    def _compile_lines(self, lines):
+        start = len(self.records)
+        for line in lines:
+            self._line_num += 1
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue  # 跳过空行和注释
+            try:
+                if line.upper().startswith('LOOP'):
+                    self.loop = parse_loop_line(line)
+                else:
+                    self.records.append(compile_note_line(line, self.channel_ids, self.channels))
+            except Exception as e:
+                self.diagnostics.append(f"第{self._line_num}行解析失败 - {str(e)}，跳过")
+        notes = np.array(self.records[start:], dtype=SCORE_DTYPE)
+        if len(notes):
+            self.latest_time = max(self.latest_time, float(notes['time'].max()))
+        return notes
+
+    def score(self):
+        """把已编译的全部音符整理为CompiledScore"""
+        notes = np.array(self.records, dtype=SCORE_DTYPE)
+        # 稳定排序使同一轨道的音符连续存放，且保持乐谱中的先后顺序
+        notes = notes[np.argsort(notes['channel'], kind='stable')]
+        return CompiledScore(list(self.channels), notes, list(self.diagnostics), self.loop)
 
 
 def parse_chiptune_text(chiptune_text):
-    """解析Chiptune指令文本"""
-    tracks = defaultdict(list)  # 按轨道存储指令
-    
-    for line_num, line in enumerate(chiptune_text.split('\n'), 1):
-        line = line.strip()
-        if not line or line.startswith('#'):
-            continue  # 跳过空行和注释
-            
-        # 解析每行指令
-        parts = [p.strip() for p in re.split(r'\|', line) if p.strip()]
-        
-        if len(parts) < 4:
-            print(f"警告: 第{line_num}行格式不正确，跳过")
-            continue
-            
-        channel, time_str, note, duration_str = parts[:4]
-        params_str = parts[4] if len(parts) > 4 else ''
-        
-        # 解析各部分
-        try:
-            time = parse_time(time_str)
-            duration = parse_duration(duration_str)
-            params = parse_parameters(params_str)
-            
-            # 确定波形类型
-            wave_type = 'square'
-            if channel.startswith('S1') or channel.startswith('S2'):
-                wave_type = 'square'
-            elif channel.startswith('TR'):
-                wave_type = 'triangle'
-            elif channel.startswith('NO'):
-                wave_type = 'noise'
-                
-            # 提取脉冲宽度
-            pulse_width = 0.5  # 默认值
-            if 'pw' in params:
-                # 确保参数值是数字
-                pw_value = params['pw']
-                if isinstance(pw_value, str):
-                    pw_value = int(float(pw_value)) if '.' in pw_value else int(pw_value)
-                pulse_width = pw_value / 100.0
-            elif 'np' in params:  # 噪音周期参数
-                # 确保参数值是数字
-                np_value = params['np']
-                if isinstance(np_value, str):
-                    np_value = int(float(np_value)) if '.' in np_value else int(np_value)
-                pulse_width = np_value / 100.0
-                
-            # 提取音量
-            volume = 0.7  # 默认值
-            if 'vol' in params:
-                # 确保参数值是数字
-                vol_value = params['vol']
-                if isinstance(vol_value, str):
-                    vol_value = int(float(vol_value)) if '.' in vol_value else int(vol_value)
-                volume = vol_value / 15.0  # 转换为0-1范围
-                
-            # 添加到轨道
-            tracks[channel].append({
-                'time': time,
-                'note': note,
-                'duration': duration,
-                'wave_type': wave_type,
-                'pulse_width': pulse_width,
-                'volume': volume
-            })
-            
-        except Exception as e:
-            print(f"警告: 解析第{line_num}行时出错 - {str(e)}，跳过")
-            continue
-    
-    return tracks
+    """单遍解析并编译Chiptune指令文本，返回CompiledScore，警告信息收集在diagnostics中"""
+    parser = IncrementalScoreParser()
+    parser.feed(chiptune_text)
+    parser.close()
+    return parser.score()
 
 
 def generate_envelope(duration, sample_rate, attack=0.01, decay=0.01, sustain=0.7, release=0.05):
@@ -312,136 +754,1100 @@ def generate_envelope(duration, sample_rate, attack=0.01, decay=0.01, sustain=0.
     return envelope
 
 
-def generate_track(commands, bpm, sample_rate):
-    """根据指令生成单个轨道的音频"""
-    if not commands:
-        return np.array([])
+_note_cache_scope = contextvars.ContextVar('note_cache_scope', default=None)  # 当前渲染的 (命中统计, 外层统计)
+
+
+class NoteRenderCache:
+    """进程内共享的LRU音符缓存，按总字节数限制容量，缓存渲染好的音符和包络数组
+
+    hits/misses是整个进程的累计值；评估单次渲染的缓存效果时用measure()统计该次渲染自己的命中情况。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_render(self, key, render):
+        """命中则直接返回缓存数组，否则调用render生成并放入缓存"""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._count('hits')
+                return value
+            self.misses += 1
+            self._count('misses')
+
+        value = render()
+        # 缓存中的数组会被多个请求共享，设为只读防止被意外修改
+        value.setflags(write=False)
+        if value.nbytes > self.max_bytes:
+            return value
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = value
+                self._bytes += value.nbytes
+                while self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= evicted.nbytes
+                    self.evictions += 1
+        return value
+
+    def _count(self, name):
+        # 调用方需持有self._lock；嵌套的统计范围都要计入
+        scope = _note_cache_scope.get()
+        while scope is not None:
+            stats, scope = scope
+            stats[name] += 1
+
+    @contextmanager
+    def measure(self, stats=None):
+        """统计with块内本次渲染的命中/未命中次数，返回统计字典；stats为已有的统计字典时在其上累加
+
+        统计范围随contextvars传递，并发的其他请求不会计入；提交到渲染线程池的任务需在复制的上下文中运行。
+        """
+        if stats is None:
+            stats = {'hits': 0, 'misses': 0}
+        token = _note_cache_scope.set((stats, _note_cache_scope.get()))
+        try:
+            yield stats
+        finally:
+            _note_cache_scope.reset(token)
+
+    def measure_blocks(self, blocks, stats):
+        """逐块迭代流式渲染的blocks，把合成每一块时的命中情况累加到stats中，全部产出后输出一行统计"""
+        iterator = iter(blocks)
+        while True:
+            with self.measure(stats):
+                block = next(iterator, None)
+            if block is None:
+                break
+            yield block
+        print(f"音符缓存统计: {format_note_cache_stats(stats)}")
+
+    def stats(self):
+        """返回进程累计的命中/未命中/淘汰计数，用于评估缓存容量"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+
+note_cache = NoteRenderCache(NOTE_CACHE_MAX_BYTES)
+
+
+def format_note_cache_stats(stats):
+    """单次渲染的音符缓存统计的文本形式，用于日志和X-Note-Cache响应头"""
+    return f"hits={stats['hits']}; misses={stats['misses']}"
+
+# 各波形使用的ADSR包络参数 (attack, decay, sustain, release)
+NOTE_ENVELOPES = {
+    'square': (0.005, 0.01, 0.8, 0.02),  # 旋律音符
+    'triangle': (0.005, 0.01, 0.8, 0.02),
+    'noise': (0.001, 0.001, 0.7, 0.01),  # 噪音使用较短的包络
+}
+
+
+def get_note_envelope(wave_type, num_samples, duration, sample_rate):
+    """获取某种波形、某个长度的音符所用的ADSR包络（缓存在音符缓存中）"""
+    adsr = NOTE_ENVELOPES.get(wave_type)
+    if adsr is None:
+        return None
+
+    def render_envelope():
+        attack, decay, sustain, release = adsr
+        return generate_envelope(duration, sample_rate, attack=attack, decay=decay, sustain=sustain, release=release)
+
+    return note_cache.get_or_render(('envelope', num_samples, sample_rate, adsr), render_envelope)
+
+
+def render_note(note, beat_duration, sample_rate, gain=1.0):
+    """渲染单个音符（编译后乐谱中的一条记录），结果按音符参数缓存"""
+    duration = float(note['duration']) * beat_duration
+    num_samples = int(sample_rate * duration)
+    
+    freq = float(note['freq'])
+    wave_type = WAVE_TYPES[note['wave']]
+    pulse_width = float(note['pulse_width'])
+    volume = float(note['volume']) * gain
+    noise_mode = NOISE_MODES[note['noise_mode']]
+    effects = note_effects(note)
+
+    def render_wave():
+        envelope = get_note_envelope(wave_type, num_samples, duration, sample_rate)
+        return generate_wave(
+            freq, duration, sample_rate,
+            wave_type=wave_type,
+            pulse_width=pulse_width,
+            volume=volume,
+            envelope=envelope,
+            noise_mode=noise_mode,
+            effects=effects
+        )
+
+    key = ('note', freq, num_samples, sample_rate, wave_type, pulse_width, volume, noise_mode,
+           tuple(sorted(effects.items())) if effects else None)
+    return note_cache.get_or_render(key, render_wave)
+
+
+def note_effects(note):
+    """取出音符记录中的效果参数，没有任何效果时返回None"""
+    if WAVE_TYPES[note['wave']] == 'noise' or not has_effects(note):
+        return None
+    return {
+        'arp': int(note['arp']),
+        'vib_rate': float(note['vib_rate']),
+        'vib_depth': float(note['vib_depth']),
+        'sweep': float(note['sweep']),
+        'pw_end': float(note['pw_end']),
+    }
+
+
+def has_effects(notes):
+    """判断音符（或一组音符，返回布尔数组）是否带有效果参数"""
+    return ((notes['arp'] != 0) | (notes['vib_depth'] != 0) | (notes['sweep'] != 0) | (notes['pw_end'] >= 0)) \
+        & (notes['wave'] != WAVE_TYPES.index('noise'))
+
+
+def note_spans(notes, beat_duration, sample_rate):
+    """向量化计算一组音符在轨道中的起始样本和样本数"""
+    starts = (notes['time'] * beat_duration * sample_rate).astype(np.int64)
+    lengths = (sample_rate * (notes['duration'] * beat_duration)).astype(np.int64)
+    return starts, np.maximum(lengths, 0)
+
+
+def compute_song_length(notes, bpm, sample_rate):
+    """根据编译后的音符预先计算整首歌的样本数"""
+    if len(notes) == 0:
+        return 0
+    starts, lengths = note_spans(notes, 60.0 / bpm, sample_rate)
+    return max(0, int((starts + lengths).max()))
+
+
+def scatter_add(bus, starts, waves, rows):
+    """把waves[rows[i]]累加到bus中starts[i]开始的位置
+
+    花式索引的scatter-add每个样本都要经过索引数组，音符较长时反而比逐个音符的
+    连续切片累加慢得多，因此只有短音符才整体scatter-add。
+    """
+    num_samples = waves.shape[1]
+    if num_samples > SCATTER_MAX_NOTE_SAMPLES:
+        for start_idx, row in zip(starts.tolist(), rows.tolist()):
+            bus[start_idx:start_idx + num_samples] += waves[row]
+        return
+    
+    index = starts[:, None] + np.arange(num_samples)
+    if np.all(np.diff(np.sort(starts)) >= num_samples):
+        # 音符互不重叠时可以直接用花式索引累加
+        bus[index] += waves[rows]
+    else:
+        # 有重叠的音符需要用ufunc.at保证重复位置都被累加
+        np.add.at(bus, index, waves[rows])
+
+
+def render_note_group(notes, starts, num_samples, beat_duration, sample_rate, bus, gain=1.0):
+    """批量渲染一组波形类型和样本数都相同的音符，并按起始位置scatter-add到总线"""
+    wave_type = WAVE_TYPES[notes['wave'][0]]
+    # 同组音符样本数相同，包络只需按第一个音符的时长生成一次
+    duration = float(notes['duration'][0]) * beat_duration
+    envelope = get_note_envelope(wave_type, num_samples, duration, sample_rate)
+    
+    # 参数完全相同的音符只渲染一次，之后按inverse展开
+    params = np.stack([notes['freq'], notes['pulse_width'], notes['volume'], notes['noise_mode']], axis=1)
+    unique_params, inverse = np.unique(params, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+    
+    # 分批渲染不同的音符，限制单次渲染的二维数组大小
+    batch = max(1, BATCH_MAX_SAMPLES // num_samples)
+    for offset in range(0, len(unique_params), batch):
+        freqs, pulse_widths, volumes, noise_modes = unique_params[offset:offset + batch].T
+        if wave_type == 'noise':
+            waves = np.stack([
+                generate_noise_lfsr(num_samples, pulse_width, mode=NOISE_MODES[int(noise_mode)])
+                for pulse_width, noise_mode in zip(pulse_widths.tolist(), noise_modes.tolist())
+            ])
+        else:
+            waves = oscillator_bank.render_batch(freqs, num_samples, sample_rate, wave_type, pulse_widths)
+        shape_note_waves(waves, (volumes * gain).astype(np.float32)[:, None], envelope)
+        
+        # 把本批对应的所有音符scatter-add到总线
+        members = np.flatnonzero((inverse >= offset) & (inverse < offset + len(waves)))
+        scatter_add(bus, starts[members], waves, inverse[members] - offset)
+
+
+def generate_track(notes, bpm, sample_rate, bus=None, gain=1.0):
+    """根据音符记录生成单个轨道的音频，原地累加到float32混音总线bus上
+
+    音符按 (波形类型, 样本数) 分组，每组一次性渲染成二维数组再scatter-add到总线，
+    Python层的迭代次数只与不同音符形状的数量有关，而与音符总数无关。
+    """
+    if bus is None:
+        bus = np.zeros(compute_song_length(notes, bpm, sample_rate), dtype=np.float32)
+    if len(notes) == 0:
+        return bus
         
     # 计算每拍的秒数
     beat_duration = 60.0 / bpm
+    starts, lengths = note_spans(notes, beat_duration, sample_rate)
     
-    # 找到最长的时间点以确定总时长
-    max_time = max(cmd['time'] + cmd['duration'] for cmd in commands)
-    total_duration = max_time * beat_duration
+    # 超出总线范围的音符截掉尾部（正常情况下总线长度已按乐谱预先算好）
+    lengths = np.minimum(lengths, len(bus) - starts)
     
-    # 创建空的音频数组
-    track = np.zeros(int(sample_rate * total_duration), dtype=np.float32)  # 使用float32以提高混合质量
+    # 带效果的音符频率逐样本变化，无法与其他音符共用批量渲染，逐个渲染（按参数缓存）后累加
+    modulated = has_effects(notes)
+    for index in np.flatnonzero(modulated).tolist():
+        wave = render_note(notes[index], beat_duration, sample_rate, gain)
+        start_idx, length = int(starts[index]), int(lengths[index])
+        if length > 0:
+            bus[start_idx:start_idx + length] += wave[:length]
+    if modulated.any():
+        notes, starts, lengths = notes[~modulated], starts[~modulated], lengths[~modulated]
     
-    # 为每个音符生成波形并添加到轨道
-    for cmd in commands:
-        start_time = cmd['time'] * beat_duration
-        duration = cmd['duration'] * beat_duration
-        
-        # 计算频率（噪音不需要频率）
-        freq = note_to_frequency(cmd['note']) if cmd['wave_type'] != 'noise' else 0
-        
-        # 为不同类型的波形生成不同的包络
-        envelope = None
-        if cmd['wave_type'] == 'square' or cmd['wave_type'] == 'triangle':
-            # 为旋律音符生成ADSR包络
-            envelope = generate_envelope(duration, sample_rate, attack=0.005, decay=0.01, sustain=0.8, release=0.02)
-        elif cmd['wave_type'] == 'noise':
-            # 为噪音生成较短的包络
-            envelope = generate_envelope(duration, sample_rate, attack=0.001, decay=0.001, sustain=0.7, release=0.01)
-        
-        # 生成波形
-        wave = generate_wave(
-            freq, duration, sample_rate,
-            wave_type=cmd['wave_type'],
-            pulse_width=cmd['pulse_width'],
-            volume=cmd['volume'],
-            envelope=envelope
-        )
-        
-        # 计算波形在轨道中的位置
-        start_idx = int(start_time * sample_rate)
-        end_idx = start_idx + len(wave)
-        
-        # 确保不超出轨道范围
-        if end_idx > len(track):
-            # 扩展轨道
-            track = np.append(track, np.zeros(end_idx - len(track), dtype=np.float32))
-        
-        # 将波形添加到轨道
-        track[start_idx:end_idx] += wave.astype(np.float32)
+    # 按 (样本数, 波形类型) 分组
+    group_keys = lengths * len(WAVE_TYPES) + notes['wave']
+    unique_keys, group_ids = np.unique(group_keys, return_inverse=True)
+    for group_id, key in enumerate(unique_keys.tolist()):
+        num_samples = key // len(WAVE_TYPES)
+        if num_samples <= 0:
+            continue
+        members = np.flatnonzero(group_ids == group_id)
+        render_note_group(notes[members], starts[members], num_samples, beat_duration, sample_rate, bus, gain)
     
-    # 防止溢出并转换为16位
-    track = np.clip(track, -(2**(BIT_DEPTH-1)), 2**(BIT_DEPTH-1)-1)
-    return track.astype(np.int16)
+    return bus
+
+
+def comb_filter(signal, delay_samples, feedback):
+    """反馈梳状滤波器 y[n] = x[n] + feedback * y[n - delay]（原地计算）
+
+    以delay_samples为块长分块递推：每个块只依赖上一个已经算完的块，
+    因此块内可以整体向量化，Python层的迭代次数只有 len / delay_samples。
+    """
+    for start in range(delay_samples, len(signal), delay_samples):
+        end = min(start + delay_samples, len(signal))
+        signal[start:end] += signal[start - delay_samples:end - delay_samples] * feedback
+    return signal
+
+
+def allpass_filter(signal, delay_samples, gain):
+    """Schroeder全通滤波器 y[n] = -g * x[n] + x[n - delay] + g * y[n - delay]"""
+    output = signal * -gain
+    for start in range(delay_samples, len(signal), delay_samples):
+        end = min(start + delay_samples, len(signal))
+        output[start:end] += signal[start - delay_samples:end - delay_samples]
+        output[start:end] += output[start - delay_samples:end - delay_samples] * gain
+    return output
 
 
-def apply_reverb(signal, sample_rate, reverb_time=0.1, decay=0.5):
-    """应用简单混响效果"""
+# Schroeder混响的默认房间参数（时间单位为秒）
+SCHROEDER_ROOM = {
+    'comb_delays': (0.0297, 0.0371, 0.0411, 0.0437),  # 并联梳状滤波器的延迟
+    'comb_feedback': 0.7,  # 梳状滤波器反馈系数，越大混响越长
+    'allpass_delays': (0.005, 0.0017),  # 串联全通滤波器的延迟
+    'allpass_gain': 0.7,  # 全通滤波器增益，控制扩散程度
+    'wet': 0.25,  # 混响信号的混合比例
+}
+
+
+def apply_schroeder_reverb(signal_float, sample_rate, room=None):
+    """Schroeder混响：多路并联梳状滤波器 + 串联全通滤波器"""
+    room = {**SCHROEDER_ROOM, **(room or {})}
+
+    # 并联梳状滤波器，多个互质的延迟叠加出更密集的回声
+    wet = np.zeros_like(signal_float)
+    for delay in room['comb_delays']:
+        delay_samples = int(sample_rate * delay)
+        if delay_samples > 0:
+            wet += comb_filter(signal_float.copy(), delay_samples, room['comb_feedback'])
+    wet /= max(1, len(room['comb_delays']))
+
+    # 串联全通滤波器，增加回声密度而不改变频响
+    for delay in room['allpass_delays']:
+        delay_samples = int(sample_rate * delay)
+        if delay_samples > 0:
+            wet = allpass_filter(wet, delay_samples, room['allpass_gain'])
+
+    return signal_float * (1.0 - room['wet']) + wet * room['wet']
+
+
+def apply_reverb(signal, sample_rate, reverb_time=0.1, decay=0.5, mode='comb', room=None):
+    """对float32归一化信号应用混响效果，mode为'comb'时使用单梳状滤波器（原地计算），
+    为'schroeder'时使用Schroeder混响"""
     if len(signal) == 0:
         return signal
-    
+
     # 计算混响延迟样本数
     delay_samples = int(sample_rate * reverb_time)
+
+    # 应用延迟和衰减
+    if mode == 'schroeder':
+        return apply_schroeder_reverb(signal, sample_rate, room)
     if delay_samples == 0:
         return signal
+    return comb_filter(signal, delay_samples, decay)
+
+
+def quantize_to_pcm(signal):
+    """混音总线的唯一限幅/量化阶段：float32归一化样本转换为16位PCM"""
+    signal = np.clip(signal, -1.0, 1.0, out=signal)
+    signal *= 2**(BIT_DEPTH-1) - 1
+    return signal.astype(np.int16)
+
+
+_render_pools = {}
+_render_pools_lock = threading.Lock()
+
+
+def get_render_pool(workers):
+    """获取（按需创建）进程内共享的轨道渲染线程池
+
+    只使用线程：服务进程是多线程的，fork出的工作进程可能继承其他线程持有的锁而死锁，
+    spawn出的工作进程又会重新导入启动服务的main.py，重复执行其中创建客户端、启动清理线程等初始化。
+    轨道合成的主要开销在大块NumPy运算上，这些运算会释放GIL，线程可以并行执行。
+    """
+    with _render_pools_lock:
+        pool = _render_pools.get(workers)
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chiptune-render")
+            _render_pools[workers] = pool
+        return pool
+
+
+def parallel_render_workers(score, workers=None):
+    """乐谱适合并行渲染时返回使用的线程数，否则返回0
+
+    workers默认取RENDER_WORKERS；单轨道乐谱和音符数少于PARALLEL_MIN_NOTES的短乐谱串行渲染，因为此时池的开销大于收益。
+    """
+    workers = RENDER_WORKERS if workers is None else workers
+    if workers > 1 and len(score.channels) > 1 and len(score) >= PARALLEL_MIN_NOTES:
+        return min(workers, len(score.channels))
+    return 0
+
+
+def render_channels_parallel(score, bpm, sample_rate, bus, gain, workers):
+    """把各轨道分发到线程池并行渲染，再累加到混音总线"""
+    length = len(bus)
+    pool = get_render_pool(workers)
+    # 各轨道渲染到自己的缓冲区，按乐谱中的轨道顺序累加，结果与串行渲染一致
+    # 在复制的上下文中运行，使各轨道的音符缓存命中计入本次渲染的统计（见NoteRenderCache.measure）
+    futures = [pool.submit(contextvars.copy_context().run, generate_track, notes, bpm, sample_rate, None, gain)
+               for _, notes in score.tracks()]
+    for future in futures:
+        track = future.result()
+        bus[:len(track)] += track[:length]
+    return bus
+
+
+def mix_tracks(score, bpm, sample_rate, reverb_mode='comb', reverb_room=None, workers=None):
+    """将编译后乐谱的所有轨道渲染到同一条预分配的float32混音总线上，并应用混响"""
+    bus = render_dry_bus(score, bpm, sample_rate, workers=workers)
     
-    # 创建混响缓冲区
-    signal_float = signal.astype(np.float32) / (2**(BIT_DEPTH-1))  # 归一化到-1到1
-    reverbed = signal_float.copy()
-    
-    # 应用延迟和衰减
-    for i in range(delay_samples, len(signal_float)):
-        reverbed[i] += reverbed[i - delay_samples] * decay
+    # 应用轻微的混响效果
+    return apply_reverb(bus, sample_rate, reverb_time=MIX_REVERB_TIME, decay=MIX_REVERB_DECAY,
+                        mode=reverb_mode, room=reverb_room)
+
+
+def render_stems(score, bpm, sample_rate, reverb_mode='comb', reverb_room=None):
+    """一次合成同时得到各轨道分轨和总混音，返回 [(名称, float32音频)]，最后一项为master
+
+    每个轨道渲染到各自等长的总线上，总混音由各轨道干声相加后经过混响得到（与mix_tracks一致）。
+    混响是线性的，各分轨经过同样的混响后相加即等于总混音，在引擎中重新混合时不会改变音色。
+    """
+    length = compute_song_length(score.notes, bpm, sample_rate)
+    master = np.zeros(length, dtype=np.float32)
+    stems = []
+    for name, notes in score.tracks():
+        bus = generate_track(notes, bpm, sample_rate, bus=np.zeros(length, dtype=np.float32), gain=MIX_GAIN)
+        master += bus
+        stems.append((name, bus))
+    stems.append(('master', master))
     
-    # 限制范围并转换回int16
-    reverbed = np.clip(reverbed, -1.0, 1.0)
-    return (reverbed * (2**(BIT_DEPTH-1))).astype(np.int16)
+    return [(name, apply_reverb(bus, sample_rate, reverb_time=MIX_REVERB_TIME, decay=MIX_REVERB_DECAY,
+                                mode=reverb_mode, room=reverb_room))
+            for name, bus in stems]
 
 
-def mix_tracks(tracks, sample_rate):
-    """混合多个轨道的音频"""
-    if not tracks:
-        return np.array([])
+def render_dry_bus(score, bpm, sample_rate, workers=None):
+    """将编译后乐谱的所有轨道渲染到同一条预分配的float32混音总线上（不含混响）
+
+    workers大于1且乐谱足够大时（见parallel_render_workers）把各轨道分发到线程池并行渲染。
+    """
+    if not score:
+        return np.array([], dtype=np.float32)
         
-    # 找到最长的轨道以确定总时长
-    max_length = max(len(track) for track in tracks.values())
+    # 根据乐谱一次性确定总时长并分配混音总线
+    bus = np.zeros(compute_song_length(score.notes, bpm, sample_rate), dtype=np.float32)
+    
+    workers = parallel_render_workers(score, workers)
+    if workers:
+        render_channels_parallel(score, bpm, sample_rate, bus, MIX_GAIN, workers)
+    else:
+        # 各轨道直接累加到总线，使用缩放因子避免溢出
+        for _, notes in score.tracks():
+            generate_track(notes, bpm, sample_rate, bus=bus, gain=MIX_GAIN)
+    
+    return bus
+
+
+def reverb_tail_samples(sample_rate, reverb_mode='comb', reverb_room=None):
+    """估算混音总线混响的尾音长度（样本数）：输入停止后输出衰减到REVERB_TAIL_THRESHOLD以下所需的时间"""
+    def decay_length(delay, gain):
+        if delay <= 0:
+            return 0
+        if not 0 < abs(gain) < 1:
+            return delay
+        return delay * math.ceil(math.log(REVERB_TAIL_THRESHOLD) / math.log(abs(gain)))
+    
+    if reverb_mode == 'schroeder':
+        room = {**SCHROEDER_ROOM, **(reverb_room or {})}
+        comb_tail = max((decay_length(int(sample_rate * delay), room['comb_feedback'])
+                         for delay in room['comb_delays']), default=0)
+        allpass_tail = sum(decay_length(int(sample_rate * delay), room['allpass_gain'])
+                           for delay in room['allpass_delays'])
+        return comb_tail + allpass_tail
+    return decay_length(int(sample_rate * MIX_REVERB_TIME), MIX_REVERB_DECAY)
+
+
+def loop_layout(score, bpm, sample_rate, loop_count=2, duration=None, reverb_mode='comb', reverb_room=None):
+    """计算循环模式的布局（样本数），不做任何合成
+
+    循环区间取乐谱中的LOOP标记，没有标记时取整首歌（结束位置向上取整到整小节）。
+    输出由前奏和若干遍循环体组成：前几遍（warmup_passes）需要真实合成，使上一遍延续过来的
+    音符尾部和混响尾音达到稳定；之后的每一遍都与最后一遍合成结果完全相同，直接平铺。
+    loop_start/loop_end指向第一段稳态循环体，引擎从loop_end跳回loop_start即可无缝循环。
+    """
+    beat_duration = 60.0 / bpm
+    loop_start_beat, loop_end_beat = score.loop or (0.0, None)
+    if loop_end_beat is None:
+        song_end = float((score.notes['time'] + score.notes['duration']).max()) if score else 0.0
+        loop_end_beat = max(loop_start_beat + BEATS_PER_BAR,
+                            math.ceil(song_end / BEATS_PER_BAR - 1e-9) * BEATS_PER_BAR)
+    
+    intro_length = int(loop_start_beat * beat_duration * sample_rate)
+    loop_length = int(loop_end_beat * beat_duration * sample_rate) - intro_length
+    if loop_length <= 0:
+        raise ValueError("循环区间为空")
+    
+    times = score.notes['time']
+    intro = score.select(times < loop_start_beat)
+    body = score.select((times >= loop_start_beat) & (times < loop_end_beat), -loop_start_beat)
+    
+    # 超出一遍循环体的部分（前奏和循环体的音符尾部、混响尾音）都要在真实合成的几遍内衰减完
+    spill = max(compute_song_length(intro.notes, bpm, sample_rate) - intro_length,
+                compute_song_length(body.notes, bpm, sample_rate) - loop_length, 0)
+    tail = spill + reverb_tail_samples(sample_rate, reverb_mode, reverb_room)
+    warmup_passes = 1 + math.ceil(tail / loop_length)
+    
+    total_samples = None
+    if duration is not None:
+        total_samples = int(duration * sample_rate)
+        loop_count = max(1, math.ceil((total_samples - intro_length) / loop_length))
+    loop_count = max(1, int(loop_count))
+    if total_samples is None:
+        total_samples = intro_length + loop_count * loop_length
+    
+    rendered_passes = min(loop_count, warmup_passes)
+    loop_start = intro_length + (rendered_passes - 1) * loop_length
+    return {
+        'intro': intro,
+        'body': body,
+        'intro_length': intro_length,
+        'loop_length': loop_length,
+        'loop_count': loop_count,
+        'rendered_passes': rendered_passes,
+        'loop_start': loop_start,
+        'loop_end': loop_start + loop_length,
+        'total_samples': total_samples,
+        # 重复次数不足以让尾音稳定时，循环点处仍会有残留的差异
+        'seamless': rendered_passes == warmup_passes,
+    }
+
+
+def loop_metadata(layout, sample_rate):
+    """循环点信息（样本偏移），供游戏引擎使用"""
+    return {
+        'sample_rate': sample_rate,
+        'total_samples': layout['total_samples'],
+        'intro_length': layout['intro_length'],
+        'loop_start': layout['loop_start'],
+        'loop_end': layout['loop_end'],
+        'loop_length': layout['loop_length'],
+        'loop_count': layout['loop_count'],
+        'seamless': layout['seamless'],
+    }
+
+
+def render_loop(layout, bpm, sample_rate, reverb_mode='comb', reverb_room=None, workers=None):
+    """按loop_layout的布局合成循环音乐，返回float32音频
+
+    循环体只合成一遍（不含混响的干声），前奏和前几遍循环体按样本偏移叠加到时间线上后统一
+    经过混响，因此循环体末尾的音符尾部和混响尾音会自然延续到下一遍的开头；其余各遍直接平铺。
+    """
+    intro_dry = render_dry_bus(layout['intro'], bpm, sample_rate, workers=workers)
+    body_dry = render_dry_bus(layout['body'], bpm, sample_rate, workers=workers)
+    
+    intro_length = layout['intro_length']
+    loop_length = layout['loop_length']
+    rendered_passes = layout['rendered_passes']
+    timeline_length = intro_length + rendered_passes * loop_length
     
-    # 使用浮点数进行混合以提高质量
-    mixed = np.zeros(max_length, dtype=np.float32)
+    timeline = np.zeros(timeline_length, dtype=np.float32)
+    timeline[:min(len(intro_dry), timeline_length)] += intro_dry[:timeline_length]
+    for loop_pass in range(rendered_passes):
+        offset = intro_length + loop_pass * loop_length
+        segment = body_dry[:timeline_length - offset]
+        timeline[offset:offset + len(segment)] += segment
     
-    # 混合所有轨道
-    for track in tracks.values():
-        # 将轨道转换为浮点数
-        track_float = track.astype(np.float32)
+    wet = apply_reverb(timeline, sample_rate, reverb_time=MIX_REVERB_TIME, decay=MIX_REVERB_DECAY,
+                       mode=reverb_mode, room=reverb_room)
+    
+    # 最后一遍已经是稳态，其余各遍直接平铺
+    total_samples = layout['total_samples']
+    repeats = math.ceil(max(total_samples - timeline_length, 0) / loop_length)
+    if repeats:
+        wet = np.concatenate((wet, np.tile(wet[-loop_length:], repeats)))
+    if len(wet) > total_samples:
+        # 按时长截断在循环体中间时淡出，避免结尾的爆音
+        wet = wet[:total_samples].copy()
+        fade = min(100, total_samples)
+        wet[total_samples - fade:] *= np.linspace(1, 0, fade, dtype=np.float32)
+    return wet
+
+
+class StreamingReverb:
+    """跨块保存延迟线状态的混响，逐块处理的结果与整段调用apply_reverb一致"""
+
+    def __init__(self, sample_rate, reverb_time=0.1, decay=0.5, mode='comb', room=None):
+        self.mode = mode
+        if mode == 'schroeder':
+            self.room = {**SCHROEDER_ROOM, **(room or {})}
+            comb_delays = [int(sample_rate * delay) for delay in self.room['comb_delays']]
+            allpass_delays = [int(sample_rate * delay) for delay in self.room['allpass_delays']]
+            self.comb_feedback = self.room['comb_feedback']
+            self.comb_count = max(1, len(comb_delays))
+        else:
+            comb_delays = [int(sample_rate * reverb_time)]
+            allpass_delays = []
+            self.comb_feedback = decay
+
+        # 每条延迟线只需保留最近delay个样本的历史
+        self.combs = [[delay, np.zeros(delay, dtype=np.float32)] for delay in comb_delays if delay > 0]
+        self.allpasses = [[delay, np.zeros(delay, dtype=np.float32), np.zeros(delay, dtype=np.float32)]
+                          for delay in allpass_delays if delay > 0]
+
+    def _comb(self, state, block):
+        delay, history = state
+        # 把上一块输出的尾部拼在前面，comb_filter只会改写拼接位置之后的样本
+        extended = np.concatenate((history, block))
+        comb_filter(extended, delay, self.comb_feedback)
+        state[1] = extended[-delay:].copy()
+        return extended[delay:]
+
+    def _allpass(self, state, block):
+        delay, input_history, output_history = state
+        gain = self.room['allpass_gain']
+        extended_input = np.concatenate((input_history, block))
+        extended_output = np.concatenate((output_history, block * -gain))
+        for start in range(delay, len(extended_input), delay):
+            end = min(start + delay, len(extended_input))
+            extended_output[start:end] += extended_input[start - delay:end - delay]
+            extended_output[start:end] += extended_output[start - delay:end - delay] * gain
+        state[1] = extended_input[-delay:].copy()
+        state[2] = extended_output[-delay:].copy()
+        return extended_output[delay:]
+
+    def process(self, block):
+        """处理一个float32块，返回混响后的块"""
+        if len(block) == 0:
+            return block
+        if self.mode != 'schroeder':
+            return self._comb(self.combs[0], block) if self.combs else block
+
+        wet = np.zeros_like(block)
+        for state in self.combs:
+            wet += self._comb(state, block)
+        wet /= self.comb_count
+        for state in self.allpasses:
+            wet = self._allpass(state, wet)
+        return block * (1.0 - self.room['wet']) + wet * self.room['wet']
+
+
+def render_blocks(score, bpm, sample_rate, block_size=None, reverb_mode='comb', reverb_room=None):
+    """按块流式合成整首歌，逐块产出混音并经过混响的float32音频
+
+    音符按起始时间排序后依次进入当前块，跨越块边界的音符保留到下一块继续累加，
+    因此音频缓冲区的峰值内存只与块大小（和最长的单个音符）有关，与歌曲长度无关。
+    """
+    return render_incremental_blocks([(score.notes, None)], bpm, sample_rate, block_size=block_size,
+                                     reverb_mode=reverb_mode, reverb_room=reverb_room)
+
+
+def render_incremental_blocks(note_batches, bpm, sample_rate, block_size=None, reverb_mode='comb', reverb_room=None,
+                              stats=None):
+    """边接收音符边按块合成，逐块产出混音并经过混响的float32音频
+
+    note_batches逐次产出 (音符记录数组, 水位线)：水位线（拍）表示之后到达的音符起始时间
+    都不早于它，水位线之前的块已经不会再变化，可以立即合成输出；水位线为None表示不会再有音符。
+    起始时间早于已输出部分的音符（数量记在stats['late_notes']中）说明水位线不可靠：此后不再输出，
+    等全部音符到达后从头完整合成，只输出尚未输出的部分，使其后的音频与完整渲染一致。
+    """
+    if stats is None:
+        stats = {}
+    stats['late_notes'] = 0
+    beat_duration = 60.0 / bpm
+    if block_size is None:
+        block_size = int(STREAM_BLOCK_BEATS * beat_duration * sample_rate)
+    block_size = max(1, block_size)
+    reverb = StreamingReverb(sample_rate, reverb_time=MIX_REVERB_TIME, decay=MIX_REVERB_DECAY,
+                             mode=reverb_mode, room=reverb_room)
+    
+    all_notes = []  # 到达的全部音符 (起始样本, 到达顺序, 音符)，出现晚到的音符时用于从头合成
+    pending_notes = []  # 尚未开始的音符，按 (起始样本, 到达顺序) 排列的小根堆
+    arrival = itertools.count()
+    active_notes = []  # 已开始但尚未结束的音符 (起始样本, 波形)
+    song_length = 0
+    block_start = 0
+    
+    def render_block(block_end):
+        nonlocal active_notes
+        block = np.zeros(block_end - block_start, dtype=np.float32)
         
-        # 如果轨道较短，补零
-        if len(track_float) < max_length:
-            track_float = np.append(track_float, np.zeros(max_length - len(track_float), dtype=np.float32))
+        # 渲染在本块内开始的音符
+        while pending_notes and pending_notes[0][0] < block_end:
+            start_idx, _, note = heapq.heappop(pending_notes)
+            active_notes.append((start_idx, render_note(note, beat_duration, sample_rate, MIX_GAIN)))
         
-        # 添加到混合轨道，使用缩放因子避免溢出
-        mixed += track_float * 0.7  # 缩放因子，避免混合后溢出
+        # 累加每个音符落在本块内的部分，未结束的音符留到下一块
+        carried_notes = []
+        for start_idx, wave in active_notes:
+            note_end = start_idx + len(wave)
+            lo = max(start_idx, block_start)
+            hi = min(note_end, block_end)
+            if hi > lo:
+                block[lo - block_start:hi - block_start] += wave[lo - start_idx:hi - start_idx]
+            if note_end > block_end:
+                carried_notes.append((start_idx, wave))
+        active_notes = carried_notes
+        
+        return reverb.process(block)
     
-    # 防止溢出并转换为int16
-    mixed = np.clip(mixed, -(2**(BIT_DEPTH-1)), 2**(BIT_DEPTH-1)-1)
+    for notes, watermark in note_batches:
+        if len(notes):
+            starts, lengths = note_spans(notes, beat_duration, sample_rate)
+            song_length = max(song_length, int((starts + lengths).max()))
+            stats['late_notes'] += int(np.count_nonzero(starts < block_start))
+            for index, start_idx in enumerate(starts.tolist()):
+                entry = (start_idx, next(arrival), notes[index])
+                all_notes.append(entry)
+                heapq.heappush(pending_notes, entry)
+        if watermark is None or stats['late_notes']:
+            # 最后一批，或已经出现晚到的音符：不再输出，继续读取note_batches直到其结束，
+            # 使其中生成结束后的处理得以执行
+            continue
+        
+        # 水位线之前的完整块已经确定，立即输出
+        ready_end = int(watermark * beat_duration * sample_rate)
+        while block_start + block_size <= min(ready_end, song_length):
+            yield render_block(block_start + block_size)
+            block_start += block_size
     
-    # 应用轻微的混响效果
-    mixed_int16 = mixed.astype(np.int16)
-    mixed_with_reverb = apply_reverb(mixed_int16, sample_rate, reverb_time=0.02, decay=0.1)
+    sent_end = 0
+    if stats['late_notes']:
+        print(f"{stats['late_notes']}个音符到达过晚，从头完整合成，只输出第{block_start}个样本之后的部分")
+        # 已输出的都是完整的块，从头合成时按同样的块边界跳过这些块
+        sent_end = block_start
+        reverb = StreamingReverb(sample_rate, reverb_time=MIX_REVERB_TIME, decay=MIX_REVERB_DECAY,
+                                 mode=reverb_mode, room=reverb_room)
+        pending_notes = sorted(all_notes)
+        active_notes = []
+        block_start = 0
     
-    return mixed_with_reverb
+    while block_start < song_length:
+        block_end = min(block_start + block_size, song_length)
+        block = render_block(block_end)
+        if block_start >= sent_end:
+            yield block
+        block_start = block_end
 
 
-def convert_to_mp3(audio_data, sample_rate, output_file):
-    """将音频数据转换为MP3"""
-    # 将numpy数组转换为AudioSegment
-    # 注意：pydub需要16位小端字节序的PCM数据
-    audio_data = audio_data.astype(np.int16)
-    bytes_data = audio_data.tobytes()
-    
-    audio_segment = AudioSegment(
-        bytes_data,
-        frame_rate=sample_rate,
-        sample_width=2,  # 16位
-        channels=1  # 单声道
+def resolve_output_profile(profile=None, output_format=None, sample_rate=None, stems=False):
+    """根据输出档位和显式参数确定 (输出格式, 采样率)，参数不合法时抛出ValueError
+
+    stems为True且没有显式指定格式时，档位格式不适合分轨的改用ogg。
+    """
+    profile = profile or 'final'
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(f"不支持的输出档位: {profile}")
+    default_format = OUTPUT_PROFILES[profile]['format']
+    if stems and default_format not in STEM_FORMATS:
+        default_format = 'ogg'
+    output_format = (output_format or default_format).lower()
+    sample_rate = sample_rate or OUTPUT_PROFILES[profile]['sample_rate']
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"不支持的输出格式: {output_format}")
+    if sample_rate not in SUPPORTED_SAMPLE_RATES:
+        raise ValueError(f"不支持的采样率: {sample_rate}")
+    return output_format, sample_rate
+
+
+def resolve_stems_options(request, output_format):
+    """检查分轨模式参数，返回是否导出分轨，参数不合法时抛出ValueError"""
+    if not request.stems:
+        return False
+    if request.loop:
+        raise ValueError("分轨导出不支持循环模式")
+    if output_format not in STEM_FORMATS:
+        raise ValueError(f"分轨导出只支持以下格式: {', '.join(STEM_FORMATS)}")
+    return True
+
+
+def resolve_loop_options(request):
+    """从请求中取出循环模式参数，返回 (重复次数, 总时长) 或None，参数不合法时抛出ValueError"""
+    if not request.loop:
+        return None
+    if request.loop_duration is not None:
+        if request.loop_duration <= 0:
+            raise ValueError(f"循环总时长必须为正数: {request.loop_duration}")
+        return None, request.loop_duration
+    if request.loop_count is None or request.loop_count < 1:
+        raise ValueError(f"循环次数必须至少为1: {request.loop_count}")
+    return request.loop_count, None
+
+
+def output_media_type(output_format, sample_rate):
+    """输出格式对应的HTTP媒体类型"""
+    media_type = OUTPUT_FORMATS[output_format]['media_type']
+    if output_format == 'pcm':
+        media_type += f";rate={sample_rate};channels=1"
+    return media_type
+
+
+def iter_pcm_bytes(pcm_blocks, dtype='<i2'):
+    """把PCM数组（或逐块产出的PCM数组）转换为16位字节块，默认为小端字节序（WAV和ffmpeg的s16le输入）"""
+    if isinstance(pcm_blocks, np.ndarray):
+        pcm_blocks = (pcm_blocks,)
+    for block in pcm_blocks:
+        yield memoryview(np.ascontiguousarray(block, dtype=dtype)).cast('B')
+
+
+def wav_header(num_samples, sample_rate, trailer_size=0):
+    """16位单声道WAV文件头，num_samples为None时按流式WAV的惯例把长度填为最大值
+
+    trailer_size为data块之后附加的其他块（如smpl）的总字节数。
+    """
+    data_size = num_samples * 2 if num_samples is not None else 0xFFFFFFFF - 36
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', min(36 + data_size + trailer_size, 0xFFFFFFFF), b'WAVE',
+        b'fmt ', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16,
+        b'data', data_size
+    )
+
+
+def wav_smpl_chunk(loop_start, loop_end, sample_rate):
+    """WAV的smpl块，记录一个向前循环区间，多数游戏引擎和采样器据此读取循环点"""
+    return struct.pack(
+        '<4sI9I6I',
+        b'smpl', 36 + 24,
+        0, 0, 1000000000 // sample_rate, 60, 0, 0, 0, 1, 0,
+        0, 0, loop_start, loop_end - 1, 0, 0  # 循环结束位置为闭区间
+    )
+
+
+def encode_audio_stream(pcm_blocks, sample_rate, output_format='mp3', total_samples=None,
+                        chunk_size=ENCODER_CHUNK_SIZE, loop=None):
+    """把PCM数据编码为指定格式，返回逐块产出编码数据的生成器
+
+    pcm_blocks可以是完整的PCM数组，也可以是逐块产出PCM数组的可迭代对象（流式合成）。
+    wav和pcm不经过外部编码器；流式输出wav时通过total_samples提前给出总样本数，未知时按流式WAV输出。
+    loop为循环点信息（loop_metadata），wav写入smpl块，ogg/mp3写入LOOPSTART/LOOPLENGTH标签。
+    """
+    if output_format == 'pcm':
+        return (bytes(chunk) for chunk in iter_pcm_bytes(pcm_blocks, OUTPUT_FORMATS['pcm']['dtype']))
+    if output_format == 'wav':
+        if total_samples is None and isinstance(pcm_blocks, np.ndarray):
+            total_samples = len(pcm_blocks)
+        trailer = wav_smpl_chunk(loop['loop_start'], loop['loop_end'], sample_rate) if loop else b''
+        return itertools.chain((wav_header(total_samples, sample_rate, len(trailer)),),
+                               (bytes(chunk) for chunk in iter_pcm_bytes(pcm_blocks)),
+                               (trailer,) if trailer else ())
+    metadata = {'LOOPSTART': loop['loop_start'], 'LOOPLENGTH': loop['loop_length']} if loop else None
+    return encode_ffmpeg_stream(pcm_blocks, sample_rate, output_format, chunk_size, metadata)
+
+
+def encode_ffmpeg_stream(pcm_blocks, sample_rate, output_format='mp3', chunk_size=ENCODER_CHUNK_SIZE, metadata=None):
+    """通过管道把PCM数据直接送入ffmpeg编码，返回逐块产出编码数据的生成器，metadata为写入的标签"""
+    metadata_args = [arg for name, value in (metadata or {}).items() for arg in ('-metadata', f"{name}={value}")]
+    # 复用pydub找到的ffmpeg可执行文件
+    process = subprocess.Popen(
+        [AudioSegment.converter, '-hide_banner', '-loglevel', 'error',
+         '-f', 's16le', '-ar', str(sample_rate), '-ac', '1', '-i', 'pipe:0',
+         *metadata_args, *OUTPUT_FORMATS[output_format]['ffmpeg_args'], 'pipe:1'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
     )
     
-    # 导出为MP3
-    audio_segment.export(output_file, format="mp3")
+    feed_errors = []
+    
+    def feed_pcm():
+        # 在后台线程合成并写入PCM，避免与读取编码输出互相阻塞
+        try:
+            # 注意：ffmpeg按16位小端字节序的单声道PCM读取输入
+            for pcm in iter_pcm_bytes(pcm_blocks):
+                for start in range(0, len(pcm), chunk_size):
+                    process.stdin.write(pcm[start:start + chunk_size])
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            feed_errors.append(e)
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+    
+    writer = threading.Thread(target=feed_pcm, daemon=True)
+    writer.start()
+    
+    def stop_encoder():
+        # 客户端提前断开时终止编码进程，写入线程随之因管道断开而退出
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+    
+    def read_encoded():
+        try:
+            while True:
+                chunk = process.stdout.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+            writer.join()
+            if feed_errors:
+                raise feed_errors[0]
+            if process.wait() != 0:
+                error = process.stderr.read().decode('utf-8', errors='ignore')
+                raise RuntimeError(f"{output_format.upper()}编码失败: {error.strip()}")
+        finally:
+            stop_encoder()
+    
+    encoded = read_encoded()
+    # 生成器在第一次迭代之前就被丢弃时不会执行finally，由回收时的回调终止编码进程
+    weakref.finalize(encoded, stop_encoder)
+    return encoded
+
+
+def encode_audio(audio_data, sample_rate, output_format='mp3', loop=None):
+    """将音频数据编码为指定格式（完整字节串）"""
+    return b''.join(encode_audio_stream(audio_data, sample_rate, output_format, loop=loop))
+
+
+class DiskCache:
+    """基于磁盘的字节缓存，按总字节数（LRU）和条目存活时间淘汰
+
+    每个条目存为一个文件，文件名为键的SHA-256。写入时间记在mtime上用于按存活时间淘汰，
+    最近访问时间记在atime上用于按字节数淘汰，多个服务进程可以共享同一个缓存目录。
+    """
+
+    def __init__(self, directory, max_bytes, max_age):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        """命中则返回缓存的字节串，否则返回None"""
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime > self.max_age:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            # 刷新访问时间，保留写入时间
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """写入缓存并按容量淘汰旧条目，写入失败时只打印日志"""
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # 先写临时文件再原子替换，避免其他进程读到写了一半的条目
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+            self._evict()
+        except OSError as e:
+            print(f"写入缓存失败: {str(e)}")
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+    def cache_stream(self, key, chunks):
+        """边产出数据边收集，数据完整产出后写入缓存；中途断开则不写入
+
+        key也可以是无参函数，在数据完整产出后才求值（键依赖于流式生成的内容时使用）。
+        """
+        buffered = []
+        size = 0
+        for chunk in chunks:
+            if size <= self.max_bytes:
+                buffered.append(chunk)
+                size += len(chunk)
+            yield chunk
+        if callable(key):
+            key = key()
+        if key is not None:
+            self.put(key, b''.join(buffered))
+
+    def _evict(self):
+        entries = []
+        now = time.time()
+        with self._lock:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                        if now - stat.st_mtime > self.max_age:
+                            os.remove(entry.path)
+                            self.evictions += 1
+                            continue
+                    except OSError:
+                        continue
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+            
+            total = sum(size for _, size, _ in entries)
+            # 超出容量时从最久未访问的条目开始删除
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        """返回命中/未命中/淘汰计数"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+prompt_cache = DiskCache(os.path.join(CACHE_DIR, "prompts"), PROMPT_CACHE_MAX_BYTES, PROMPT_CACHE_MAX_AGE)
+render_cache = DiskCache(os.path.join(CACHE_DIR, "renders"), RENDER_CACHE_MAX_BYTES, RENDER_CACHE_MAX_AGE)
+
+
+def normalize_prompt(prompt: str) -> str:
+    """规范化提示词：去掉首尾空白、合并连续空白并统一为小写"""
+    return ' '.join(prompt.split()).lower()
+
+
+def prompt_cache_key(prompt: str) -> str:
+    # 模型或系统提示词变化后旧的缓存自动失效
+    return '\n'.join((CHIPTUNE_MODEL, CHIPTUNE_SYSTEM_PROMPT, normalize_prompt(prompt)))
+
+
+def render_cache_key(chiptune_text: str, bpm, output_format, sample_rate, loop=None, stems=False) -> str:
+    # loop为 (重复次数, 总时长) 或None；stems为True时缓存的是分轨zip
+    # pcm的键包含字节序，避免命中改为大端之前缓存的小端数据
+    format_key = output_format + OUTPUT_FORMATS.get(output_format, {}).get('dtype', '')
+    return '\n'.join((f"{bpm}|{format_key}|{sample_rate}|{loop}|{'stems' if stems else 'mix'}", chiptune_text))
+
+
+def get_chiptune_text(prompt: str, use_cache=True):
+    """获取提示词对应的Chiptune文本，返回 (文本, 缓存状态)，缓存状态为hit/miss/bypass
+
+    use_cache为False时跳过缓存读取、重新调用模型，新结果仍会写入缓存。
+    """
+    key = prompt_cache_key(prompt)
+    if use_cache:
+        cached = prompt_cache.get(key)
+        if cached is not None:
+            print("提示词缓存命中")
+            return cached.decode('utf-8'), 'hit'
+    
+    chiptune_text = generate_chiptune_from_prompt(prompt)
+    prompt_cache.put(key, chiptune_text.encode('utf-8'))
+    return chiptune_text, 'miss' if use_cache else 'bypass'
+
+
+def chiptune_messages(prompt: str):
+    """生成Chiptune文本的对话消息"""
+    return [
+        {
+            "role": "system",
+            "content": CHIPTUNE_SYSTEM_PROMPT
+        },
+        {
+            "role": "user",
+            "content": prompt
+        }
+    ]
+
+
+def stream_chiptune_from_prompt(prompt: str, stream_client=None):
+    """以流式方式调用AI模型，返回逐段产出Chiptune文本的生成器
+
+    请求在调用时立即发出，连接错误在开始流式输出之前抛出。
+    stream_client可替换为任何兼容 chat.completions.create(stream=True) 接口的客户端。
+    """
+    try:
+        stream = (stream_client or client).chat.completions.create(
+            model=CHIPTUNE_MODEL,
+            messages=chiptune_messages(prompt),
+            stream=True
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"生成Chiptune文本时发生错误: {str(e)}")
+    
+    def iter_deltas():
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+    
+    return iter_deltas()
 
 
 def generate_chiptune_from_prompt(prompt: str) -> str:
@@ -449,17 +1855,8 @@ def generate_chiptune_from_prompt(prompt: str) -> str:
     try:
         # 调用AI模型生成Chiptune文本
         completion = client.chat.completions.create(
-            model="doubao-1-5-pro-256k-250115",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "你是一个专业的Chiptune音乐生成器。你的任务是根据用户提供的音乐风格描述，生成符合Chiptune格式的音乐指令文本。\n\nChiptune格式说明：\n1. 每行代表一个音符指令\n2. 格式为：轨道|时间|音符|时长|参数\n3. 轨道类型：S1/S2（方波），TR（三角波），NO（噪音）\n4. 时间格式：小节:拍 或 拍数\n5. 音符格式：八度+音名（如4C表示第4八度的C音）\n6. 时长：以拍为单位\n7. 参数：vol=音量(0-15), pw=脉冲宽度(0-100)\n\n示例：\nS1 | 1:1 | 5C | 0.5 | vol=10\nS1 | 1:1.5 | 5D | 0.5 | vol=10\nS1 | 1:2 | 5E | 0.5 | vol=10\n\n请严格按照上述格式输出，不要添加任何额外的文本或解释。"
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
+            model=CHIPTUNE_MODEL,
+            messages=chiptune_messages(prompt)
         )
         
         # 获取生成的Chiptune文本
@@ -483,49 +1880,347 @@ def generate_chiptune_from_prompt(prompt: str) -> str:
         raise HTTPException(status_code=500, detail=f"生成Chiptune文本时发生错误: {str(e)}")
 
 
-def generate_music_from_chiptune(chiptune_text: str, bpm: int = 130) -> bytes:
-    """将Chiptune文本转换为MP3音频数据"""
+def compile_score(chiptune_text: str):
+    """编译Chiptune文本，没有任何有效音符时抛出ValueError"""
+    score = parse_chiptune_text(chiptune_text)
+    print(f"乐谱编译完成: {len(score)}个音符, {len(score.channels)}个轨道, {len(score.diagnostics)}条警告")
+    
+    if not score:
+        raise ValueError("没有找到有效的音频指令")
+    return score
+
+
+def render_score_pcm(score, bpm: int = 130, workers=None, sample_rate=SAMPLE_RATE):
+    """将编译好的乐谱以指定采样率渲染为16位PCM数据"""
+    # 将所有轨道渲染到混音总线，最后统一量化为16位PCM
+    return quantize_to_pcm(mix_tracks(score, bpm, sample_rate, workers=workers))
+
+
+def render_chiptune_pcm(chiptune_text: str, bpm: int = 130, workers=None, sample_rate=SAMPLE_RATE):
+    """将Chiptune文本以指定采样率渲染为16位PCM数据"""
+    return render_score_pcm(compile_score(chiptune_text), bpm, workers=workers, sample_rate=sample_rate)
+
+
+def render_chiptune_stream(chiptune_text: str, bpm: int = 130, block_size=None, sample_rate=SAMPLE_RATE, workers=None):
+    """将Chiptune文本按块流式渲染，返回 (总样本数, 逐块产出16位PCM数据的生成器)
+
+    乐谱适合多线程并行渲染时（见parallel_render_workers），各轨道并行合成到整条混音总线上，完成后一次产出。
+    """
+    # 先完成编译，使乐谱错误在开始流式输出之前抛出
+    score = compile_score(chiptune_text)
+    
+    if parallel_render_workers(score, workers):
+        mixed_audio = render_score_pcm(score, bpm, workers=workers, sample_rate=sample_rate)
+        return len(mixed_audio), iter((mixed_audio,))
+    
+    total_samples = compute_song_length(score.notes, bpm, sample_rate)
+    blocks = render_blocks(score, bpm, sample_rate, block_size=block_size)
+    return total_samples, (quantize_to_pcm(block) for block in blocks)
+
+
+def render_loop_audio(chiptune_text: str, score, bpm, output_format, sample_rate, loop, workers=None):
+    """循环模式渲染编译好的乐谱，返回 (音频数据, 循环点信息, 渲染缓存状态)
+
+    loop为 (重复次数, 总时长)；命中渲染缓存时只计算循环布局，不做合成。
+    """
+    loop_count, loop_duration = loop
+    layout = loop_layout(score, bpm, sample_rate, loop_count, loop_duration)
+    metadata = loop_metadata(layout, sample_rate)
+    
+    key = render_cache_key(chiptune_text, bpm, output_format, sample_rate, loop)
+    audio_data = render_cache.get(key)
+    if audio_data is not None:
+        return audio_data, metadata, 'hit'
+    
+    mixed_audio = quantize_to_pcm(render_loop(layout, bpm, sample_rate, workers=workers))
+    print(f"循环渲染完成: 合成{layout['rendered_passes']}遍, 共{layout['loop_count']}遍, 循环点{metadata['loop_start']}-{metadata['loop_end']}")
+    audio_data = encode_audio(mixed_audio, sample_rate, output_format, loop=metadata)
+    render_cache.put(key, audio_data)
+    return audio_data, metadata, 'miss'
+
+
+def generate_music_from_chiptune(chiptune_text: str, bpm: int = 130, workers=None,
+                                 output_format='mp3', sample_rate=SAMPLE_RATE, loop=None) -> bytes:
+    """将Chiptune文本转换为指定格式和采样率的音频数据，workers指定并行渲染轨道的工作者数
+
+    loop为 (重复次数, 总时长) 时按循环模式渲染。
+    """
     try:
-        # 解析Chiptune文本
-        tracks_commands = parse_chiptune_text(chiptune_text)
-        
-        if not tracks_commands:
-            raise ValueError("没有找到有效的音频指令")
-        
-        # 生成各个轨道的音频
-        tracks_audio = {}
-        for channel, commands in tracks_commands.items():
-            tracks_audio[channel] = generate_track(commands, bpm, SAMPLE_RATE)
-        
-        # 混合所有轨道
-        mixed_audio = mix_tracks(tracks_audio, SAMPLE_RATE)
-        
-        # 创建临时文件来保存MP3
-        with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as tmp_file:
-            tmp_filename = tmp_file.name
-        
-        # 转换为MP3
-        convert_to_mp3(mixed_audio, SAMPLE_RATE, tmp_filename)
+        if loop:
+            score = compile_score(chiptune_text)
+            return render_loop_audio(chiptune_text, score, bpm, output_format, sample_rate, loop, workers)[0]
         
-        # 读取MP3文件内容
-        with open(tmp_filename, 'rb') as f:
-            mp3_data = f.read()
+        key = render_cache_key(chiptune_text, bpm, output_format, sample_rate)
+        cached = render_cache.get(key)
+        if cached is not None:
+            return cached
         
-        # 删除临时文件
-        os.unlink(tmp_filename)
+        # 直接以目标采样率合成，而不是合成后再降采样
+        mixed_audio = render_chiptune_pcm(chiptune_text, bpm, workers=workers, sample_rate=sample_rate)
         
-        return mp3_data
+        # 直接在内存中编码
+        audio_data = encode_audio(mixed_audio, sample_rate, output_format)
+        render_cache.put(key, audio_data)
+        return audio_data
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"生成音乐时发生错误: {str(e)}")
 
 
-def generate_music(prompt: str, bpm: int = 130) -> bytes:
+def render_chiptune_variants(chiptune_text: str, variants, workers=None):
+    """把同一份乐谱按多组 (bpm, 输出格式, 采样率, 循环) 渲染，乐谱只编译一次
+
+    variants为 (bpm, 输出格式, 采样率, 循环, 分轨) 列表，循环为 (重复次数, 总时长) 或None，
+    分轨为True时该变体的数据是分轨zip。返回 (编译好的乐谱, 与之对应的结果字典列表)。
+    乐谱在渲染任何变体之前编译一次，所有变体共用，诊断信息因此总是完整的。
+    每个结果的note_cache是渲染该变体时的音符缓存命中统计，渲染缓存命中时为0。
+    """
+    score = compile_score(chiptune_text)
+    results = []
+    for bpm, output_format, sample_rate, loop, stems in variants:
+        with note_cache.measure() as note_stats:
+            result = render_variant(chiptune_text, score, bpm, output_format, sample_rate, loop, stems, workers)
+        result['note_cache'] = note_stats
+        print(f"变体 {bpm}bpm/{output_format}/{sample_rate}Hz 音符缓存统计: {format_note_cache_stats(note_stats)}")
+        results.append(result)
+    return score, results
+
+
+def render_variant(chiptune_text: str, score, bpm, output_format, sample_rate, loop, stems, workers=None):
+    """渲染render_chiptune_variants中的一个变体，返回结果字典"""
+    result = {
+        'bpm': bpm,
+        'output_format': output_format,
+        'sample_rate': sample_rate,
+        'loop': None,
+    }
+    if stems:
+        audio_data, cache_status = render_stems_audio(chiptune_text, score, bpm, output_format, sample_rate)
+        result['stems'] = True
+    elif loop:
+        audio_data, result['loop'], cache_status = render_loop_audio(
+            chiptune_text, score, bpm, output_format, sample_rate, loop, workers)
+    else:
+        key = render_cache_key(chiptune_text, bpm, output_format, sample_rate)
+        audio_data = render_cache.get(key)
+        cache_status = 'hit'
+        if audio_data is None:
+            mixed_audio = render_score_pcm(score, bpm, workers=workers, sample_rate=sample_rate)
+            audio_data = encode_audio(mixed_audio, sample_rate, output_format)
+            render_cache.put(key, audio_data)
+            cache_status = 'miss'
+    result['cache'] = cache_status
+    result['data'] = audio_data
+    return result
+
+
+def variant_filename(variant):
+    if variant.get('stems'):
+        return f"chiptune_{variant['bpm']}bpm_{variant['sample_rate']}hz_stems.zip"
+    suffix = '_loop' if variant.get('loop') else ''
+    return f"chiptune_{variant['bpm']}bpm_{variant['sample_rate']}hz{suffix}.{variant['output_format']}"
+
+
+def build_stems_zip(stems, sample_rate, output_format='wav') -> bytes:
+    """把分轨编码后打包为zip，各分轨的编码相互独立，并发进行"""
+    def encode_stem(stem):
+        return encode_audio(quantize_to_pcm(stem[1]), sample_rate, output_format)
+    
+    # 编码在ffmpeg子进程中进行，用线程并发即可利用多核
+    with ThreadPoolExecutor(max_workers=len(stems)) as pool:
+        encoded = list(pool.map(encode_stem, stems))
+    
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        for (name, _), audio_data in zip(stems, encoded):
+            # 轨道名来自乐谱，只保留适合作为文件名的字符
+            safe_name = re.sub(r'[^0-9A-Za-z_-]', '_', name)
+            archive.writestr(f"{safe_name}.{output_format}", audio_data)
+    return buffer.getvalue()
+
+
+def render_stems_audio(chiptune_text: str, score, bpm, output_format, sample_rate):
+    """分轨模式渲染乐谱，返回 (zip数据, 渲染缓存状态)；score为None时按需编译"""
+    if output_format not in STEM_FORMATS:
+        raise ValueError(f"分轨导出不支持的格式: {output_format}")
+    key = render_cache_key(chiptune_text, bpm, output_format, sample_rate, stems=True)
+    zip_data = render_cache.get(key)
+    if zip_data is not None:
+        return zip_data, 'hit'
+    
+    if score is None:
+        score = compile_score(chiptune_text)
+    zip_data = build_stems_zip(render_stems(score, bpm, sample_rate), sample_rate, output_format)
+    render_cache.put(key, zip_data)
+    return zip_data, 'miss'
+
+
+def build_variant_zip(chiptune_text: str, variants) -> bytes:
+    """把渲染好的变体、乐谱原文和清单打包为zip（音频不再压缩，直接存储）"""
+    manifest = []
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as archive:
+        archive.writestr('score.txt', chiptune_text)
+        for variant in variants:
+            filename = variant_filename(variant)
+            archive.writestr(filename, variant['data'])
+            manifest.append({**{k: v for k, v in variant.items() if k != 'data'}, 'file': filename})
+        archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    return buffer.getvalue()
+
+
+def build_variant_json(chiptune_text: str, score, variants) -> dict:
+    """把渲染好的变体以base64形式和乐谱一起放入JSON"""
+    return {
+        'score': chiptune_text,
+        'diagnostics': score.diagnostics,
+        'variants': [
+            {
+                **{k: v for k, v in variant.items() if k != 'data'},
+                'file': variant_filename(variant),
+                'media_type': 'application/zip' if variant.get('stems') else output_media_type(variant['output_format'], variant['sample_rate']),
+                'audio': base64.b64encode(variant['data']).decode('ascii'),
+            }
+            for variant in variants
+        ],
+    }
+
+
+def generate_music(prompt: str, bpm: int = 130, output_format='mp3', sample_rate=SAMPLE_RATE, use_cache=True) -> bytes:
     """根据提示生成音乐的完整流程"""
-    # 1. 使用AI模型生成Chiptune文本
-    chiptune_text = generate_chiptune_from_prompt(prompt)
+    # 1. 使用AI模型生成Chiptune文本（优先使用提示词缓存）
+    chiptune_text, _ = get_chiptune_text(prompt, use_cache)
+    
+    # 2. 将Chiptune文本转换为音频
+    audio_data = generate_music_from_chiptune(chiptune_text, bpm, output_format=output_format, sample_rate=sample_rate)
     
-    # 2. 将Chiptune文本转换为MP3音频
-    mp3_data = generate_music_from_chiptune(chiptune_text, bpm)
+    return audio_data
+
+
+def generate_music_stems(prompt: str, bpm: int = 130, output_format='wav', sample_rate=SAMPLE_RATE, use_cache=True):
+    """根据提示生成音乐并导出分轨，返回 (分轨zip数据, 缓存状态)，缓存状态含本次渲染的音符缓存统计"""
+    chiptune_text, prompt_status = get_chiptune_text(prompt, use_cache)
+    try:
+        with note_cache.measure() as note_stats:
+            zip_data, render_status = render_stems_audio(chiptune_text, None, bpm, output_format, sample_rate)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"生成分轨时发生错误: {str(e)}")
+    return zip_data, {'prompt': prompt_status, 'render': render_status, 'note_cache': note_stats}
+
+
+def generate_music_pipelined(prompt: str, bpm: int = 130, output_format='mp3', sample_rate=SAMPLE_RATE,
+                             stream_client=None):
+    """边接收模型输出边编译乐谱、边合成、边编码，返回逐块产出编码后音频数据的生成器
+
+    模型按时间顺序输出音符时，已到达的最晚音符之前STREAM_LOOKBACK_BEATS拍的部分视为已经确定，
+    随即合成输出，使模型生成与合成、编码的耗时相互重叠。只有观察到不同轨道的音符交替出现后才认为输出是
+    按时间排列的；模型逐个轨道输出时不会出现交替，全部音符到达后再完整合成。
+    生成结束后写入提示词缓存和渲染缓存；仍有音符到达过晚时，已输出的部分与完整渲染不同，不写入渲染缓存。
+    乐谱为空等错误在产出第一块数据之前抛出。
+    """
+    deltas = stream_chiptune_from_prompt(prompt, stream_client)
+    parser = IncrementalScoreParser()
+    render_stats = {}
+    
+    def note_batches():
+        seen_channels = set()
+        last_channel = None
+        interleaved = False  # 是否出现过某个轨道在其他轨道之后再次输出音符
+        for delta in deltas:
+            notes = parser.feed(delta)
+            if not len(notes):
+                continue
+            for channel in notes['channel'].tolist():
+                if channel != last_channel and channel in seen_channels:
+                    interleaved = True
+                seen_channels.add(channel)
+                last_channel = channel
+            # 未观察到轨道交替之前，后面可能还有从头开始的轨道，不输出任何块
+            yield notes, parser.latest_time - STREAM_LOOKBACK_BEATS if interleaved else 0.0
+        last_notes = parser.close()
+        
+        chiptune_text = parser.text
+        print(f"AI生成的原始内容: {repr(chiptune_text)}")
+        print(f"乐谱编译完成: {len(parser.records)}个音符, {len(parser.channels)}个轨道, {len(parser.diagnostics)}条警告")
+        if not parser.records:
+            raise ValueError("没有找到有效的音频指令")
+        prompt_cache.put(prompt_cache_key(prompt), chiptune_text.encode('utf-8'))
+        yield last_notes, None
     
-    return mp3_data
\ No newline at end of file
+    def completed_key():
+        # 流式WAV的文件头中没有真实长度，不写入渲染缓存
+        if output_format == 'wav':
+            return None
+        # 有音符到达过晚时，之前已输出的块缺少这些音符，音频与完整渲染不同，不能用乐谱的键缓存
+        if render_stats.get('late_notes'):
+            return None
+        return render_cache_key(parser.text, bpm, output_format, sample_rate)
+    
+    blocks = render_incremental_blocks(note_batches(), bpm, sample_rate, stats=render_stats)
+    # 先取得第一块音频再开始编码，乐谱为空等错误在输出任何数据之前抛出
+    first_block = next(blocks, None)
+    if first_block is not None:
+        blocks = itertools.chain((first_block,), blocks)
+    pcm_blocks = (quantize_to_pcm(block) for block in blocks)
+    audio_stream = encode_audio_stream(pcm_blocks, sample_rate, output_format)
+    return render_cache.cache_stream(completed_key, audio_stream)
+
+
+def generate_music_stream(prompt: str, bpm: int = 130, output_format='mp3', sample_rate=SAMPLE_RATE, use_cache=True,
+                          pipelined=False, loop=None):
+    """根据提示生成音乐，返回 (逐块产出编码后音频数据的生成器, 生成信息)
+
+    生成信息为 {'prompt': hit/miss/bypass, 'render': hit/miss, 'loop': 循环点信息或None, 'note_cache': 音符缓存统计}。
+    音符缓存统计在返回前渲染完整音频时（循环模式、渲染缓存命中）已经完整；
+    流式合成时随音频逐块产出而累加，全部产出后输出到日志。
+    pipelined为True且提示词缓存未命中时，以流式方式调用模型，边生成乐谱边合成。
+    loop为 (重复次数, 总时长) 时按循环模式渲染，需要完整乐谱，因此不使用pipelined。
+    """
+    if loop:
+        chiptune_text, prompt_status = get_chiptune_text(prompt, use_cache)
+        try:
+            score = compile_score(chiptune_text)
+            with note_cache.measure() as note_stats:
+                audio_data, metadata, render_status = render_loop_audio(
+                    chiptune_text, score, bpm, output_format, sample_rate, loop)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"生成音乐时发生错误: {str(e)}")
+        return iter((audio_data,)), {'prompt': prompt_status, 'render': render_status, 'loop': metadata,
+                                     'note_cache': note_stats}
+    
+    if pipelined:
+        cached = prompt_cache.get(prompt_cache_key(prompt)) if use_cache else None
+        if cached is None:
+            note_stats = {'hits': 0, 'misses': 0}
+            try:
+                # 返回之前已经合成出第一块，同样计入本次渲染的统计
+                with note_cache.measure(note_stats):
+                    audio_stream = generate_music_pipelined(prompt, bpm, output_format, sample_rate)
+            except HTTPException:
+                raise
+            except Exception as e:
+                raise HTTPException(status_code=500, detail=f"生成音乐时发生错误: {str(e)}")
+            return note_cache.measure_blocks(audio_stream, note_stats), {
+                'prompt': 'miss' if use_cache else 'bypass', 'render': 'miss', 'loop': None, 'note_cache': note_stats}
+    
+    # 1. 使用AI模型生成Chiptune文本（优先使用提示词缓存）
+    chiptune_text, prompt_status = get_chiptune_text(prompt, use_cache)
+    
+    # 2. 同一乐谱、同一输出参数已经渲染过时直接返回缓存的音频
+    key = render_cache_key(chiptune_text, bpm, output_format, sample_rate)
+    cached = render_cache.get(key)
+    if cached is not None:
+        return iter((cached,)), {'prompt': prompt_status, 'render': 'hit', 'loop': None,
+                                 'note_cache': {'hits': 0, 'misses': 0}}
+    
+    # 3. 按块流式合成并边合成边编码，乐谱错误在开始流式响应之前抛出；完整输出后写入渲染缓存
+    note_stats = {'hits': 0, 'misses': 0}
+    try:
+        with note_cache.measure(note_stats):
+            total_samples, pcm_blocks = render_chiptune_stream(chiptune_text, bpm, sample_rate=sample_rate)
+        audio_stream = encode_audio_stream(note_cache.measure_blocks(pcm_blocks, note_stats), sample_rate, output_format,
+                                           total_samples=total_samples)
+        return render_cache.cache_stream(key, audio_stream), {'prompt': prompt_status, 'render': 'miss', 'loop': None,
+                                                              'note_cache': note_stats}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"生成音乐时发生错误: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,239 @@
+"""
+帧动画（GIF/WebP/APNG）导出模块
+"""
+import os
+import subprocess
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+from pydub import AudioSegment
+
+# 配置参数
+PALETTE_SAMPLE_PIXELS = 262144  # 计算全局调色板时从所有帧中抽取的像素总数
+PALETTE_QUANTIZERS = ('median_cut', 'kmeans')  # 支持的调色板算法
+KMEANS_ITERATIONS = 8  # k-means迭代次数（以中位切分的结果为初值，收敛很快）
+KMEANS_CHUNK_SIZE = 16384  # k-means分配最近中心时每批处理的像素数，限制距离矩阵的内存
+
+# 支持的动图格式：loop_args为(无限循环, 只播放一次)时的ffmpeg参数；gif和apng经paletteuse输出8位索引色
+ANIMATION_FORMATS = {
+    'webp': {'ext': '.webp', 'media_type': 'image/webp',
+             'ffmpeg_args': ('-c:v', 'libwebp_anim', '-lossless', '1', '-f', 'webp'),
+             'loop_args': (('-loop', '0'), ('-loop', '1'))},
+    'gif': {'ext': '.gif', 'media_type': 'image/gif', 'paletted': True,
+            'ffmpeg_args': ('-f', 'gif'),
+            'loop_args': (('-loop', '0'), ('-loop', '-1'))},
+    'apng': {'ext': '.png', 'media_type': 'image/apng', 'paletted': True,
+             'ffmpeg_args': ('-c:v', 'apng', '-f', 'apng'),
+             'loop_args': (('-plays', '0'), ('-plays', '1'))},
+}
+
+
+def resolve_animation_options(output_format="webp", fps=12, colors=256, quantizer="median_cut", loop=True):
+    """校验动图参数，返回选项字典；参数无效时抛出ValueError"""
+    output_format = (output_format or "webp").lower()
+    if output_format not in ANIMATION_FORMATS:
+        raise ValueError(f"不支持的动图格式: {output_format}，可选: {', '.join(ANIMATION_FORMATS)}")
+    if not fps or not 0 < fps <= 60:
+        raise ValueError(f"帧率必须在0-60之间: {fps}")
+    if not 2 <= colors <= 256:
+        raise ValueError(f"调色板颜色数必须在2-256之间: {colors}")
+    quantizer = (quantizer or "median_cut").lower()
+    if quantizer not in PALETTE_QUANTIZERS:
+        raise ValueError(f"不支持的调色板算法: {quantizer}，可选: {', '.join(PALETTE_QUANTIZERS)}")
+    return {
+        'format': output_format,
+        'fps': fps,
+        'colors': colors,
+        'quantizer': quantizer,
+        'loop': bool(loop),
+    }
+
+
+def _read_frame(path, size=None):
+    image = cv2.imread(path, cv2.IMREAD_COLOR)
+    if image is None:
+        raise IOError(f"无法读取帧图片: {os.path.basename(path)}")
+    if size is not None and (image.shape[1], image.shape[0]) != size:
+        # 尺寸不一致的帧缩放到第一帧的尺寸
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+    return image
+
+
+def sample_pixels(paths, max_samples=PALETTE_SAMPLE_PIXELS, seed=0):
+    """从所有帧中均匀抽取像素，返回 (N, 3) 的BGR数组和第一帧的尺寸 (宽, 高)"""
+    rng = np.random.default_rng(seed)
+    per_frame = max(1, max_samples // len(paths))
+    samples = []
+    size = None
+    for path in paths:
+        image = _read_frame(path, size)
+        if size is None:
+            size = (image.shape[1], image.shape[0])
+        pixels = image.reshape(-1, 3)
+        if len(pixels) > per_frame:
+            pixels = pixels[rng.choice(len(pixels), per_frame, replace=False)]
+        samples.append(pixels)
+    return np.concatenate(samples), size
+
+
+def median_cut_palette(pixels, colors):
+    """中位切分：反复把（范围×像素数）最大的颜色盒沿最宽的通道从中位数处一分为二，返回 (k, 3) 的uint8调色板"""
+    def make_box(box_pixels):
+        extent = box_pixels.max(axis=0).astype(np.int32) - box_pixels.min(axis=0)
+        channel = int(np.argmax(extent))
+        return int(extent[channel]) * len(box_pixels), channel, box_pixels
+
+    boxes = [make_box(pixels)]
+    while len(boxes) < colors:
+        index = max(range(len(boxes)), key=lambda i: boxes[i][0])
+        score, channel, box_pixels = boxes[index]
+        if score <= 0:
+            # 所有盒子都只剩一种颜色
+            break
+        half = len(box_pixels) // 2
+        order = np.argpartition(box_pixels[:, channel], half)
+        boxes[index] = make_box(box_pixels[order[:half]])
+        boxes.append(make_box(box_pixels[order[half:]]))
+    return np.array([box_pixels.mean(axis=0) for _, _, box_pixels in boxes]).round().astype(np.uint8)
+
+
+def _nearest(pixels, centers):
+    """分批计算每个像素最近的中心，返回索引数组"""
+    centers = centers.astype(np.float32)
+    center_norms = (centers ** 2).sum(axis=1)
+    result = np.empty(len(pixels), dtype=np.intp)
+    for start in range(0, len(pixels), KMEANS_CHUNK_SIZE):
+        chunk = pixels[start:start + KMEANS_CHUNK_SIZE].astype(np.float32)
+        # |x-c|² = |x|² - 2x·c + |c|²，|x|²对比较无影响
+        distances = center_norms - 2 * chunk @ centers.T
+        result[start:start + KMEANS_CHUNK_SIZE] = np.argmin(distances, axis=1)
+    return result
+
+
+def kmeans_palette(pixels, colors, iterations=KMEANS_ITERATIONS):
+    """以中位切分的结果为初值做k-means（Lloyd迭代），返回 (k, 3) 的uint8调色板"""
+    centers = median_cut_palette(pixels, colors).astype(np.float64)
+    for _ in range(iterations):
+        labels = _nearest(pixels, centers)
+        counts = np.bincount(labels, minlength=len(centers))
+        sums = np.stack([np.bincount(labels, weights=pixels[:, c], minlength=len(centers)) for c in range(3)], axis=1)
+        # 没有分到像素的中心保持不变
+        filled = counts > 0
+        centers[filled] = sums[filled] / counts[filled, None]
+    return centers.round().clip(0, 255).astype(np.uint8)
+
+
+class PaletteMapper:
+    """把像素映射到调色板中最近的颜色
+
+    按24位颜色缓存已经算出的最近索引，相邻帧的颜色大多相同，每帧只需为新出现的颜色计算距离。
+    缓存是按颜色排序的数组，用二分查找，大小只与出现过的颜色数有关，不预先分配覆盖全部24位颜色的表。
+    """
+
+    def __init__(self, palette):
+        self.palette = palette
+        self._keys = np.empty(0, dtype=np.int32)  # 已计算的24位颜色，升序
+        self._indices = np.empty(0, dtype=np.int16)  # 与_keys对应的调色板索引
+
+    def map(self, image):
+        """返回只包含调色板颜色的BGR图像"""
+        flat = image.reshape(-1, 3)
+        keys = (flat[:, 0].astype(np.int32) << 16) | (flat[:, 1].astype(np.int32) << 8) | flat[:, 2]
+        positions = self._lookup(keys)
+        missing = positions < 0
+        if missing.any():
+            new_keys = np.unique(keys[missing])
+            colors = np.stack([(new_keys >> 16) & 255, (new_keys >> 8) & 255, new_keys & 255], axis=1)
+            insert_at = np.searchsorted(self._keys, new_keys)
+            self._keys = np.insert(self._keys, insert_at, new_keys)
+            self._indices = np.insert(self._indices, insert_at, _nearest(colors, self.palette))
+            positions = self._lookup(keys)
+        return self.palette[self._indices[positions]].reshape(image.shape)
+
+    def _lookup(self, keys):
+        # 返回各颜色在_keys中的位置，尚未计算的为-1
+        positions = np.searchsorted(self._keys, keys)
+        found = positions < len(self._keys)
+        found[found] = self._keys[positions[found]] == keys[found]
+        return np.where(found, positions, -1)
+
+
+def build_palette(paths, options):
+    """从所有帧的抽样像素计算一次全局调色板，返回 (调色板, 帧尺寸)"""
+    pixels, size = sample_pixels(paths)
+    if options['quantizer'] == 'kmeans':
+        palette = kmeans_palette(pixels, options['colors'])
+    else:
+        palette = median_cut_palette(pixels, options['colors'])
+    return palette, size
+
+
+def encode_animation(paths, output_path, options):
+    """把按顺序排列的帧图片编码为动图写入output_path，所有帧共用一个全局调色板，返回动图信息"""
+    spec = ANIMATION_FORMATS[options['format']]
+    palette, (width, height) = build_palette(paths, options)
+    mapper = PaletteMapper(palette)
+
+    try:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            inputs = ['-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f"{width}x{height}",
+                      '-framerate', str(options['fps']), '-i', 'pipe:0']
+            filters = []
+            if spec.get('paletted'):
+                # 帧已映射到调色板颜色，paletteuse不抖动时一一对应，全部帧共用同一个调色板
+                palette_path = os.path.join(temp_dir, "palette.png")
+                padded = np.concatenate([palette, np.repeat(palette[-1:], 256 - len(palette), axis=0)])
+                cv2.imwrite(palette_path, padded.reshape(16, 16, 3))
+                inputs += ['-i', palette_path]
+                filters = ['-lavfi', '[0:v][1:v]paletteuse=dither=none']
+            loop_args = spec['loop_args'][0 if options['loop'] else 1]
+
+            process = subprocess.Popen(
+                [AudioSegment.converter, '-hide_banner', '-loglevel', 'error', '-y',
+                 *inputs, *filters, *spec['ffmpeg_args'], *loop_args, output_path],
+                stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+            stderr_chunks = []
+            # 后台读取错误输出，避免管道写满后ffmpeg阻塞
+            reader = threading.Thread(target=lambda: stderr_chunks.append(process.stderr.read()), daemon=True)
+            reader.start()
+            written = False
+            try:
+                for path in paths:
+                    process.stdin.write(mapper.map(_read_frame(path, (width, height))).tobytes())
+                written = True
+            except BrokenPipeError:
+                # ffmpeg提前退出，错误信息在下面按返回码报告
+                written = True
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+                if not written:
+                    # 读取帧失败时终止编码进程
+                    process.kill()
+                process.wait()
+                reader.join()
+                process.stderr.close()
+            if process.returncode != 0:
+                error = b''.join(stderr_chunks).decode('utf-8', errors='ignore')
+                raise RuntimeError(f"{options['format'].upper()}编码失败: {error.strip()}")
+    except Exception:
+        # 删除不完整的输出文件，避免留在对外提供访问的帧目录中
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+    return {
+        'format': options['format'],
+        'media_type': spec['media_type'],
+        'frames': len(paths),
+        'fps': options['fps'],
+        'width': width,
+        'height': height,
+        'colors': len(palette),
+        'bytes': os.path.getsize(output_path),
+    }
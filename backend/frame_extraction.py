@@ -0,0 +1,607 @@
+"""
+视频帧提取模块
+"""
+import hashlib
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import urllib.request
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+# 配置参数
+SEEK_MIN_GAP_SECONDS = 4.0  # 尚未测得定位开销时，距下一目标帧超过该时长才尝试直接定位
+SAMPLING_MODES = ('interval', 'smart')  # 帧采样方式：固定间隔 / 按画面差异挑选
+PROXY_WIDTH = 64  # 智能采样时每帧缩小成的灰度代理图像宽度（像素）
+PROXY_SAMPLE_FPS = 10  # 代理图像的采样帧率：每秒只取约这么多帧缩小比较，其余帧只grab不retrieve
+PROXY_CACHE_SIZE = 8  # 内存中保留代理图像序列的视频数，同一视频换参数重新拆分时不必再次全片解码
+
+# 视频缓存目录（支持exe打包：打包后放在exe所在目录）
+VIDEO_CACHE_DIR = os.environ.get('FRAMEFORGE_VIDEO_CACHE_DIR') or os.path.join(
+    os.path.dirname(sys.executable) if getattr(sys, 'frozen', False) else os.path.dirname(__file__), "cache", "videos")
+VIDEO_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 视频缓存的磁盘上限，超出后按最近访问时间淘汰
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 下载时每次读取写入的字节数，内存中只保留一块
+DOWNLOAD_TIMEOUT = 60  # 下载连接和单次读取的超时（秒）
+ENCODE_WORKERS = min(4, os.cpu_count() or 1)  # 帧图片编码线程数（cv2编码时释放GIL，可与解码并行）
+ENCODE_MAX_PENDING = ENCODE_WORKERS * 2  # 等待编码的已解码帧上限，限制内存占用（1080p每帧约6MB）
+
+# 帧图片输出格式：quality为None时使用各格式的默认值
+FRAME_FORMATS = {
+    'jpg': {'ext': '.jpg', 'quality_flag': cv2.IMWRITE_JPEG_QUALITY, 'default_quality': 95},
+    'png': {'ext': '.png'},  # 无损，忽略quality
+    'webp': {'ext': '.webp', 'quality_flag': cv2.IMWRITE_WEBP_QUALITY, 'default_quality': 101},  # quality>100为无损
+}
+PNG_COMPRESSION = 3  # PNG压缩级别（0-9），兼顾速度和体积
+ZIP_CHUNK_SIZE = 256 * 1024  # 流式导出zip时每次读取和发送的字节数
+FRAME_SET_PATTERN = re.compile(r'^frames_[0-9a-f_]+$')  # 帧集合ID（帧图片目录名）的格式
+
+
+class VideoCache:
+    """按URL和内容哈希缓存下载的视频文件
+
+    视频按内容的SHA-256存放在objects目录下，内容相同的不同URL共用一个文件；urls目录记录URL到内容哈希的映射。
+    下载边读边写临时文件并计算哈希，同一URL的并发请求共享同一次下载。
+    总字节数超出上限时按最近访问时间（atime）淘汰，正在被使用的文件不会被淘汰。
+    """
+
+    def __init__(self, directory, max_bytes, chunk_size=DOWNLOAD_CHUNK_SIZE, timeout=DOWNLOAD_TIMEOUT):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._objects_dir = os.path.join(directory, "objects")
+        self._urls_dir = os.path.join(directory, "urls")
+        self._lock = threading.Lock()
+        self._downloads = {}  # URL -> 正在进行的下载（threading.Event, 结果）
+        self._pins = {}  # 内容哈希 -> 正在使用该文件的请求数
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0
+        self.evictions = 0
+
+    def _url_path(self, url):
+        return os.path.join(self._urls_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def _object_path(self, digest, ext):
+        return os.path.join(self._objects_dir, digest + ext)
+
+    @contextmanager
+    def open(self, url):
+        """取得URL对应视频的本地路径，with块内该文件不会被淘汰"""
+        digest, path = self.fetch(url)
+        try:
+            yield path
+        finally:
+            self._release(digest)
+
+    def _release(self, digest):
+        with self._lock:
+            self._pins[digest] -= 1
+            if not self._pins[digest]:
+                del self._pins[digest]
+
+    def fetch(self, url):
+        """返回 (内容哈希, 本地路径)，并为该文件加上引用，调用方负责释放（一般通过open使用）"""
+        while True:
+            with self._lock:
+                cached = self._lookup(url)
+                if cached is not None:
+                    self.hits += 1
+                    self._pins[cached[0]] = self._pins.get(cached[0], 0) + 1
+                    return cached
+
+                download = self._downloads.get(url)
+                if download is None:
+                    download = self._downloads[url] = {'event': threading.Event(), 'error': None}
+                    owner = True
+                    self.misses += 1
+                else:
+                    owner = False
+                    self.shared += 1
+
+            if not owner:
+                # 等待其他请求完成同一URL的下载，成功后回到缓存查找
+                download['event'].wait()
+                if download['error'] is not None:
+                    raise download['error']
+                continue
+
+            try:
+                return self._download(url)
+            except Exception as e:
+                download['error'] = e
+                raise
+            finally:
+                with self._lock:
+                    del self._downloads[url]
+                download['event'].set()
+
+    def _lookup(self, url):
+        # 调用方需持有self._lock
+        url_path = self._url_path(url)
+        try:
+            with open(url_path, 'r', encoding='utf-8') as f:
+                name = f.read().strip()
+        except OSError:
+            return None
+        path = os.path.join(self._objects_dir, name)
+        try:
+            stat = os.stat(path)
+            # 刷新访问时间，供按LRU淘汰使用
+            os.utime(path, (time.time(), stat.st_mtime))
+        except OSError:
+            # 文件已被淘汰，删除失效的URL映射
+            try:
+                os.remove(url_path)
+            except OSError:
+                pass
+            return None
+        return os.path.splitext(name)[0], path
+
+    def _download(self, url):
+        ext = os.path.splitext(urllib.parse.urlparse(url).path)[1].lower() or ".mp4"
+        os.makedirs(self._objects_dir, exist_ok=True)
+        os.makedirs(self._urls_dir, exist_ok=True)
+        temp_path = os.path.join(self._objects_dir, f"{uuid.uuid4().hex}.tmp")
+        sha256 = hashlib.sha256()
+        size = 0
+        start = time.time()
+        try:
+            with urllib.request.urlopen(url, timeout=self.timeout) as response, open(temp_path, 'wb') as f:
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+
+            digest = sha256.hexdigest()
+            with self._lock:
+                path = self._object_path(digest, ext)
+                if os.path.exists(path):
+                    # 其他URL已经下载过相同内容
+                    os.remove(temp_path)
+                else:
+                    os.replace(temp_path, path)
+                url_temp_path = f"{self._url_path(url)}.{uuid.uuid4().hex}.tmp"
+                with open(url_temp_path, 'w', encoding='utf-8') as f:
+                    f.write(digest + ext)
+                os.replace(url_temp_path, self._url_path(url))
+                # 淘汰前先为本次请求加上引用，保证刚下载的文件不会被立即删除
+                self._pins[digest] = self._pins.get(digest, 0) + 1
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+
+        # 从这里起本次请求持有引用，返回之前的任何失败都要释放，否则该文件永远不会被淘汰
+        try:
+            print(f"视频下载完成: {size} 字节，用时 {time.time() - start:.2f} 秒，内容哈希 {digest[:12]}")
+            self._evict()
+        except BaseException:
+            self._release(digest)
+            raise
+        return digest, path
+
+    def _evict(self):
+        with self._lock:
+            entries = []
+            with os.scandir(self._objects_dir) as it:
+                for entry in it:
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append((stat.st_atime, stat.st_size, entry.name))
+
+            total = sum(size for _, size, _ in entries)
+            # 超出容量时从最久未访问的文件开始删除，URL映射在下次查找时发现文件不存在即视为未命中
+            entries.sort()
+            for _, size, name in entries:
+                if total <= self.max_bytes:
+                    break
+                if os.path.splitext(name)[0] in self._pins:
+                    continue
+                try:
+                    os.remove(os.path.join(self._objects_dir, name))
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        """返回命中/未命中/共享下载/淘汰计数"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'shared': self.shared, 'evictions': self.evictions}
+
+
+video_cache = VideoCache(VIDEO_CACHE_DIR, VIDEO_CACHE_MAX_BYTES)
+
+
+def open_video(video_path):
+    """打开视频文件，返回 (cap, info)，info包含fps、frame_count、width、height"""
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        raise IOError("无法打开视频文件")
+
+    info = {
+        'fps': cap.get(cv2.CAP_PROP_FPS) or 0.0,
+        # 部分容器不记录总帧数，此时为0，提取到视频末尾为止
+        'frame_count': max(0, int(cap.get(cv2.CAP_PROP_FRAME_COUNT))),
+        'width': int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        'height': int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+    }
+    return cap, info
+
+
+def plan_interval_indices(fps, frame_count, interval, count):
+    """按固定时间间隔计算目标帧序号：从第0帧开始，每interval秒取一帧，最多count帧
+
+    间隔不足一帧（包括interval<=0）时逐帧提取。
+    """
+    # 计算帧间隔（以帧为单位）
+    frame_interval = max(1, int(fps * interval))
+    indices = [i * frame_interval for i in range(max(0, count))]
+    if frame_count:
+        indices = [index for index in indices if index < frame_count]
+    return indices
+
+
+def plan_timestamp_indices(timestamps, fps, frame_count):
+    """把时间点列表（秒）换算为升序去重的目标帧序号"""
+    if fps <= 0:
+        raise ValueError("无法获取视频帧率，不能按时间点提取")
+
+    indices = set()
+    for t in timestamps:
+        if t < 0:
+            raise ValueError(f"时间点不能为负数: {t}")
+        index = int(round(t * fps))
+        if frame_count:
+            # 超出视频长度的时间点取最后一帧
+            index = min(index, frame_count - 1)
+        indices.add(index)
+    return sorted(indices)
+
+
+_proxy_cache = OrderedDict()  # 视频文件路径（按内容哈希命名）-> 代理图像序列
+_proxy_lock = threading.Lock()
+
+
+def proxy_stride(fps, sample_fps=PROXY_SAMPLE_FPS):
+    """代理图像的取帧间隔：按sample_fps采样，帧率未知时逐帧采样"""
+    return max(1, int(round(fps / sample_fps))) if fps > 0 else 1
+
+
+def compute_proxies(video_path, width=PROXY_WIDTH, sample_fps=PROXY_SAMPLE_FPS):
+    """按proxy_stride的间隔取帧并缩小为灰度代理图像，返回 (帧序号数组, (采样帧数, 高, 宽) 的uint8数组)
+
+    相邻帧的画面几乎相同，逐帧比较没有意义；每一帧仍需grab以保持解码顺序，但只有采样帧retrieve，
+    省去其余帧的格式转换、拷贝和缩放。
+    """
+    cap, info = open_video(video_path)
+    try:
+        height = max(1, round(info['height'] * width / info['width'])) if info['width'] else width
+        stride = proxy_stride(info['fps'], sample_fps)
+        indices = []
+        proxies = []
+        index = 0
+        while cap.grab():
+            if index % stride == 0:
+                ret, frame = cap.retrieve()
+                if not ret:
+                    break
+                # 先缩小再转灰度，缩小用区域插值相当于块平均，对噪点不敏感
+                small = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+                indices.append(index)
+                proxies.append(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY))
+            index += 1
+    finally:
+        cap.release()
+    return np.array(indices, dtype=np.int64), np.array(proxies, dtype=np.uint8).reshape(-1, height, width)
+
+
+def load_proxies(video_path):
+    """取得视频的 (帧序号数组, 代理图像序列)，按文件路径缓存（视频缓存中的文件按内容哈希命名，路径相同即内容相同）"""
+    with _proxy_lock:
+        cached = _proxy_cache.get(video_path)
+        if cached is not None:
+            _proxy_cache.move_to_end(video_path)
+            return cached
+
+    start = time.time()
+    cached = compute_proxies(video_path)
+    print(f"计算代理图像: {len(cached[1])} 帧，用时 {time.time() - start:.2f} 秒")
+    with _proxy_lock:
+        _proxy_cache[video_path] = cached
+        while len(_proxy_cache) > PROXY_CACHE_SIZE:
+            _proxy_cache.popitem(last=False)
+    return cached
+
+
+def frame_changes(proxies):
+    """相邻帧代理图像的平均绝对差，返回长度为帧数的数组（第0帧为0）"""
+    changes = np.zeros(len(proxies), dtype=np.float32)
+    if len(proxies) > 1:
+        diff = np.abs(np.diff(proxies.astype(np.int16), axis=0))
+        changes[1:] = diff.reshape(len(diff), -1).mean(axis=1)
+    return changes
+
+
+def plan_smart_indices(proxies, count, frame_indices=None):
+    """从代理图像序列中挑选count个彼此差异最大的帧，返回升序帧序号
+
+    frame_indices为各代理图像对应的帧序号（compute_proxies按间隔采样），为None时代理图像与帧一一对应。
+
+    贪心最远点采样：从第一帧开始，每次选与已选帧的最小平均绝对差最大的帧。静止片段中的近似重复帧彼此距离很小，
+    只会被选中一帧；动作快、镜头切换处的帧与已选帧差异大，会优先入选。距离相同时取画面变化更剧烈的帧。
+    """
+    total = len(proxies)
+    if total == 0 or count <= 0:
+        return []
+    if frame_indices is None:
+        frame_indices = range(total)
+    if count >= total:
+        return [int(index) for index in frame_indices]
+
+    flat = proxies.reshape(total, -1).astype(np.int16)
+    # 作为并列时的次要依据，放大到远小于1个灰度级，不影响主要的距离比较
+    tie_breaker = frame_changes(proxies) * 1e-6
+    selected = [0]
+    min_distance = np.abs(flat - flat[0]).mean(axis=1)
+    min_distance[0] = -1
+    while len(selected) < count:
+        index = int(np.argmax(min_distance + tie_breaker))
+        if min_distance[index] < 0:
+            break
+        selected.append(index)
+        min_distance = np.minimum(min_distance, np.abs(flat - flat[index]).mean(axis=1))
+        min_distance[selected] = -1
+    return [int(frame_indices[index]) for index in sorted(selected)]
+
+
+def iter_frames(cap, indices, fps=0.0, seek_min_gap=SEEK_MIN_GAP_SECONDS):
+    """按升序帧序号依次解码目标帧，逐个产出 (帧序号, BGR图像)
+
+    非目标帧只grab()不取回图像；距离较远时直接定位，但定位要从前一个关键帧重新解码，
+    因此记录实际的定位开销和单帧grab开销，只有预计顺序跳过更慢时才定位。
+    最后一个目标帧解码后立即停止，不再读取视频剩余部分；视频提前结束时（总帧数不准确）只产出已解码的帧。
+    """
+    can_seek = fps > 0
+    seek_gap = max(1, int(fps * seek_min_gap)) if can_seek else 0
+    seek_cost = None  # 定位的平均耗时（秒），与目标帧在关键帧间隔中的位置有关
+    grab_time = 0.0  # grab()累计耗时（秒）
+    grab_count = 0  # grab()累计帧数
+    position = 0  # 下一次grab()将解码的帧序号
+
+    for index in indices:
+        if index < position:
+            continue
+
+        gap = index - position
+        if can_seek and gap > 0:
+            if seek_cost is None or not grab_count:
+                should_seek = gap > seek_gap
+            else:
+                should_seek = gap * grab_time / grab_count > seek_cost
+
+            if should_seek:
+                start = time.perf_counter()
+                if cap.set(cv2.CAP_PROP_POS_FRAMES, index) and int(cap.get(cv2.CAP_PROP_POS_FRAMES)) == index:
+                    position = index
+                    cost = time.perf_counter() - start
+                    seek_cost = cost if seek_cost is None else 0.5 * (seek_cost + cost)
+                else:
+                    # 容器不支持精确定位，之后全部顺序跳过
+                    print("视频不支持精确定位，改为顺序跳帧")
+                    can_seek = False
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                    position = 0
+
+        # 顺序跳过中间帧并解码目标帧，同时更新单帧grab开销的估计
+        while position <= index:
+            start = time.perf_counter()
+            if not cap.grab():
+                return
+            # 第一帧包含解码器初始化开销，不计入估计
+            if position > 0:
+                grab_time += time.perf_counter() - start
+                grab_count += 1
+            position += 1
+
+        ret, frame = cap.retrieve()
+        if not ret:
+            return
+        yield index, frame
+
+
+def resolve_frame_options(image_format="jpg", quality=None, scale=None, width=None, height=None):
+    """校验帧图片的输出参数，返回选项字典；参数无效时抛出ValueError
+
+    width和height只给出一个时按原视频宽高比计算另一个；都不给时按scale缩放，scale也为None时保持原尺寸。
+    """
+    image_format = (image_format or "jpg").lower()
+    if image_format == "jpeg":
+        image_format = "jpg"
+    if image_format not in FRAME_FORMATS:
+        raise ValueError(f"不支持的图片格式: {image_format}，可选: {', '.join(FRAME_FORMATS)}")
+    max_quality = 101 if image_format == "webp" else 100
+    if quality is not None and not 1 <= quality <= max_quality:
+        raise ValueError(f"图片质量必须在1-{max_quality}之间（WebP取101为无损）: {quality}")
+    if scale is not None and not 0 < scale <= 4:
+        raise ValueError(f"缩放比例必须在0-4之间: {scale}")
+    for name, value in (("宽度", width), ("高度", height)):
+        if value is not None and value <= 0:
+            raise ValueError(f"{name}必须为正数: {value}")
+
+    spec = FRAME_FORMATS[image_format]
+    params = []
+    if 'quality_flag' in spec:
+        params = [spec['quality_flag'], quality if quality is not None else spec['default_quality']]
+    elif image_format == "png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, PNG_COMPRESSION]
+    return {
+        'format': image_format,
+        'ext': spec['ext'],
+        'params': params,
+        'scale': scale,
+        'width': width,
+        'height': height,
+    }
+
+
+def frame_target_size(src_width, src_height, options):
+    """计算输出尺寸 (宽, 高)，与原尺寸相同时返回None"""
+    width, height, scale = options['width'], options['height'], options['scale']
+    if width and height:
+        size = (width, height)
+    elif width:
+        size = (width, max(1, round(src_height * width / src_width)))
+    elif height:
+        size = (max(1, round(src_width * height / src_height)), height)
+    elif scale and scale != 1:
+        size = (max(1, round(src_width * scale)), max(1, round(src_height * scale)))
+    else:
+        return None
+    return None if size == (src_width, src_height) else size
+
+
+def write_frame(frame, path, options):
+    """按输出选项缩放并编码一帧，写入path"""
+    size = frame_target_size(frame.shape[1], frame.shape[0], options)
+    if size is not None:
+        # 缩小用区域插值避免摩尔纹，放大用最近邻保持像素画的硬边
+        shrinking = size[0] * size[1] < frame.shape[0] * frame.shape[1]
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_NEAREST)
+    if not cv2.imwrite(path, frame, options['params']):
+        raise IOError(f"写入帧图片失败: {path}")
+
+
+def save_frames(frames, directory, options, workers=ENCODE_WORKERS, max_pending=ENCODE_MAX_PENDING):
+    """把 (帧序号, 图像) 依次交给线程池编码写入directory，返回按产出顺序排列的文件名列表
+
+    解码线程（调用方）在等待编码的帧达到max_pending时才阻塞，解码和编码因此可以重叠进行。
+    """
+    filenames = []
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for extracted_count, (_, frame) in enumerate(frames):
+                if len(pending) >= max_pending:
+                    pending.popleft().result()
+                filename = f"frame_{extracted_count}{options['ext']}"
+                pending.append(executor.submit(write_frame, frame, os.path.join(directory, filename), options))
+                filenames.append(filename)
+            while pending:
+                pending.popleft().result()
+        finally:
+            # 出错时取消尚未开始的编码任务
+            for future in pending:
+                future.cancel()
+    return filenames
+
+
+def resolve_frame_selection(frames_root, frame_set, names=None):
+    """校验帧集合ID和选中的帧文件名，返回zip条目列表 [(条目名, 文件路径, 字节数, 修改时间)]
+
+    names为帧图片文件名的有序列表，为None时按帧序号导出整个集合；条目依次命名为frame_1、frame_2……
+    帧集合或文件不存在、文件名不合法时抛出ValueError。
+    """
+    if not FRAME_SET_PATTERN.match(frame_set or ''):
+        raise ValueError(f"帧集合ID无效: {frame_set}")
+    directory = os.path.join(frames_root, frame_set)
+    if not os.path.isdir(directory):
+        raise ValueError(f"帧集合不存在或已过期: {frame_set}")
+
+    if names is None:
+        names = sorted((name for name in os.listdir(directory) if name.startswith("frame_")),
+                       key=lambda name: int(re.sub(r'\D', '', name) or 0))
+    if not names:
+        raise ValueError("没有要导出的帧")
+
+    entries = []
+    for number, name in enumerate(names, start=1):
+        # 只接受目录内的文件名，防止路径穿越
+        if os.path.basename(name) != name or not name.startswith("frame_"):
+            raise ValueError(f"帧文件名无效: {name}")
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            raise ValueError(f"帧文件不存在: {name}")
+        entries.append((f"frame_{number}{os.path.splitext(name)[1]}", path, stat.st_size, stat.st_mtime))
+    return entries
+
+
+def stored_zip_size(entries):
+    """计算由entries构成的不压缩zip的总字节数（本地文件头+数据、中央目录、目录结束记录）"""
+    total = 22
+    for arcname, _, size, _ in entries:
+        name_length = len(arcname.encode('utf-8'))
+        total += 30 + name_length + size + 46 + name_length
+    if total > 0xFFFFFFFF or len(entries) > 0xFFFF:
+        raise ValueError("导出内容过大，超出zip格式限制")
+    return total
+
+
+def _dos_datetime(timestamp):
+    t = time.localtime(max(timestamp, 315532800))  # zip时间戳不早于1980年
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+def iter_stored_zip(entries, chunk_size=ZIP_CHUNK_SIZE):
+    """按entries的顺序流式产出不压缩（stored）的zip文件
+
+    图片本身已经压缩，再用deflate几乎不会变小，直接存储省去压缩开销。每个文件先计算CRC32写入本地文件头，
+    再按chunk_size分块发送，内存中任何时候只有一块数据。输出的总字节数等于stored_zip_size(entries)。
+    """
+    central_directory = []
+    offset = 0
+    for arcname, path, size, mtime in entries:
+        crc = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+
+        name = arcname.encode('utf-8')
+        dos_time, dos_date = _dos_datetime(mtime)
+        # 版本、标志（0x800：文件名为UTF-8）、压缩方式（0：stored）、时间、日期、CRC、压缩后大小、原始大小、名称长度、扩展字段长度
+        fields = (20, 0x800, 0, dos_time, dos_date, crc, size, size, len(name))
+        yield struct.pack('<I5HIIIHH', 0x04034b50, *fields, 0) + name
+
+        sent = 0
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                sent += len(chunk)
+                yield chunk
+        if sent != size:
+            raise IOError(f"帧文件在导出过程中被修改: {arcname}")
+
+        central_directory.append(struct.pack('<IH5HIIIHHHHHII', 0x02014b50, 20, *fields, 0, 0, 0, 0, 0, offset) + name)
+        offset += 30 + len(name) + size
+
+    directory = b''.join(central_directory)
+    yield directory
+    yield struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(entries), len(entries), len(directory), offset, 0)
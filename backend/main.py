@@ -6,14 +6,24 @@ import sys
 import requests
 from datetime import datetime, timedelta
 import time
-import cv2
 import numpy as np
-import urllib.request
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import threading
 import shutil
-from chiptune_generation import MusicGenerationRequest, generate_music
+import asyncio
+import json
+import uuid
+from starlette.concurrency import run_in_threadpool
+from chiptune_generation import MusicGenerationRequest, generate_music_stream, generate_music_stems, resolve_output_profile, resolve_loop_options, resolve_stems_options, output_media_type, format_note_cache_stats
+from chiptune_generation import ChiptuneRenderRequest, RenderVariant, render_chiptune_variants, build_variant_zip, build_variant_json, MAX_RENDER_VARIANTS
+
+from animation_jobs import AnimationJobManager
+from frame_extraction import open_video, plan_interval_indices, plan_timestamp_indices, plan_smart_indices, load_proxies, SAMPLING_MODES, iter_frames, video_cache, resolve_frame_options, save_frames
+from frame_extraction import resolve_frame_selection, stored_zip_size, iter_stored_zip
+from sprite_atlas import resolve_atlas_options, build_atlas, write_atlas, DEFAULT_ATLAS_SIZE, DEFAULT_PADDING, DEFAULT_TOLERANCE
+from frame_animation import resolve_animation_options, encode_animation, ANIMATION_FORMATS
 
 from volcenginesdkarkruntime import Ark
 import config
@@ -32,6 +42,11 @@ client = Ark(
     api_key=os.environ.get('ARK_API_KEY'),
 )
 
+# 动画生成任务管理器，由一个后台线程统一轮询所有任务的状态
+animation_jobs = AnimationJobManager(client)
+ANIMATION_WAIT_INTERVAL = 0.5  # 等待任务状态变化时的检查间隔（秒），只读内存状态，不访问上游
+SSE_HEARTBEAT_INTERVAL = 15  # SSE连接无事件时发送心跳的间隔（秒）
+
 class ImageGenerationRequest(BaseModel):
     prompt: str
     size: Optional[str] = "512x512"
@@ -55,6 +70,75 @@ class FrameSplitRequest(BaseModel):
     video_url: str
     interval: float = 1.0
     count: int = 10
+    timestamps: Optional[List[float]] = None  # 按时间点（秒）提取，提供时忽略interval和count
+    mode: Optional[str] = "interval"  # 采样方式：interval按固定间隔，smart挑选画面差异最大的count帧（忽略interval）
+    image_format: Optional[str] = "jpg"  # 帧图片格式：jpg/png/webp，png和默认质量的webp为无损
+    quality: Optional[int] = None  # jpg/webp的质量（1-100，webp取101为无损），不填使用默认值
+    scale: Optional[float] = None  # 缩放比例，未指定width/height时生效
+    width: Optional[int] = None  # 输出宽度，只给出宽或高时按原比例计算另一边
+    height: Optional[int] = None  # 输出高度
+
+def build_animation_content(request: AnimationGenerationRequest):
+    """根据请求参数构建动画生成任务的内容数组"""
+    # 构建参数字符串
+    params_str = f" --resolution {request.resolution}  --duration {request.duration} --camerafixed {str(request.camera_fixed).lower()} --watermark {str(request.watermark).lower()}"
+    full_prompt = request.prompt + params_str
+
+    # 准备内容数组
+    content = [
+        {
+            "type": "text",
+            "text": full_prompt
+        }
+    ]
+
+    # 如果提供了首帧图片URL，则添加到内容中
+    if request.first_frame and request.first_frame.strip():
+        content.append(
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": request.first_frame.strip()
+                }
+            }
+        )
+    return content
+
+def submit_animation_job(request: AnimationGenerationRequest):
+    """校验请求并提交动画生成任务，立即返回任务对象"""
+    print(f"收到动画生成请求: prompt={request.prompt}, first_frame={request.first_frame}, resolution={request.resolution}, duration={request.duration}, camera_fixed={request.camera_fixed}, watermark={request.watermark}")
+
+    # 验证参数
+    if not request.prompt or len(request.prompt.strip()) == 0:
+        raise HTTPException(status_code=400, detail="Prompt不能为空")
+
+    params = {
+        "prompt": request.prompt,
+        "first_frame": request.first_frame,
+        "resolution": request.resolution,
+        "duration": request.duration,
+        "camera_fixed": request.camera_fixed,
+        "watermark": request.watermark,
+    }
+    return animation_jobs.submit(build_animation_content(request), params)
+
+class AtlasRequest(BaseModel):
+    frames: Optional[List[str]] = None  # 按顺序排列的帧图片文件名，不提供时使用整个帧集合
+    packing: Optional[str] = "maxrects"  # 打包方式：maxrects（紧凑）/grid（等大格子，帧间对齐）
+    trim: Optional[bool] = True  # 裁掉透明边缘
+    transparent_color: Optional[str] = None  # 抠为透明的背景色（#rrggbb），auto取四角颜色，不填则不抠图
+    tolerance: Optional[int] = DEFAULT_TOLERANCE  # 抠图时允许的单通道色差
+    padding: Optional[int] = DEFAULT_PADDING  # 精灵之间的间距（像素）
+    max_size: Optional[int] = DEFAULT_ATLAS_SIZE  # 单张图集的最大边长，超出时拆分为多张
+    power_of_two: Optional[bool] = True  # 图集尺寸取2的幂
+
+class FrameAnimationRequest(BaseModel):
+    frames: Optional[List[str]] = None  # 按播放顺序排列的帧图片文件名，不提供时使用整个帧集合
+    output_format: Optional[str] = "webp"  # 动图格式：webp/gif/apng
+    fps: Optional[float] = 12  # 播放帧率
+    colors: Optional[int] = 256  # 全局调色板的颜色数（2-256）
+    quantizer: Optional[str] = "median_cut"  # 调色板算法：median_cut（快）/kmeans（更准确）
+    loop: Optional[bool] = True  # 是否循环播放
 
 app = FastAPI()
 
@@ -66,7 +150,9 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
     allow_origin_regex=None,
-    expose_headers=[],
+    # 生成接口通过响应头返回缓存状态、采样率和循环点，跨域的前端需要读取
+    expose_headers=["Content-Disposition", "X-Sample-Rate", "X-Prompt-Cache", "X-Render-Cache", "X-Note-Cache",
+                    "X-Loop-Start", "X-Loop-End", "X-Loop-Length", "X-Loop-Seamless"],
     max_age=600,
 )
 
@@ -132,69 +218,154 @@ threading.Thread(target=cleanup_old_frames, daemon=True).start()
 @app.post("/api/split-frames")
 def split_frames(request: FrameSplitRequest):
     try:
-        print(f"收到帧拆分请求: video_url={request.video_url}, interval={request.interval}, count={request.count}")
+        print(f"收到帧拆分请求: video_url={request.video_url}, interval={request.interval}, count={request.count}, timestamps={request.timestamps}, mode={request.mode}, image_format={request.image_format}, quality={request.quality}, scale={request.scale}, size={request.width}x{request.height}")
         
-        # 下载视频文件到临时位置
-        temp_video_path = f"temp_video_{int(time.time())}.mp4"
-        urllib.request.urlretrieve(request.video_url, temp_video_path)
-        
-        # 使用OpenCV读取视频
-        cap = cv2.VideoCapture(temp_video_path)
-        
-        if not cap.isOpened():
-            raise HTTPException(status_code=500, detail="无法打开视频文件")
+        # 先校验输出参数，参数无效时不必下载视频
+        try:
+            frame_options = resolve_frame_options(request.image_format, request.quality, request.scale, request.width, request.height)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        sampling_mode = (request.mode or "interval").lower()
+        if sampling_mode not in SAMPLING_MODES:
+            raise HTTPException(status_code=400, detail=f"不支持的采样方式: {request.mode}，可选: {', '.join(SAMPLING_MODES)}")
         
-        # 获取视频的帧率
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        print(f"视频帧率: {fps}")
+        # 从视频缓存取得本地文件，未缓存时流式下载；同一URL的并发请求共享一次下载
+        with video_cache.open(request.video_url) as video_path:
+            # 使用OpenCV读取视频
+            try:
+                cap, video_info = open_video(video_path)
+            except IOError as e:
+                raise HTTPException(status_code=500, detail=str(e))
+            
+            fps = video_info['fps']
+            print(f"视频帧率: {fps}, 总帧数: {video_info['frame_count']}")
+            
+            # 先计算全部目标帧，提取开销只与目标帧数量有关，与视频长度无关
+            try:
+                if request.timestamps is not None:
+                    frame_indices = plan_timestamp_indices(request.timestamps, fps, video_info['frame_count'])
+                elif sampling_mode == 'smart':
+                    # 先在缩小的灰度代理图像上比较画面差异，只对选中的帧做完整解码和编码
+                    proxy_indices, proxies = load_proxies(video_path)
+                    frame_indices = plan_smart_indices(proxies, request.count, proxy_indices)
+                else:
+                    frame_indices = plan_interval_indices(fps, video_info['frame_count'], request.interval, request.count)
+            except ValueError as e:
+                cap.release()
+                raise HTTPException(status_code=400, detail=str(e))
+            print(f"目标帧: {frame_indices}")
+            
+            # 生成唯一的帧图片目录（加随机后缀，避免同一秒内的并发请求写入同一目录）
+            timestamp = int(time.time())
+            frame_dir_name = f"frames_{timestamp}_{uuid.uuid4().hex[:8]}"
+            frame_dir_path = os.path.join(frames_dir, frame_dir_name)
+            os.makedirs(frame_dir_path, exist_ok=True)
+            
+            try:
+                # 解码出的帧交给线程池缩放、编码并保存，解码与编码同时进行
+                frame_filenames = save_frames(iter_frames(cap, frame_indices, fps), frame_dir_path, frame_options)
+            finally:
+                cap.release()
         
-        frames = []
-        frame_index = 0
-        extracted_count = 0
+        # 生成可访问的URL
+        frames = [f"http://localhost:8000/frames/{frame_dir_name}/{frame_filename}" for frame_filename in frame_filenames]
         
-        # 计算帧间隔（以帧为单位）
-        frame_interval = max(1, int(fps * request.interval))
-        print(f"计算的帧间隔: {frame_interval} (基于{request.interval}秒间隔)")
+        print(f"成功提取 {len(frames)} 帧图片")
+        # 返回帧图片URL，frame_set用于导出
+        return {"frames": frames, "frame_set": frame_dir_name}
         
-        # 生成唯一的帧图片目录
-        timestamp = int(time.time())
-        frame_dir_name = f"frames_{timestamp}"
-        frame_dir_path = os.path.join(frames_dir, frame_dir_name)
-        os.makedirs(frame_dir_path, exist_ok=True)
+    except HTTPException as he:
+        print(f"HTTP异常: {he.detail}")
+        raise he
+    except Exception as e:
+        print(f"帧拆分过程中发生错误: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 图集打包功能：把帧集合打包为一张或多张精灵图集，附带TexturePacker格式的JSON
+@app.post("/api/frames/{frame_set}/atlas")
+def create_atlas(frame_set: str, request: AtlasRequest):
+    try:
+        print(f"收到图集打包请求: frame_set={frame_set}, frames={len(request.frames) if request.frames is not None else '全部'}, packing={request.packing}, trim={request.trim}, transparent_color={request.transparent_color}, max_size={request.max_size}")
+        try:
+            atlas_options = resolve_atlas_options(request.packing, request.trim, request.transparent_color, request.tolerance,
+                                                  request.padding, request.max_size, request.power_of_two)
+            entries = resolve_frame_selection(frames_dir, frame_set, request.frames)
+            # 图集中的帧名称与导出zip中的文件名一致
+            results = build_atlas([(arcname, path) for arcname, path, _, _ in entries], atlas_options)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        while True:
-            ret, frame = cap.read()
-            if not ret:
-                break
-                
-            # 根据间隔提取帧
-            if frame_index % frame_interval == 0 and extracted_count < request.count:
-                # 保存帧为图片
-                frame_filename = f"frame_{extracted_count}.jpg"
-                frame_filepath = os.path.join(frame_dir_path, frame_filename)
-                cv2.imwrite(frame_filepath, frame)
-                
-                # 生成可访问的URL
-                frame_url = f"http://localhost:8000/frames/{frame_dir_name}/{frame_filename}"
-                frames.append(frame_url)
-                extracted_count += 1
-                
-            frame_index += 1
-            
-        cap.release()
+        frame_dir_path = os.path.join(frames_dir, frame_set)
+        written = write_atlas(results, frame_dir_path, f"atlas_{uuid.uuid4().hex[:8]}")
         
-        # 删除临时视频文件
-        os.remove(temp_video_path)
+        sheets = []
+        for image_name, metadata_name, metadata in written:
+            sheets.append({
+                "image": f"http://localhost:8000/frames/{frame_set}/{image_name}",
+                "metadata": f"http://localhost:8000/frames/{frame_set}/{metadata_name}",
+                "width": metadata["meta"]["size"]["w"],
+                "height": metadata["meta"]["size"]["h"],
+                "frames": len(metadata["frames"]),
+            })
+        print(f"图集打包完成: {len(entries)} 帧，{len(sheets)} 张图集")
+        return {"sheets": sheets}
+    except HTTPException as he:
+        print(f"HTTP异常: {he.detail}")
+        raise he
+    except Exception as e:
+        print(f"图集打包过程中发生错误: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 动图导出功能：把选中的帧按顺序编码为共用全局调色板的WebP/GIF/APNG动图
+@app.post("/api/frames/{frame_set}/animation")
+def create_frame_animation(frame_set: str, request: FrameAnimationRequest):
+    try:
+        print(f"收到动图导出请求: frame_set={frame_set}, frames={len(request.frames) if request.frames is not None else '全部'}, output_format={request.output_format}, fps={request.fps}, colors={request.colors}, quantizer={request.quantizer}, loop={request.loop}")
+        try:
+            animation_options = resolve_animation_options(request.output_format, request.fps, request.colors, request.quantizer, request.loop)
+            entries = resolve_frame_selection(frames_dir, frame_set, request.frames)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        print(f"成功提取 {len(frames)} 帧图片")
-        # 返回帧图片URL
-        return {"frames": frames}
+        animation_name = f"anim_{uuid.uuid4().hex[:8]}{ANIMATION_FORMATS[animation_options['format']]['ext']}"
+        start_time = time.time()
+        animation_info = encode_animation([path for _, path, _, _ in entries],
+                                          os.path.join(frames_dir, frame_set, animation_name), animation_options)
+        print(f"动图导出完成: {animation_info['frames']} 帧，{animation_info['bytes']} 字节，用时 {time.time() - start_time:.2f} 秒")
+        return {"url": f"http://localhost:8000/frames/{frame_set}/{animation_name}", **animation_info}
+    except HTTPException as he:
+        print(f"HTTP异常: {he.detail}")
+        raise he
+    except Exception as e:
+        print(f"动图导出过程中发生错误: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# 帧导出功能：把已拆分的帧直接从磁盘打包为不压缩的zip流式返回
+@app.get("/api/frames/{frame_set}/export")
+def export_frames(frame_set: str, frames: Optional[str] = None):
+    # frames为逗号分隔的帧图片文件名，按导出顺序排列；不提供时导出整个帧集合
+    try:
+        names = [name.strip() for name in frames.split(",") if name.strip()] if frames is not None else None
+        print(f"收到帧导出请求: frame_set={frame_set}, frames={len(names) if names is not None else '全部'}")
+        try:
+            entries = resolve_frame_selection(frames_dir, frame_set, names)
+            content_length = stored_zip_size(entries)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
+        return StreamingResponse(
+            iter_stored_zip(entries),
+            media_type="application/zip",
+            headers={
+                "Content-Disposition": 'attachment; filename="selected_frames.zip"',
+                "Content-Length": str(content_length),
+            }
+        )
     except HTTPException as he:
         print(f"HTTP异常: {he.detail}")
         raise he
     except Exception as e:
-        print(f"帧拆分过程中发生错误: {str(e)}")
+        print(f"帧导出过程中发生错误: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 if os.path.isdir(frontend_build_path):
     # 确保build目录包含index.html
@@ -311,82 +482,80 @@ if os.path.isdir(frontend_build_path):
             return {"status": "ok"}
 
         @app.post("/api/generate-animation")
-        def generate_animation(request: AnimationGenerationRequest):
-            prompt = request.prompt
-            first_frame = request.first_frame
-            resolution = request.resolution
-            duration = request.duration
-            camera_fixed = request.camera_fixed
-            watermark = request.watermark
-            
+        async def generate_animation(request: AnimationGenerationRequest):
+            # 兼容旧接口：提交任务后等待后台轮询线程给出结果，等待期间不占用线程池
             try:
-                print(f"收到动画生成请求: prompt={prompt}, first_frame={first_frame}, resolution={resolution}, duration={duration}, camera_fixed={camera_fixed}, watermark={watermark}")
-                
-                # 验证参数
-                if not prompt or len(prompt.strip()) == 0:
-                    raise HTTPException(status_code=400, detail="Prompt不能为空")
-                
-                # 构建参数字符串
-                params_str = f" --resolution {resolution}  --duration {duration} --camerafixed {str(camera_fixed).lower()} --watermark {str(watermark).lower()}"
-                full_prompt = prompt + params_str
-                
-                # 准备内容数组
-                content = [
-                    {
-                        "type": "text",
-                        "text": full_prompt
-                    }
-                ]
-                
-                # 如果提供了首帧图片URL，则添加到内容中
-                if first_frame and first_frame.strip():
-                    content.append(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": first_frame.strip()
-                            }
-                        }
-                    )
-                
-                # 调用动画生成API
-                create_result = client.content_generation.tasks.create(
-                    model="doubao-seedance-1-0-pro-250528",
-                    content=content
-                )
-                
-                # 获取任务ID
-                task_id = create_result.id
-                print(f"动画生成任务已创建，任务ID: {task_id}")
-                
-                # 轮询查询任务状态
-                while True:
-                    get_result = client.content_generation.tasks.get(task_id=task_id)
-                    status = get_result.status
-                    
-                    if status == "succeeded":
-                        print("动画生成任务成功完成")
-                        # 获取视频URL
-                        video_url = get_result.content.video_url.strip()
-                        print(f"视频URL: {video_url}")
-                        
-                        # 返回视频URL
-                        return {"video_url": video_url}
-                    elif status == "failed":
-                        print("动画生成任务失败")
-                        error_msg = get_result.error.message if get_result.error else "未知错误"
-                        raise HTTPException(status_code=500, detail=f"动画生成失败: {error_msg}")
-                    else:
-                        print(f"当前任务状态: {status}, 3秒后重试...")
-                        import time
-                        time.sleep(3)
-                        
+                job = await run_in_threadpool(submit_animation_job, request)
+
+                while not job.finished:
+                    await asyncio.sleep(ANIMATION_WAIT_INTERVAL)
+
+                if job.status == "failed":
+                    raise HTTPException(status_code=500, detail=f"动画生成失败: {job.error}")
+
+                print(f"视频URL: {job.video_url}")
+                return {"video_url": job.video_url}
             except HTTPException as he:
                 print(f"HTTP异常: {he.detail}")
                 raise he
             except Exception as e:
                 print(f"动画生成过程中发生错误: {str(e)}")
                 raise HTTPException(status_code=500, detail=str(e))
+
+        # 添加异步动画任务API端点
+        @app.options("/api/animation-jobs")
+        def animation_jobs_options():
+            return {"status": "ok"}
+
+        @app.post("/api/animation-jobs")
+        def create_animation_job(request: AnimationGenerationRequest):
+            try:
+                job = submit_animation_job(request)
+                return {"job_id": job.job_id, "status": job.status}
+            except HTTPException as he:
+                print(f"HTTP异常: {he.detail}")
+                raise he
+            except Exception as e:
+                print(f"动画任务创建过程中发生错误: {str(e)}")
+                raise HTTPException(status_code=500, detail=str(e))
+
+        @app.get("/api/animation-jobs/{job_id}")
+        def get_animation_job(job_id: str):
+            job_info = animation_jobs.snapshot(job_id)
+            if job_info is None:
+                raise HTTPException(status_code=404, detail="动画任务不存在或已过期")
+            return job_info
+
+        @app.get("/api/animation-jobs/{job_id}/events")
+        async def animation_job_events(job_id: str):
+            if animation_jobs.get(job_id) is None:
+                raise HTTPException(status_code=404, detail="动画任务不存在或已过期")
+
+            async def event_stream():
+                # 状态变化时推送一条事件，长时间没有变化时发送注释行保持连接，任务结束后关闭
+                version = -1
+                last_sent = time.time()
+                while True:
+                    job = animation_jobs.get(job_id)
+                    if job is None:
+                        yield 'event: error\ndata: {"detail": "动画任务不存在或已过期"}\n\n'
+                        return
+                    if job.version != version:
+                        version = job.version
+                        last_sent = time.time()
+                        yield f"data: {json.dumps(animation_jobs.snapshot(job_id), ensure_ascii=False)}\n\n"
+                        if job.finished:
+                            return
+                    elif time.time() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+                        last_sent = time.time()
+                        yield ": heartbeat\n\n"
+                    await asyncio.sleep(ANIMATION_WAIT_INTERVAL)
+
+            return StreamingResponse(
+                event_stream(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
         
         # 添加Chiptune音乐生成API端点
         @app.options("/api/generate-chiptune")
@@ -399,19 +568,51 @@ if os.path.isdir(frontend_build_path):
             bpm = request.bpm
             
             try:
-                print(f"收到Chiptune音乐生成请求: prompt={prompt}, bpm={bpm}")
+                print(f"收到Chiptune音乐生成请求: prompt={prompt}, bpm={bpm}, profile={request.profile}, output_format={request.output_format}, sample_rate={request.sample_rate}, use_cache={request.use_cache}, pipelined={request.pipelined}")
                 
                 # 验证参数
                 if not prompt or len(prompt.strip()) == 0:
                     raise HTTPException(status_code=400, detail="Prompt不能为空")
+                try:
+                    output_format, sample_rate = resolve_output_profile(request.profile, request.output_format, request.sample_rate, request.stems)
+                    loop = resolve_loop_options(request)
+                    stems = resolve_stems_options(request, output_format)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
                 
-                # 调用音乐生成函数
-                mp3_data = generate_music(prompt, bpm)
+                # 分轨模式：一次合成，返回各轨道分轨和总混音的zip
+                if stems:
+                    zip_data, cache_status = generate_music_stems(prompt, bpm, output_format, sample_rate, request.use_cache)
+                    return Response(content=zip_data, media_type="application/zip", headers={
+                        "Content-Disposition": "attachment; filename=generated_music_stems.zip",
+                        "X-Sample-Rate": str(sample_rate),
+                        "X-Prompt-Cache": cache_status['prompt'],
+                        "X-Render-Cache": cache_status['render'],
+                        "X-Note-Cache": format_note_cache_stats(cache_status['note_cache'])
+                    })
                 
-                # 返回MP3数据
-                return Response(content=mp3_data, media_type="audio/mpeg", headers={
-                    "Content-Disposition": "attachment; filename=generated_music.mp3"
-                })
+                # 调用音乐生成函数，编码后的音频数据逐块流式返回
+                audio_stream, generation_info = generate_music_stream(prompt, bpm, output_format, sample_rate, request.use_cache, request.pipelined, loop)
+                
+                headers = {
+                    "Content-Disposition": f"attachment; filename=generated_music.{output_format}",
+                    "X-Sample-Rate": str(sample_rate),
+                    "X-Prompt-Cache": generation_info['prompt'],
+                    "X-Render-Cache": generation_info['render']
+                }
+                # 循环模式下通过响应头返回循环点（样本偏移）；此时音频已完整渲染，一并返回音符缓存统计
+                if generation_info['loop']:
+                    loop_info = generation_info['loop']
+                    headers.update({
+                        "X-Note-Cache": format_note_cache_stats(generation_info['note_cache']),
+                        "X-Loop-Start": str(loop_info['loop_start']),
+                        "X-Loop-End": str(loop_info['loop_end']),
+                        "X-Loop-Length": str(loop_info['loop_length']),
+                        "X-Loop-Seamless": str(loop_info['seamless']).lower()
+                    })
+                
+                # 返回音频数据流
+                return StreamingResponse(audio_stream, media_type=output_media_type(output_format, sample_rate), headers=headers)
             except HTTPException as he:
                 print(f"HTTP异常: {he.detail}")
                 raise he
@@ -419,6 +620,54 @@ if os.path.isdir(frontend_build_path):
                 print(f"Chiptune音乐生成过程中发生错误: {str(e)}")
                 raise HTTPException(status_code=500, detail=str(e))
         
+        # 添加Chiptune乐谱重渲染API端点：直接使用乐谱文本，不调用模型
+        @app.options("/api/render-chiptune")
+        def render_chiptune_options():
+            return {"status": "ok"}
+
+        @app.post("/api/render-chiptune")
+        def render_chiptune_endpoint(request: ChiptuneRenderRequest):
+            variants = request.variants or [RenderVariant()]
+            
+            try:
+                print(f"收到Chiptune乐谱重渲染请求: {len(variants)}个变体, bundle={request.bundle}")
+                
+                # 验证参数
+                if not request.score or len(request.score.strip()) == 0:
+                    raise HTTPException(status_code=400, detail="乐谱不能为空")
+                if len(variants) > MAX_RENDER_VARIANTS:
+                    raise HTTPException(status_code=400, detail=f"变体数不能超过{MAX_RENDER_VARIANTS}个")
+                if request.bundle not in ("zip", "json"):
+                    raise HTTPException(status_code=400, detail=f"不支持的返回方式: {request.bundle}")
+                try:
+                    render_specs = []
+                    for variant in variants:
+                        if not variant.bpm or variant.bpm <= 0:
+                            raise ValueError(f"BPM必须为正数: {variant.bpm}")
+                        output_format, sample_rate = resolve_output_profile(variant.profile, variant.output_format, variant.sample_rate, variant.stems)
+                        render_specs.append((variant.bpm, output_format, sample_rate, resolve_loop_options(variant),
+                                             resolve_stems_options(variant, output_format)))
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+                
+                # 乐谱只编译一次，所有变体共用编译结果
+                try:
+                    score, rendered = render_chiptune_variants(request.score, render_specs)
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=f"乐谱无效: {str(e)}")
+                
+                if request.bundle == "json":
+                    return build_variant_json(request.score, score, rendered)
+                return Response(content=build_variant_zip(request.score, rendered), media_type="application/zip", headers={
+                    "Content-Disposition": "attachment; filename=chiptune_variants.zip"
+                })
+            except HTTPException as he:
+                print(f"HTTP异常: {he.detail}")
+                raise he
+            except Exception as e:
+                print(f"Chiptune乐谱重渲染过程中发生错误: {str(e)}")
+                raise HTTPException(status_code=500, detail=str(e))
+        
         # 挂载静态文件服务到根路径
         app.mount("/", StaticFiles(directory=frontend_build_path, html=True), name="static")
         print("静态文件服务已挂载到根路径")
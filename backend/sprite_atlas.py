@@ -0,0 +1,336 @@
+"""
+精灵图集（Sprite Sheet）打包模块
+"""
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from frame_extraction import ENCODE_WORKERS
+
+# 配置参数
+ATLAS_PACKINGS = ('maxrects', 'grid')  # 支持的打包方式
+ATLAS_MIN_SIZE = 64  # 图集尺寸下限
+ATLAS_MAX_SIZE = 8192  # 图集尺寸上限（多数GPU支持的最大纹理尺寸）
+DEFAULT_ATLAS_SIZE = 2048  # 默认的单张图集最大边长
+DEFAULT_TOLERANCE = 16  # 抠除背景色时允许的单通道最大色差
+DEFAULT_PADDING = 2  # 相邻精灵之间的间距（像素），避免纹理过滤时串色
+
+
+def resolve_atlas_options(packing="maxrects", trim=True, transparent_color=None, tolerance=DEFAULT_TOLERANCE,
+                          padding=DEFAULT_PADDING, max_size=DEFAULT_ATLAS_SIZE, power_of_two=True):
+    """校验图集参数，返回选项字典；参数无效时抛出ValueError
+
+    transparent_color为"#rrggbb"时把该颜色（容差tolerance内）抠为透明，为"auto"时取四角最常见的颜色，None时不抠图。
+    """
+    packing = (packing or "maxrects").lower()
+    if packing not in ATLAS_PACKINGS:
+        raise ValueError(f"不支持的打包方式: {packing}，可选: {', '.join(ATLAS_PACKINGS)}")
+    if not ATLAS_MIN_SIZE <= max_size <= ATLAS_MAX_SIZE:
+        raise ValueError(f"图集最大尺寸必须在{ATLAS_MIN_SIZE}-{ATLAS_MAX_SIZE}之间: {max_size}")
+    if power_of_two and max_size & (max_size - 1):
+        raise ValueError(f"图集最大尺寸必须是2的幂: {max_size}")
+    if not 0 <= padding <= 64:
+        raise ValueError(f"间距必须在0-64之间: {padding}")
+    if not 0 <= tolerance <= 255:
+        raise ValueError(f"容差必须在0-255之间: {tolerance}")
+
+    color = None
+    if transparent_color:
+        if transparent_color.lower() == "auto":
+            color = "auto"
+        else:
+            value = transparent_color.lstrip('#')
+            try:
+                if len(value) != 6:
+                    raise ValueError(value)
+                r, g, b = int(value[0:2], 16), int(value[2:4], 16), int(value[4:6], 16)
+            except ValueError:
+                raise ValueError(f"背景色格式无效（应为#rrggbb或auto）: {transparent_color}")
+            color = (b, g, r)  # OpenCV使用BGR顺序
+
+    return {
+        'packing': packing,
+        'trim': bool(trim),
+        'color': color,
+        'tolerance': tolerance,
+        'padding': padding,
+        'max_size': max_size,
+        'power_of_two': bool(power_of_two),
+    }
+
+
+def load_sprite(path, options):
+    """读取一帧为BGRA图像，按选项把背景色抠为透明"""
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise IOError(f"无法读取帧图片: {os.path.basename(path)}")
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA)
+    elif image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA)
+
+    color = options['color']
+    if color is not None:
+        if color == "auto":
+            corners = image[[0, 0, -1, -1], [0, -1, 0, -1], :3]
+            # 四角中出现次数最多的颜色视为背景色
+            values, counts = np.unique(corners, axis=0, return_counts=True)
+            color = values[np.argmax(counts)]
+        diff = np.abs(image[:, :, :3].astype(np.int16) - np.asarray(color, dtype=np.int16)).max(axis=2)
+        image[diff <= options['tolerance'], 3] = 0
+    return image
+
+
+def opaque_bounds(image):
+    """返回不透明像素的包围盒 (x, y, 宽, 高)，全透明时返回 (0, 0, 1, 1)"""
+    mask = image[:, :, 3] > 0
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return 0, 0, 1, 1
+    return int(cols[0]), int(rows[0]), int(cols[-1] - cols[0] + 1), int(rows[-1] - rows[0] + 1)
+
+
+def _next_power_of_two(value):
+    return 1 << max(0, math.ceil(math.log2(max(1, value))))
+
+
+def _candidate_sizes(min_width, min_height, area, max_size):
+    # 从能容纳所有矩形的最小面积开始，按面积递增尝试2的幂尺寸
+    sizes = []
+    width = _next_power_of_two(min_width)
+    while width <= max_size:
+        height = _next_power_of_two(max(min_height, math.ceil(area / width)))
+        while height <= max_size:
+            sizes.append((width * height, abs(width - height), width, height))
+            height *= 2
+        width *= 2
+    return [(width, height) for _, _, width, height in sorted(sizes)]
+
+
+class MaxRectsBin:
+    """MaxRects装箱（最短边适配，BSSF）：维护所有极大空闲矩形，每次选剩余短边最小的位置"""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.free = [(0, 0, width, height)]
+
+    def insert(self, width, height):
+        """放入一个矩形，返回左上角 (x, y)，放不下时返回None"""
+        best = None
+        for fx, fy, fw, fh in self.free:
+            if width <= fw and height <= fh:
+                score = (min(fw - width, fh - height), max(fw - width, fh - height))
+                if best is None or score < best[0]:
+                    best = (score, fx, fy)
+        if best is None:
+            return None
+
+        _, x, y = best
+        placed = (x, y, width, height)
+        new_free = []
+        for rect in self.free:
+            new_free.extend(self._split(rect, placed))
+        self.free = self._prune(new_free)
+        return x, y
+
+    @staticmethod
+    def _split(rect, placed):
+        fx, fy, fw, fh = rect
+        px, py, pw, ph = placed
+        if px >= fx + fw or px + pw <= fx or py >= fy + fh or py + ph <= fy:
+            return [rect]
+        pieces = []
+        if px > fx:
+            pieces.append((fx, fy, px - fx, fh))
+        if px + pw < fx + fw:
+            pieces.append((px + pw, fy, fx + fw - px - pw, fh))
+        if py > fy:
+            pieces.append((fx, fy, fw, py - fy))
+        if py + ph < fy + fh:
+            pieces.append((fx, py + ph, fw, fy + fh - py - ph))
+        return pieces
+
+    @staticmethod
+    def _prune(rects):
+        # 去掉被其他空闲矩形完全包含的矩形
+        rects = sorted(set(rects), key=lambda r: r[2] * r[3], reverse=True)
+        kept = []
+        for x, y, w, h in rects:
+            if not any(kx <= x and ky <= y and x + w <= kx + kw and y + h <= ky + kh for kx, ky, kw, kh in kept):
+                kept.append((x, y, w, h))
+        return kept
+
+
+def pack_maxrects(sizes, max_size, padding=0):
+    """把 (宽, 高) 列表装入一张或多张尺寸为2的幂的图集，返回 [(宽, 高, {序号: (x, y)})]
+
+    每张图集选能装下剩余全部矩形的最小尺寸；最大尺寸也装不下时先装满一张，剩下的放入下一张。
+    矩形之间留出padding间距：每个矩形和箱子都加大padding后装箱，图集边缘不留间距。
+    """
+    sizes = [(w + padding, h + padding) for w, h in sizes]
+    remaining = sorted(range(len(sizes)), key=lambda i: (max(sizes[i]), sizes[i][0] * sizes[i][1]), reverse=True)
+    sheets = []
+    while remaining:
+        min_width = max(sizes[i][0] for i in remaining) - padding
+        min_height = max(sizes[i][1] for i in remaining) - padding
+        area = sum((sizes[i][0] - padding) * (sizes[i][1] - padding) for i in remaining)
+        sheet = None
+        for width, height in _candidate_sizes(min_width, min_height, area, max_size):
+            bin_ = MaxRectsBin(width + padding, height + padding)
+            placements = {}
+            for i in remaining:
+                position = bin_.insert(*sizes[i])
+                if position is None:
+                    break
+                placements[i] = position
+            else:
+                sheet = (width, height, placements)
+                break
+
+        if sheet is None:
+            # 最大尺寸也装不下全部，尽量装满一张
+            bin_ = MaxRectsBin(max_size + padding, max_size + padding)
+            placements = {}
+            for i in remaining:
+                position = bin_.insert(*sizes[i])
+                if position is not None:
+                    placements[i] = position
+            # 收缩到实际使用范围对应的2的幂尺寸
+            width = _next_power_of_two(max(x + sizes[i][0] - padding for i, (x, _) in placements.items()))
+            height = _next_power_of_two(max(y + sizes[i][1] - padding for i, (_, y) in placements.items()))
+            sheet = (width, height, placements)
+
+        sheets.append(sheet)
+        remaining = [i for i in remaining if i not in sheet[2]]
+    return sheets
+
+
+def pack_grid(count, cell_width, cell_height, max_size, padding=0):
+    """按统一格子大小逐行排列，返回与pack_maxrects相同结构的结果"""
+    step_x, step_y = cell_width + padding, cell_height + padding
+    columns_max = (max_size + padding) // step_x
+    rows_max = (max_size + padding) // step_y
+    per_sheet = columns_max * rows_max
+    sheets = []
+    for start in range(0, count, per_sheet):
+        n = min(per_sheet, count - start)
+        # 选2的幂尺寸面积最小的列数，面积相同时取更接近正方形的
+        best = None
+        for columns in range(1, columns_max + 1):
+            rows = math.ceil(n / columns)
+            if rows > rows_max:
+                continue
+            width = _next_power_of_two(columns * step_x - padding)
+            height = _next_power_of_two(rows * step_y - padding)
+            key = (width * height, abs(width - height))
+            if best is None or key < best[0]:
+                best = (key, columns, width, height)
+        _, columns, width, height = best
+        placements = {start + k: ((k % columns) * step_x, (k // columns) * step_y) for k in range(n)}
+        sheets.append((width, height, placements))
+    return sheets
+
+
+def build_atlas(sprites, options, workers=ENCODE_WORKERS):
+    """把 [(名称, 图片路径)] 打包为图集，返回 [(BGRA图集图像, TexturePacker格式的frames字典)]
+
+    帧图片读取两遍（先计算包围盒、再拼合），内存中同时只保留少量整帧，适合上百帧的1080p帧集合。
+    grid方式下所有帧按共同的包围盒裁剪，保持帧间对齐；maxrects方式下每帧单独裁剪。
+    """
+    padding = options['padding']
+    max_size = options['max_size']
+    paths = [path for _, path in sprites]
+
+    def measure(path):
+        image = load_sprite(path, options)
+        bounds = opaque_bounds(image) if options['trim'] else (0, 0, image.shape[1], image.shape[0])
+        return image.shape[1], image.shape[0], bounds
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        measured = list(executor.map(measure, paths))
+
+    if options['packing'] == 'grid':
+        # 所有帧共用包围盒的并集
+        left = min(b[0] for _, _, b in measured)
+        top = min(b[1] for _, _, b in measured)
+        right = max(b[0] + b[2] for _, _, b in measured)
+        bottom = max(b[1] + b[3] for _, _, b in measured)
+        measured = [(w, h, (left, top, right - left, bottom - top)) for w, h, _ in measured]
+
+    for (name, _), (_, _, (_, _, w, h)) in zip(sprites, measured):
+        if w > max_size or h > max_size:
+            raise ValueError(f"帧 {name} 的尺寸 {w}x{h} 超过图集最大尺寸 {max_size}，请先缩小帧图片")
+
+    if options['packing'] == 'grid':
+        _, _, (_, _, cell_w, cell_h) = measured[0]
+        sheets = pack_grid(len(sprites), cell_w, cell_h, max_size, padding)
+    else:
+        sheets = pack_maxrects([(b[2], b[3]) for _, _, b in measured], max_size, padding)
+
+    results = []
+    for sheet_width, sheet_height, placements in sheets:
+        if not options['power_of_two']:
+            # 不要求2的幂时收缩到实际使用的范围
+            sheet_width = max(x + measured[i][2][2] for i, (x, _) in placements.items())
+            sheet_height = max(y + measured[i][2][3] for i, (_, y) in placements.items())
+        canvas = np.zeros((sheet_height, sheet_width, 4), dtype=np.uint8)
+        order = sorted(placements)
+
+        def blit(i):
+            x, y = placements[i]
+            bx, by, w, h = measured[i][2]
+            sprite = load_sprite(paths[i], options)[by:by + h, bx:bx + w]
+            canvas[y:y + sprite.shape[0], x:x + sprite.shape[1]] = sprite
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(blit, order))
+
+        frames = {}
+        for i in order:
+            x, y = placements[i]
+            src_w, src_h, (bx, by, w, h) = measured[i]
+            frames[sprites[i][0]] = {
+                'frame': {'x': x, 'y': y, 'w': w, 'h': h},
+                'rotated': False,
+                'trimmed': (w, h) != (src_w, src_h),
+                'spriteSourceSize': {'x': bx, 'y': by, 'w': w, 'h': h},
+                'sourceSize': {'w': src_w, 'h': src_h},
+            }
+        results.append((canvas, frames))
+    return results
+
+
+def atlas_metadata(frames, image_name, width, height):
+    """生成TexturePacker JSON（Hash）格式的元数据"""
+    return {
+        'frames': frames,
+        'meta': {
+            'app': 'FrameForge',
+            'version': '1.0',
+            'image': image_name,
+            'format': 'RGBA8888',
+            'size': {'w': width, 'h': height},
+            'scale': '1',
+        },
+    }
+
+
+def write_atlas(results, directory, prefix):
+    """把图集写入directory：每张图集一个PNG和一个同名JSON，返回 [(PNG文件名, JSON文件名, 元数据)]"""
+    written = []
+    for k, (canvas, frames) in enumerate(results):
+        image_name = f"{prefix}_{k}.png"
+        metadata_name = f"{prefix}_{k}.json"
+        if not cv2.imwrite(os.path.join(directory, image_name), canvas):
+            raise IOError(f"写入图集失败: {image_name}")
+        metadata = atlas_metadata(frames, image_name, canvas.shape[1], canvas.shape[0])
+        with open(os.path.join(directory, metadata_name), 'w', encoding='utf-8') as f:
+            json.dump(metadata, f, ensure_ascii=False, indent=2)
+        written.append((image_name, metadata_name, metadata))
+    return written
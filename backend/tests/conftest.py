@@ -0,0 +1,8 @@
+"""
+测试公共设置：把backend目录加入导入路径；导入模块时会创建Ark客户端，测试不调用模型，只需提供占位的API Key
+"""
+import os
+import sys
+
+os.environ.setdefault('ARK_API_KEY', 'test')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,93 @@
+"""
+动画生成任务管理器（AnimationJobManager）的离线测试，使用假的Ark客户端，不访问上游
+"""
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from animation_jobs import AnimationJobManager
+
+
+class FakeArkClient:
+    """按预先给定的结果序列回应 content_generation.tasks.create / get
+
+    每个任务依次返回序列中的结果，最后一个结果重复返回；结果为异常实例时抛出该异常。
+    """
+
+    def __init__(self, *scripts):
+        self._scripts = list(scripts)
+        self._tasks = {}
+        self.content_generation = SimpleNamespace(tasks=SimpleNamespace(create=self.create, get=self.get))
+
+    def create(self, model, content):
+        task_id = f"task-{len(self._tasks)}"
+        self._tasks[task_id] = list(self._scripts[len(self._tasks)])
+        return SimpleNamespace(id=task_id)
+
+    def get(self, task_id):
+        results = self._tasks[task_id]
+        result = results.pop(0) if len(results) > 1 else results[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def status(name, video_url=None, error=None):
+    content = SimpleNamespace(video_url=video_url) if video_url is not None else None
+    return SimpleNamespace(status=name, content=content, error=error)
+
+
+def make_manager(*scripts, **kwargs):
+    options = dict(initial_delay=0.01, backoff=1.0, max_delay=0.01)
+    options.update(kwargs)
+    return AnimationJobManager(FakeArkClient(*scripts), **options)
+
+
+def wait_finished(manager, job, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        snapshot = manager.snapshot(job.job_id)
+        if snapshot['status'] in ('succeeded', 'failed'):
+            return snapshot
+        time.sleep(0.01)
+    pytest.fail(f"任务未在{timeout}秒内结束: {manager.snapshot(job.job_id)}")
+
+
+def test_job_succeeds():
+    manager = make_manager([status('queued'), status('running'), status('succeeded', video_url=' http://v/1.mp4 ')])
+    snapshot = wait_finished(manager, manager.submit([], {'prompt': 'a'}))
+    assert snapshot['status'] == 'succeeded'
+    assert snapshot['video_url'] == 'http://v/1.mp4'
+    assert snapshot['params'] == {'prompt': 'a'}
+
+
+def test_job_fails_upstream():
+    manager = make_manager([status('running'), status('failed', error=SimpleNamespace(message='内容审核未通过'))])
+    snapshot = wait_finished(manager, manager.submit([]))
+    assert snapshot['status'] == 'failed'
+    assert snapshot['error'] == '内容审核未通过'
+
+
+def test_repeated_query_errors_fail_job():
+    manager = make_manager([ConnectionError("网络错误")])
+    snapshot = wait_finished(manager, manager.submit([]))
+    assert snapshot['status'] == 'failed'
+    assert '网络错误' in snapshot['error']
+
+
+def test_malformed_response_fails_only_that_job():
+    # 第一个任务成功但没有content，第二个任务正常完成：后台线程不能因为第一个任务而退出
+    manager = make_manager([status('succeeded')], [status('running'), status('succeeded', video_url='http://v/2.mp4')])
+    broken = manager.submit([])
+    healthy = manager.submit([])
+    assert wait_finished(manager, broken)['status'] == 'failed'
+    assert wait_finished(manager, healthy)['status'] == 'succeeded'
+    assert manager._poller.is_alive()
+
+
+def test_stuck_job_times_out():
+    manager = make_manager([status('running')], max_age=0.1)
+    snapshot = wait_finished(manager, manager.submit([]))
+    assert snapshot['status'] == 'failed'
+    assert '未完成' in snapshot['error']
@@ -0,0 +1,51 @@
+"""
+音符缓存命中统计的测试：统计按单次渲染划分，并行渲染的轨道线程也计入
+"""
+import pytest
+
+import chiptune_generation as cg
+
+SAMPLE_RATE = 22050
+BPM = 240
+
+SCORE = "\n".join(
+    line for beat in range(160) for line in (f"S1 | {beat} | 5C | 0.5 | vol=10", f"TR | {beat % 8} | 3C | 1 | vol=12")
+)
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(cg, 'render_cache', cg.DiskCache(str(tmp_path / "renders"), 1 << 24, 3600))
+    cg.note_cache.clear()
+
+
+def measured_render(score, workers):
+    with cg.note_cache.measure() as stats:
+        cg.render_score_pcm(score, BPM, workers=workers, sample_rate=SAMPLE_RATE)
+    return stats
+
+
+def test_stats_are_scoped_per_render():
+    score = cg.compile_score(SCORE)
+    first = measured_render(score, workers=1)
+    second = measured_render(score, workers=1)
+    assert first['misses'] > 0
+    # 第二次渲染的统计不包含第一次的计数，全部命中
+    assert second == {'hits': first['hits'] + first['misses'], 'misses': 0}
+
+
+def test_parallel_render_counts_pool_threads():
+    score = cg.compile_score(SCORE)
+    assert cg.parallel_render_workers(score, 2) == 2
+    serial = measured_render(score, workers=1)
+    cg.note_cache.clear()
+    assert measured_render(score, workers=2) == serial
+
+
+def test_variants_report_their_own_stats():
+    spec = (BPM, 'pcm', SAMPLE_RATE, None, False)
+    _, results = cg.render_chiptune_variants(SCORE, [spec, spec])
+    assert results[0]['note_cache']['misses'] > 0
+    # 第二个变体命中渲染缓存，没有合成音符
+    assert results[1]['cache'] == 'hit'
+    assert results[1]['note_cache'] == {'hits': 0, 'misses': 0}
@@ -0,0 +1,132 @@
+"""
+流式LLM→合成管线（generate_music_pipelined）的离线测试，使用假的流式客户端，不访问模型
+"""
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+import chiptune_generation as cg
+
+SAMPLE_RATE = 22050
+BPM = 240
+
+# 按时间顺序输出的乐谱
+ORDERED_SCORE = "\n".join(
+    [f"S1 | {beat} | 5C | 0.5 | vol=10" for beat in range(8)]
+    + [f"TR | {beat} | 3C | 1 | vol=12" for beat in range(8, 12)]
+    + ["NO | 12 | 4C | 0.5 | vol=6"]
+)
+
+# 按轨道逐个输出的乐谱：S2的音符在S1的音符之后才到达，起始时间却更早
+CHANNEL_ORDERED_SCORE = "\n".join(
+    [f"S1 | {beat} | 5C | 0.5 | vol=10" for beat in range(24)]
+    + [f"S2 | {beat} | 4G | 0.5 | vol=8" for beat in range(24)]
+)
+
+# 两个轨道按时间交替输出的乐谱，可以边生成边合成
+INTERLEAVED_SCORE = "\n".join(
+    line for beat in range(32) for line in (f"S1 | {beat} | 5C | 0.5 | vol=10", f"TR | {beat} | 3C | 1 | vol=12")
+)
+
+# 先交替输出两个轨道，之后又从头输出第三个轨道：NO的音符到达时前面的块已经输出
+LATE_CHANNEL_SCORE = INTERLEAVED_SCORE + "\n" + "\n".join(f"NO | {beat} | 4C | 0.5 | vol=6" for beat in range(32))
+
+
+class FakeStreamClient:
+    """按固定长度切分文本，模拟 chat.completions.create(stream=True) 的输出"""
+
+    def __init__(self, text, chunk_size=7):
+        self.text = text
+        self.chunk_size = chunk_size
+        self.calls = 0
+        self.delivered = 0  # 已经交给调用方的文本长度
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, model, messages, stream=False):
+        self.calls += 1
+        assert stream
+        return self._chunks()
+
+    def _chunks(self):
+        for i in range(0, len(self.text), self.chunk_size):
+            self.delivered = min(len(self.text), i + self.chunk_size)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=self.text[i:i + self.chunk_size]))])
+
+
+@pytest.fixture(autouse=True)
+def isolated_caches(tmp_path, monkeypatch):
+    monkeypatch.setattr(cg, 'prompt_cache', cg.DiskCache(str(tmp_path / "prompts"), 1 << 20, 3600))
+    monkeypatch.setattr(cg, 'render_cache', cg.DiskCache(str(tmp_path / "renders"), 1 << 24, 3600))
+
+
+def render_pipelined(text, prompt="测试", output_format='pcm', chunk_size=7):
+    stream = cg.generate_music_pipelined(prompt, BPM, output_format, SAMPLE_RATE,
+                                         stream_client=FakeStreamClient(text, chunk_size))
+    return b''.join(stream)
+
+
+def full_render(text, output_format='pcm'):
+    total_samples, pcm_blocks = cg.render_chiptune_stream(text, BPM, sample_rate=SAMPLE_RATE)
+    return b''.join(cg.encode_audio_stream(pcm_blocks, SAMPLE_RATE, output_format, total_samples=total_samples))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 64])
+def test_chunked_parse_matches_parse_chiptune_text(chunk_size):
+    parser = cg.IncrementalScoreParser()
+    for start in range(0, len(ORDERED_SCORE), chunk_size):
+        parser.feed(ORDERED_SCORE[start:start + chunk_size])
+    parser.close()
+    expected = cg.parse_chiptune_text(ORDERED_SCORE)
+    score = parser.score()
+    assert score.channels == expected.channels
+    assert np.array_equal(score.notes, expected.notes)
+
+
+def test_pipelined_render_matches_full_render():
+    assert render_pipelined(ORDERED_SCORE) == full_render(ORDERED_SCORE)
+
+
+def test_empty_score_raises_before_output():
+    with pytest.raises(ValueError):
+        cg.generate_music_pipelined("空乐谱", BPM, 'pcm', SAMPLE_RATE,
+                                    stream_client=FakeStreamClient("这不是乐谱\n也没有音符"))
+    assert not os.path.exists(cg.prompt_cache.directory) or not os.listdir(cg.prompt_cache.directory)
+    assert not os.path.exists(cg.render_cache.directory) or not os.listdir(cg.render_cache.directory)
+
+
+def test_completed_render_fills_caches():
+    data = render_pipelined(ORDERED_SCORE, prompt="顺序乐谱")
+    assert cg.prompt_cache.get(cg.prompt_cache_key("顺序乐谱")) == ORDERED_SCORE.encode('utf-8')
+    key = cg.render_cache_key(ORDERED_SCORE, BPM, 'pcm', SAMPLE_RATE)
+    assert cg.render_cache.get(key) == data
+
+
+def test_interleaved_score_streams_before_generation_ends():
+    client = FakeStreamClient(INTERLEAVED_SCORE)
+    stream = cg.generate_music_pipelined("交替乐谱", BPM, 'pcm', SAMPLE_RATE, stream_client=client)
+    # 返回时已经合成出第一块，此时模型输出还没有读完
+    assert client.delivered < len(INTERLEAVED_SCORE)
+    assert b''.join(stream) == full_render(INTERLEAVED_SCORE)
+
+
+def test_channel_ordered_score_matches_full_render():
+    data = render_pipelined(CHANNEL_ORDERED_SCORE, prompt="逐轨乐谱", chunk_size=16)
+    # 轨道没有交替出现，全部音符到达之前不输出，结果与完整渲染一致，可以写入渲染缓存
+    assert data == full_render(CHANNEL_ORDERED_SCORE)
+    assert cg.prompt_cache.get(cg.prompt_cache_key("逐轨乐谱")) == CHANNEL_ORDERED_SCORE.encode('utf-8')
+    assert cg.render_cache.get(cg.render_cache_key(CHANNEL_ORDERED_SCORE, BPM, 'pcm', SAMPLE_RATE)) == data
+
+
+def test_late_notes_finish_with_full_render():
+    data = render_pipelined(LATE_CHANNEL_SCORE, prompt="晚到乐谱")
+    expected = full_render(LATE_CHANNEL_SCORE)
+    # 已输出的块缺少晚到的音符，其余部分来自完整渲染
+    assert len(data) == len(expected)
+    assert data != expected
+    block_bytes = 2 * int(cg.STREAM_BLOCK_BEATS * 60.0 / BPM * SAMPLE_RATE)
+    assert data[-block_bytes:] == expected[-block_bytes:]
+    # 乐谱文本完整，仍写入提示词缓存；音频与完整渲染不同，不写入渲染缓存
+    assert cg.prompt_cache.get(cg.prompt_cache_key("晚到乐谱")) == LATE_CHANNEL_SCORE.encode('utf-8')
+    assert cg.render_cache.get(cg.render_cache_key(LATE_CHANNEL_SCORE, BPM, 'pcm', SAMPLE_RATE)) is None
@@ -0,0 +1,29 @@
+"""
+乐谱效果参数的解析测试
+"""
+import pytest
+
+import chiptune_generation as cg
+
+
+def compile_arp(value):
+    score = cg.parse_chiptune_text(f"S1 | 1 | 4C | 1 | vol=10, arp={value}")
+    assert not score.diagnostics
+    return cg.arp_offsets(int(score.notes['arp'][0]))
+
+
+@pytest.mark.parametrize('value, offsets', [
+    ('47', [0, 4, 7]),
+    ('07', [0, 0, 7]),
+    ('047', [0, 0, 4, 7]),
+    ('0c', [0, 0, 12]),
+    ('4C', [0, 4, 12]),
+])
+def test_arp_digits_are_kept_verbatim(value, offsets):
+    # 每个十六进制数字都是一个偏移，前导0与其他数字一样计入
+    assert compile_arp(value) == offsets
+
+
+def test_numeric_params_still_convert():
+    params = cg.parse_parameters("vol=10, pw=12.5, sweep=-12, arp=007")
+    assert params == {'vol': 10, 'pw': 12.5, 'sweep': -12, 'arp': '007'}
@@ -0,0 +1,34 @@
+"""
+视频下载缓存（VideoCache）的测试，使用file:// URL，不访问网络
+"""
+import pytest
+
+from frame_extraction import VideoCache
+
+
+@pytest.fixture
+def video_url(tmp_path):
+    path = tmp_path / "clip.mp4"
+    path.write_bytes(b"not really a video" * 64)
+    return path.as_uri()
+
+
+def test_open_releases_pin(tmp_path, video_url):
+    cache = VideoCache(str(tmp_path / "cache"), 1 << 20)
+    with cache.open(video_url) as first:
+        with cache.open(video_url) as second:
+            assert first == second
+    assert cache._pins == {}
+    assert cache.stats()['misses'] == 1 and cache.stats()['hits'] == 1
+
+
+def test_failed_eviction_releases_pin(tmp_path, video_url, monkeypatch):
+    cache = VideoCache(str(tmp_path / "cache"), 1 << 20)
+
+    def broken_evict():
+        raise OSError("磁盘错误")
+
+    monkeypatch.setattr(cache, '_evict', broken_evict)
+    with pytest.raises(OSError):
+        cache.fetch(video_url)
+    assert cache._pins == {}
@@ -4,7 +4,6 @@ import { settingsStorageService } from './SettingsStorageService';
 import { Box, Typography, Paper, Button, TextField, FormControl, InputLabel, Select, MenuItem, Slider, FormControlLabel, Switch, Card, CardMedia, CircularProgress, LinearProgress, Modal, IconButton, Divider, Grid, Checkbox } from '@mui/material';
 import CloseIcon from '@mui/icons-material/Close';
 import PreviewIcon from '@mui/icons-material/Preview';
-import JSZip from 'jszip';
 
 const AnimationGeneration = () => {
   const [prompt, setPrompt] = useState('');
@@ -90,19 +89,65 @@ const AnimationGeneration = () => {
   // 帧拆分相关状态
   const [frameInterval, setFrameInterval] = useState(1);
   const [frameCount, setFrameCount] = useState(10);
+  const [frameFormat, setFrameFormat] = useState('jpg'); // 帧图片格式，png/webp为无损，适合像素画
+  const [frameMode, setFrameMode] = useState('interval'); // 采样方式，smart挑选画面差异最大的帧
   const [splittingFrames, setSplittingFrames] = useState(false);
   const [splitFrames, setSplitFrames] = useState([]);
+  const [frameSet, setFrameSet] = useState(''); // 帧集合ID，导出时使用
+  const [exportingAnimation, setExportingAnimation] = useState(false);
   const [selectedFrames, setSelectedFrames] = useState([]); // 新增：跟踪选中的帧
   const [framePreviewIndex, setFramePreviewIndex] = useState(0);
   const [playbackSpeed, setPlaybackSpeed] = useState(500); // 播放速度，单位毫秒
   const [loopPlayback, setLoopPlayback] = useState(false); // 是否循环播放
   const [playbackInterval, setPlaybackInterval] = useState(null); // 当前播放间隔
 
+  // 等待动画任务结束：优先通过SSE接收状态推送，连接出错时改为定时查询任务状态
+  const waitForAnimationJob = (jobId) => new Promise((resolve, reject) => {
+    const jobUrl = `http://localhost:8000/api/animation-jobs/${jobId}`;
+    const finish = (job) => {
+      if (job.status === 'succeeded') {
+        resolve(job);
+      } else {
+        reject(new Error(job.error || '动画生成失败'));
+      }
+    };
+
+    const pollJob = async () => {
+      try {
+        const response = await fetch(jobUrl);
+        const job = await response.json();
+        if (!response.ok) {
+          throw new Error(job.detail || `HTTP error! status: ${response.status}`);
+        }
+        if (job.status === 'succeeded' || job.status === 'failed') {
+          finish(job);
+        } else {
+          setTimeout(pollJob, 3000);
+        }
+      } catch (error) {
+        reject(error);
+      }
+    };
+
+    const eventSource = new EventSource(`${jobUrl}/events`);
+    eventSource.onmessage = (event) => {
+      const job = JSON.parse(event.data);
+      if (job.status === 'succeeded' || job.status === 'failed') {
+        eventSource.close();
+        finish(job);
+      }
+    };
+    eventSource.onerror = () => {
+      eventSource.close();
+      pollJob();
+    };
+  });
+
   const handleGenerate = async () => {
     setLoading(true);
     try {
-      // 调用后端API生成动画
-      const response = await fetch('http://localhost:8000/api/generate-animation', { 
+      // 提交动画生成任务，接口立即返回任务ID
+      const response = await fetch('http://localhost:8000/api/animation-jobs', { 
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
@@ -122,7 +167,8 @@ const AnimationGeneration = () => {
         throw new Error(errorData.detail || `HTTP error! status: ${response.status}`);
       }
 
-      const data = await response.json();
+      const { job_id } = await response.json();
+      const data = await waitForAnimationJob(job_id);
       setGeneratedAnimation(data.video_url);
       
       // 保存到历史记录
@@ -229,7 +275,9 @@ const AnimationGeneration = () => {
         body: JSON.stringify({
           video_url: generatedAnimation,
           interval: frameInterval,
-          count: frameCount
+          count: frameCount,
+          mode: frameMode,
+          image_format: frameFormat
         })
       });
 
@@ -240,6 +288,7 @@ const AnimationGeneration = () => {
 
       const data = await response.json();
       setSplitFrames(data.frames);
+      setFrameSet(data.frame_set);
     } catch (error) {
       console.error('帧拆分时出错:', error);
       alert(`帧拆分时出错: ${error.message}`);
@@ -280,37 +329,62 @@ const AnimationGeneration = () => {
     }
   };
 
-  // 导出选中的帧为zip文件
-  const handleExportFrames = async () => {
+  // 导出选中的帧为zip文件：由后端直接从磁盘打包并流式下载，浏览器不再逐帧请求和在内存中压缩
+  const handleExportFrames = () => {
     if (selectedFrames.length === 0) {
       alert('请至少选择一帧');
       return;
     }
 
-    const zip = new JSZip();
-    
-    // 创建一个数组来存储所有Promise
-    const promises = selectedFrames.map(async (frameIndex) => {
-      const frameUrl = splitFrames[frameIndex];
-      const response = await fetch(frameUrl);
-      const blob = await response.blob();
-      const fileName = `frame_${frameIndex + 1}.jpg`;
-      zip.file(fileName, blob);
-    });
-
-    // 等待所有图片获取完成
-    await Promise.all(promises);
-
-    // 生成zip文件
-    const content = await zip.generateAsync({ type: 'blob' });
-    
-    // 创建下载链接
+    // 按选中顺序传递帧图片文件名，zip中依次命名为frame_1、frame_2……
+    const frameNames = selectedFrames.map((frameIndex) => splitFrames[frameIndex].split('/').pop());
     const link = document.createElement('a');
-    link.href = URL.createObjectURL(content);
+    link.href = `http://localhost:8000/api/frames/${frameSet}/export?frames=${encodeURIComponent(frameNames.join(','))}`;
     link.download = 'selected_frames.zip';
     link.click();
   };
 
+  // 导出选中的帧为动图：由后端按播放速度和循环设置编码为单个WebP文件，可直接预览和使用
+  const handleExportAnimation = async () => {
+    if (selectedFrames.length === 0) {
+      alert('请至少选择一帧');
+      return;
+    }
+
+    setExportingAnimation(true);
+    try {
+      const response = await fetch(`http://localhost:8000/api/frames/${frameSet}/animation`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({
+          frames: selectedFrames.map((frameIndex) => splitFrames[frameIndex].split('/').pop()),
+          output_format: 'webp',
+          // 后端只接受0-60帧/秒，播放间隔很短时按60帧导出
+          fps: Math.min(60, Math.max(1, Math.round(1000 / playbackSpeed))),
+          loop: loopPlayback
+        })
+      });
+
+      if (!response.ok) {
+        const errorData = await response.json();
+        throw new Error(errorData.detail || `HTTP error! status: ${response.status}`);
+      }
+
+      const data = await response.json();
+      const link = document.createElement('a');
+      link.href = data.url;
+      link.download = 'animation.webp';
+      link.click();
+    } catch (error) {
+      console.error('导出动图时出错:', error);
+      alert(`导出动图时出错: ${error.message}`);
+    } finally {
+      setExportingAnimation(false);
+    }
+  };
+
   // 预览帧动画
   const previewFrameAnimation = () => {
     if (selectedFrames.length === 0) return;
@@ -836,6 +910,7 @@ const AnimationGeneration = () => {
                 type="number"
                 value={frameInterval}
                 onChange={(e) => setFrameInterval(parseFloat(e.target.value) || 0.1)}
+                disabled={frameMode === 'smart'}
                 InputProps={{ inputProps: { min: 0.1, step: 0.1 } }}
                 sx={{
                   width: 150,
@@ -877,6 +952,57 @@ const AnimationGeneration = () => {
                   }
                 }}
               />
+              <FormControl variant="outlined" sx={{ width: 150 }}>
+                <InputLabel sx={{ color: 'white' }}>采样方式</InputLabel>
+                <Select
+                  value={frameMode}
+                  onChange={(e) => setFrameMode(e.target.value)}
+                  label="采样方式"
+                  sx={{
+                    '& .MuiSelect-select': { color: 'white' },
+                    '& .MuiOutlinedInput-root': {
+                      '& fieldset': {
+                        borderColor: '#ff4500',
+                      },
+                      '&:hover fieldset': {
+                        borderColor: '#ffa500',
+                      },
+                      '&.Mui-focused fieldset': {
+                        borderColor: '#ffa500',
+                      },
+                    }
+                  }}
+                >
+                  <MenuItem value="interval">固定间隔</MenuItem>
+                  <MenuItem value="smart">智能（差异最大）</MenuItem>
+                </Select>
+              </FormControl>
+              <FormControl variant="outlined" sx={{ width: 150 }}>
+                <InputLabel sx={{ color: 'white' }}>图片格式</InputLabel>
+                <Select
+                  value={frameFormat}
+                  onChange={(e) => setFrameFormat(e.target.value)}
+                  label="图片格式"
+                  sx={{
+                    '& .MuiSelect-select': { color: 'white' },
+                    '& .MuiOutlinedInput-root': {
+                      '& fieldset': {
+                        borderColor: '#ff4500',
+                      },
+                      '&:hover fieldset': {
+                        borderColor: '#ffa500',
+                      },
+                      '&.Mui-focused fieldset': {
+                        borderColor: '#ffa500',
+                      },
+                    }
+                  }}
+                >
+                  <MenuItem value="jpg">JPG</MenuItem>
+                  <MenuItem value="png">PNG（无损）</MenuItem>
+                  <MenuItem value="webp">WebP（无损）</MenuItem>
+                </Select>
+              </FormControl>
               <Button
                 variant="contained"
                 onClick={handleSplitFrames}
@@ -1052,6 +1178,22 @@ const AnimationGeneration = () => {
                     >
                       导出帧
                     </Button>
+                    <Button
+                      variant="contained"
+                      onClick={handleExportAnimation}
+                      disabled={exportingAnimation}
+                      sx={{
+                        background: 'linear-gradient(45deg, #ff4500, #ffa500)',
+                        color: '#333',
+                        fontWeight: 'bold',
+                        padding: '5px 15px',
+                        borderRadius: '50px',
+                        marginTop: 2,
+                        marginLeft: 2
+                      }}
+                    >
+                      {exportingAnimation ? '导出中...' : '导出动图'}
+                    </Button>
                   </Box>
                 )}
               </Box>